@@ -1,14 +1,771 @@
 import psycopg2.pool
-from flask import Flask,request,jsonify
+from flask import Flask,request,jsonify,Response
 import psycopg2
-from psycopg2 import pool
+from psycopg2 import pool, extensions
+from contextlib import contextmanager
+from collections import OrderedDict
+from urllib.parse import urlencode
+import threading
+import hashlib
+import queue
+import select
+import json
+import io
+import time
 import os
 
-class TodoApp:
+PAGE_LIMIT_DEFAULT = 100
+PAGE_LIMIT_MAX = 1000
+EXPORT_ITERSIZE = 2000  # rows per FETCH from the server-side cursor, and per streamed chunk
+BULK_CHUNK_SIZE = 5000  # rows per COPY, and per commit with ?commit=chunk
+NDJSON_READ_SIZE = 1 << 16
+TASK_MAX_LENGTH = 100
+BULK_IDS_MAX = 10000
+BATCH_MAX_DELAY_MS = 2.0  # longest a create waits for others to share its INSERT
+BATCH_MAX_SIZE = 256
+CACHE_TTL = 5.0  # seconds; also bounds staleness between workers when nothing LISTENs
+CACHE_MAX_ENTRIES = 10000
+CACHE_MAX_BYTES = 32 << 20
+CACHE_ENTRY_OVERHEAD = 256  # rough per-entry bookkeeping on top of the body
+CHANGES_CHANNEL = "todos_changed"
+CHANGES_MAX_IDS = 500  # larger statements notify "*" and stay under the 8000 byte payload limit
+LISTEN_RECONNECT_DELAY = 1.0
+CHANGES_RETENTION = "1 hour"  # how far back a stream can resume from Last-Event-ID
+CHANGES_PRUNE_INTERVAL = 60.0
+CHANGES_HELD_POLL = 0.05  # how often the feed looks again while an older transaction holds changes back
+STREAM_BACKLOG_MAX = 10000  # a resume further behind than this gets a "reset" event instead
+STREAM_QUEUE_MAX = 1000  # batches a slow subscriber may lag before it is disconnected
+STREAM_HEARTBEAT = 15.0
+STREAM_RETRY_MS = 2000
+
+# Changes are ordered by (writing transaction, change id) and only released once no
+# transaction below the snapshot's xmin is still running: ids are drawn at write
+# time but commit in any order, so nothing can commit below a released position
+RELEASED_CHANGES_QUERY = """
+    SELECT c.id, c.todo_id, c.op, c.task, c.status, c.xid::text::bigint
+    FROM todo_changes c
+    WHERE (c.xid, c.id) > (%s::text::xid8, %s) AND c.xid < pg_snapshot_xmin(pg_current_snapshot())
+    ORDER BY c.xid, c.id
+    LIMIT %s
+"""
+HELD_CHANGES_QUERY = "SELECT EXISTS (SELECT 1 FROM todo_changes WHERE xid >= pg_snapshot_xmin(pg_current_snapshot()))"
+
+# Writes by id have one fixed shape each (absent fields pass NULL and keep their
+# value), so they are prepared once per connection and the server reuses the plan
+PREPARED_STATEMENTS = [
+    "PREPARE todo_update(text, boolean, integer) AS "
+    "UPDATE todos SET task = COALESCE($1, task), status = COALESCE($2, status), updated_at = now() "
+    "WHERE id = $3 RETURNING id, task, status",
+    "PREPARE todo_delete(integer) AS "
+    "DELETE FROM todos WHERE id = $1 RETURNING id",
+    "PREPARE todo_update_many(text, boolean, integer[]) AS "
+    "UPDATE todos SET task = COALESCE($1, task), status = COALESCE($2, status), updated_at = now() "
+    "WHERE id = ANY($3) RETURNING id, task, status",
+    "PREPARE todo_delete_many(integer[]) AS "
+    "DELETE FROM todos WHERE id = ANY($1) RETURNING id",
+]
+
+class PoolTimeout(pool.PoolError):
+    pass
+
+class ConnectionPool:
+    # Thread-safe replacement for SimpleConnectionPool: when all connections are
+    # out, callers queue for up to acquire_timeout seconds instead of failing
+    def __init__(self, minconn, maxconn, acquire_timeout=5.0, max_lifetime=1800.0, ping_after=1.0, **kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.acquire_timeout = acquire_timeout
+        self.max_lifetime = max_lifetime
+        self.ping_after = ping_after  # idle connections older than this are pinged on checkout
+        self.kwargs = kwargs
+        self.statements = []  # PREPAREd on each connection at its first checkout
+        self.prepared = set()
+        self.cond = threading.Condition()
+        self.idle = []  # (connection, returned at), most recently returned last
+        self.born = {}
+        self.size = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.dropped = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        for _ in range(minconn):
+            self.idle.append((self.connect(), time.monotonic()))
+            self.size += 1
+
+    def connect(self):
+        connection = psycopg2.connect(**self.kwargs)
+        self.born[connection] = time.monotonic()
+        return connection
+
+    def expired(self, connection):
+        return time.monotonic() - self.born.get(connection, 0) > self.max_lifetime
+
+    def healthy(self, connection, returned_at):
+        if connection.closed or self.expired(connection):
+            return False
+        if time.monotonic() - returned_at < self.ping_after:
+            return True
+        try:
+            with connection.cursor() as curr:
+                curr.execute("SELECT 1")
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def discard(self, connection, checked_out=True):
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+        self.prepared.discard(connection)
+        with self.cond:
+            self.born.pop(connection, None)
+            self.size -= 1
+            if checked_out:
+                self.in_use -= 1
+                self.dropped += 1
+            self.cond.notify()
+
+    def getconn(self, timeout=None):
+        timeout = self.acquire_timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        while True:
+            with self.cond:
+                self.waiting += 1
+                try:
+                    while not self.idle and self.size >= self.maxconn:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.timeouts += 1
+                            raise PoolTimeout(f"No database connection available within {timeout}s")
+                        self.cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+                if self.idle:
+                    connection, returned_at = self.idle.pop()
+                else:
+                    connection, returned_at = None, None
+                    self.size += 1
+                self.in_use += 1
+
+            if connection is None:
+                try:
+                    connection = self.connect()
+                except Exception:
+                    with self.cond:
+                        self.size -= 1
+                        self.in_use -= 1
+                        self.cond.notify()
+                    raise
+            elif not self.healthy(connection, returned_at):
+                self.discard(connection)
+                continue
+            if self.statements and connection not in self.prepared:
+                try:
+                    self.prepare(connection)
+                except Exception:
+                    self.discard(connection)
+                    raise
+
+            waited = time.monotonic() - start
+            with self.cond:
+                self.acquired += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+            return connection
+
+    def prepare(self, connection):
+        with connection.cursor() as curr:
+            for statement in self.statements:
+                curr.execute(statement)
+        connection.commit()
+        self.prepared.add(connection)
+
+    def putconn(self, connection, close=False):
+        if not close and not connection.closed:
+            status = connection.info.transaction_status
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    connection.rollback()
+                except psycopg2.Error:
+                    close = True
+        if close or connection.closed or self.expired(connection):
+            self.discard(connection)
+            return
+        with self.cond:
+            self.idle.append((connection, time.monotonic()))
+            self.in_use -= 1
+            self.cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None, autocommit=False):
+        # autocommit suits single-statement writes: no BEGIN/COMMIT round trips
+        connection = self.getconn(timeout)
+        try:
+            connection.autocommit = autocommit
+            yield connection
+        finally:
+            if autocommit and not connection.closed:
+                connection.autocommit = False
+            self.putconn(connection)
+
+    def closeall(self):
+        with self.cond:
+            idle, self.idle = self.idle, []
+        for connection, _ in idle:
+            self.discard(connection, checked_out = False)
+
+    def metrics(self):
+        with self.cond:
+            return {
+                "size": self.size,
+                "max": self.maxconn,
+                "in_use": self.in_use,
+                "idle": len(self.idle),
+                "waiting": self.waiting,
+                "acquired": self.acquired,
+                "timeouts": self.timeouts,
+                "dropped": self.dropped,
+                "wait_ms_avg": round(self.wait_total * 1000 / self.acquired, 3) if self.acquired else 0.0,
+                "wait_ms_max": round(self.wait_max * 1000, 3)
+            }
+
+def parse_bool(value):
+    if value.lower() in ("true", "1"):
+        return True
+    if value.lower() in ("false", "0"):
+        return False
+    raise ValueError(f"Expected true or false, got {value!r}")
+
+def parse_todo_filters(args):
+    status = args.get("status")
+    after_id = args.get("after_id")
+    order = args.get("order", "asc").lower()
+    if order not in ("asc", "desc"):
+        raise ValueError("order must be asc or desc")
+    return {
+        "status": parse_bool(status) if status is not None else None,
+        "after_id": int(after_id) if after_id is not None else None,
+        "descending": order == "desc"
+    }
+
+def build_todo_query(status, after_id, descending, limit=None):
+    # Keyset pagination: continue after the last id seen instead of OFFSET, so
+    # every page is an index range scan however deep the client has paged
+    conditions = []
+    params = []
+    if status is not None:
+        conditions.append("status = %s")
+        params.append(status)
+    if after_id is not None:
+        conditions.append("id < %s" if descending else "id > %s")
+        params.append(after_id)
+    query = "SELECT id,task,status FROM todos"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY id DESC" if descending else " ORDER BY id"
+    if limit is not None:
+        query += " LIMIT %s"
+        params.append(limit)
+    return query, params
+
+def validate_todo_item(item):
+    if not isinstance(item, dict):
+        raise ValueError("Each item must be an object")
+    task = item.get("task")
+    if not isinstance(task, str) or not task:
+        raise ValueError("Task is Required.")
+    if len(task) > TASK_MAX_LENGTH:
+        raise ValueError(f"Task is longer than {TASK_MAX_LENGTH} characters")
+    status = item.get("status", False)
+    if not isinstance(status, bool):
+        raise ValueError("Status must be true or false")
+    return task, status
+
+def copy_escape(value):
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def copy_todos(curr, rows):
+    # Ids are drawn from the sequence up front so they map onto rows in input order,
+    # then the rows go over in one COPY instead of one INSERT each
+    curr.execute("SELECT nextval(pg_get_serial_sequence('todos', 'id')) FROM generate_series(1, %s)", (len(rows),))
+    ids = sorted(id for id, in curr.fetchall())
+    data = "".join(f"{id}\t{copy_escape(task)}\t{'t' if status else 'f'}\n" for id, (task, status) in zip(ids, rows))
+    curr.copy_expert("COPY todos (id, task, status) FROM STDIN", io.StringIO(data))
+    return ids
+
+def iter_ndjson(stream):
+    # Reads the body in large blocks; line-by-line reads of a WSGI stream are slow
+    pending = b""
+    while True:
+        block = stream.read(NDJSON_READ_SIZE)
+        if not block:
+            break
+        lines = (pending + block).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    if pending.strip():
+        yield json.loads(pending)
+
+def parse_todo_changes(data):
+    task = data.get("task")
+    status = data.get("status")
+    if task is None and status is None:
+        raise ValueError("Nothing to update: give task and/or status")
+    if task is not None and (not isinstance(task, str) or not task):
+        raise ValueError("Task must be a non-empty string")
+    if status is not None and not isinstance(status, bool):
+        raise ValueError("Status must be true or false")
+    return task, status
+
+def parse_todo_ids(data):
+    ids = data.get("ids")
+    if not isinstance(ids, list) or not ids:
+        raise ValueError("ids must be a non-empty array")
+    if len(ids) > BULK_IDS_MAX:
+        raise ValueError(f"At most {BULK_IDS_MAX} ids per request")
+    if not all(isinstance(id, int) and not isinstance(id, bool) for id in ids):
+        raise ValueError("ids must be integers")
+    return ids
+
+def todo_dict(row):
+    id, task, status = row
+    return {"id": id, "task": task, "status": status}
+
+class PendingInsert:
+    def __init__(self, task, status):
+        self.task = task
+        self.status = status
+        self.id = None
+        self.error = None
+        self.queued = time.monotonic()
+        self.done = threading.Event()
+
+class InsertBatcher:
+    # Coalesces concurrent POST /todos: creates queue up and a flusher thread writes
+    # them as one statement and one commit, every max_delay_ms or at max_size rows
+    def __init__(self, db_pool, max_delay_ms=BATCH_MAX_DELAY_MS, max_size=BATCH_MAX_SIZE):
+        self.db_pool = db_pool
+        self.max_delay = max_delay_ms / 1000.0
+        self.max_size = max_size
+        self.cond = threading.Condition()
+        self.queue = []
+        self.closed = False
+        self.batches = 0
+        self.rows = 0
+        self.largest = 0
+        self.flusher = threading.Thread(target=self.run, name="todo-insert-batcher", daemon=True)
+        self.flusher.start()
+
+    def insert(self, task, status=False):
+        pending = PendingInsert(task, status)
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("Insert batcher is closed")
+            self.queue.append(pending)
+            if len(self.queue) == 1 or len(self.queue) >= self.max_size:
+                self.cond.notify()
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.id
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                deadline = self.queue[0].queued + self.max_delay
+                while len(self.queue) < self.max_size and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch, self.queue = self.queue[:self.max_size], self.queue[self.max_size:]
+            self.flush(batch)
+
+    def flush(self, batch):
+        try:
+            self.write(batch)
+        except pool.PoolError as e:
+            for pending in batch:
+                pending.error = e
+        except Exception:
+            # One bad row must not fail the requests that happened to share its batch
+            for pending in batch:
+                try:
+                    self.write([pending])
+                except Exception as e:
+                    pending.error = e
+        for pending in batch:
+            pending.done.set()
+
+    def write(self, batch):
+        with self.db_pool.connection() as connection:
+            try:
+                with connection.cursor() as curr:
+                    ids = copy_todos(curr, [(pending.task, pending.status) for pending in batch])
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+        for pending, id in zip(batch, ids):
+            pending.id = id
+        with self.cond:
+            self.batches += 1
+            self.rows += len(batch)
+            self.largest = max(self.largest, len(batch))
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.flusher.join()
+
+    def metrics(self):
+        with self.cond:
+            return {
+                "queued": len(self.queue),
+                "batches": self.batches,
+                "rows": self.rows,
+                "rows_per_batch": round(self.rows / self.batches, 2) if self.batches else 0.0,
+                "largest_batch": self.largest,
+                "max_delay_ms": self.max_delay * 1000,
+                "max_size": self.max_size
+            }
+
+class CachedResponse:
+    def __init__(self, body, ttl, last_modified=None, next_after_id=None):
+        self.body = body
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.last_modified = last_modified
+        self.next_after_id = next_after_id
+        self.expires = time.monotonic() + ttl
+        self.size = len(body) + CACHE_ENTRY_OVERHEAD
+
+class TodoCache:
+    # LRU of serialized responses, bounded by entry count and bytes, with a TTL.
+    # List pages are keyed by a generation that every write bumps, so dropping all
+    # of them is O(1) and the stale ones just age out of the LRU
+    def __init__(self, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.version = 0  # bumped by every invalidation; fills that started earlier are dropped
+        self.page_generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale_fills = 0
+
+    def page_key(self, *args):
+        return ("page", self.page_generation) + args
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.expires < time.monotonic():
+                self.remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry, version):
+        with self.lock:
+            if version != self.version:
+                # A write landed while this entry was being read from the DB
+                self.stale_fills += 1
+                return
+            self.remove(key)
+            self.entries[key] = entry
+            self.bytes += entry.size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted.size
+                self.evictions += 1
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+    def invalidate(self, ids=()):
+        with self.lock:
+            self.version += 1
+            self.page_generation += 1
+            self.invalidations += 1
+            if ids is None:
+                self.entries.clear()
+                self.bytes = 0
+            else:
+                for id in ids:
+                    self.remove(("todo", id))
+
+    def metrics(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "stale_fills": self.stale_fills
+            }
+
+class ChangeListener:
+    # One dedicated connection per worker LISTENs on the channel the todos triggers
+    # notify, and hands each payload to the callbacks
+    def __init__(self, kwargs, callbacks, on_connect=()):
+        self.kwargs = kwargs
+        self.callbacks = callbacks
+        self.on_connect = on_connect  # anything may have changed while we were not listening
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name="todo-change-listener", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.closed:
+            connection = None
+            try:
+                connection = psycopg2.connect(**self.kwargs)
+                connection.autocommit = True
+                with connection.cursor() as curr:
+                    curr.execute(f"LISTEN {CHANGES_CHANNEL}")
+                for callback in self.on_connect:
+                    callback()
+                while not self.closed:
+                    if select.select([connection], [], [], 1.0)[0]:
+                        connection.poll()
+                        while connection.notifies:
+                            payload = connection.notifies.pop(0).payload
+                            for callback in self.callbacks:
+                                callback(payload)
+            except psycopg2.Error as e:
+                print("Change listener error : ",e)
+                time.sleep(LISTEN_RECONNECT_DELAY)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+    def close(self):
+        self.closed = True
+        self.thread.join()
+
+def parse_change_ids(payload):
+    return None if payload == "*" else [int(id) for id in payload.split(",")]
+
+def parse_change_position(value):
+    # "<xid>:<change id>", as sent in each event's id
+    xid, id = value.split(":")
+    return int(xid), int(id)
+
+def change_position(row):
+    return row[5], row[0]
+
+def change_dict(row):
+    return {"id": row[1], "task": row[3], "status": row[4]}
+
+def sse_event(row):
+    return f"id: {row[5]}:{row[0]}\nevent: {row[2]}\ndata: {json.dumps(change_dict(row))}\n\n"
+
+class Subscriber:
     def __init__(self):
+        self.queue = queue.Queue(STREAM_QUEUE_MAX)
+        self.overflowed = False
+
+class ChangeFeed:
+    # Fans the todo_changes log out to stream subscribers. Every notification just
+    # wakes the feed, which reads everything released past its position once per
+    # burst, however many clients are connected
+    def __init__(self, db_pool):
+        self.db_pool = db_pool
+        self.cond = threading.Condition()
+        self.pending = False
+        self.subscribers = set()
+        self.closed = False
+        self.published = 0
+        self.dropped_subscribers = 0
+        self.position = None  # None while nobody listens and the feed is not following the log
+        self.thread = threading.Thread(target=self.run, name="todo-change-feed", daemon=True)
+        self.thread.start()
+
+    def notify(self, payload=None):
+        # Also called on every listener (re)connect: anything logged meanwhile was not notified
+        with self.cond:
+            self.pending = True
+            self.cond.notify()
+
+    def subscribe(self):
+        subscriber = Subscriber()
+        with self.cond:
+            if self.position is None:
+                # Follow the log again from here, before the caller reads its backlog
+                self.position = self.newest()
+                self.pending = True  # and look for changes held back behind an older transaction
+                self.cond.notify()
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.cond:
+            self.subscribers.discard(subscriber)
+            if not self.subscribers:
+                self.position = None
+
+    def backlog(self, after):
+        # None when the log no longer reaches back that far and the client must refetch
+        with self.db_pool.connection(autocommit = True) as connection:
+            with connection.cursor() as curr:
+                curr.execute("SELECT EXISTS (SELECT 1 FROM todo_changes WHERE xid = %s::text::xid8 AND id = %s)", after)
+                if not curr.fetchone()[0]:
+                    return None
+                curr.execute(RELEASED_CHANGES_QUERY, (*after, STREAM_BACKLOG_MAX + 1))
+                rows = curr.fetchall()
+        if len(rows) > STREAM_BACKLOG_MAX:
+            return None
+        return rows
+
+    def run(self):
+        held = False
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.closed, CHANGES_HELD_POLL if held else None)
+                if self.closed:
+                    return
+                self.pending = False
+                position = self.position
+            held = False
+            if position is None:
+                continue
+            try:
+                held = self.drain(position)
+            except (psycopg2.Error, pool.PoolError) as e:
+                print("Change feed error : ",e)
+                self.notify()
+                time.sleep(LISTEN_RECONNECT_DELAY)
+
+    def fetch(self, after, limit):
+        # The released changes after a position, and whether later ones are held back
+        with self.db_pool.connection(autocommit = True) as connection:
+            with connection.cursor() as curr:
+                curr.execute(RELEASED_CHANGES_QUERY, (*after, limit))
+                rows = curr.fetchall()
+                curr.execute(HELD_CHANGES_QUERY)
+                return rows, curr.fetchone()[0]
+
+    def newest(self):
+        with self.db_pool.connection(autocommit = True) as connection:
+            with connection.cursor() as curr:
+                curr.execute("""
+                    SELECT c.xid::text::bigint, c.id FROM todo_changes c
+                    WHERE c.xid < pg_snapshot_xmin(pg_current_snapshot())
+                    ORDER BY c.xid DESC, c.id DESC LIMIT 1
+                """)
+                return curr.fetchone() or (0, 0)
+
+    def drain(self, position):
+        # Publishes everything released after the position; True while later changes are held back
+        while True:
+            rows, held = self.fetch(position, STREAM_BACKLOG_MAX)
+            if rows:
+                self.publish(rows)
+                position = change_position(rows[-1])
+                with self.cond:
+                    if self.position is None:
+                        return False
+                    self.position = max(self.position, position)
+            if len(rows) < STREAM_BACKLOG_MAX:
+                return held
+
+    def publish(self, events):
+        with self.cond:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait(events)
+            except queue.Full:
+                # It resumes from its Last-Event-ID once it reconnects
+                subscriber.overflowed = True
+                self.unsubscribe(subscriber)
+                self.dropped_subscribers += 1
+        self.published += len(events)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+    def metrics(self):
+        with self.cond:
+            return {
+                "subscribers": len(self.subscribers),
+                "published": self.published,
+                "dropped_subscribers": self.dropped_subscribers,
+                "position": "%d:%d" % self.position if self.position is not None else None
+            }
+
+class ChangeLogPruner:
+    # Runs in every worker, stream or not, so todo_changes stays bounded even when
+    # the stream is switched off after rows were logged
+    def __init__(self, db_pool, interval=CHANGES_PRUNE_INTERVAL):
+        self.db_pool = db_pool
+        self.interval = interval
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="todo-change-pruner", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.prune()
+            except (psycopg2.Error, pool.PoolError) as e:
+                print("Change log prune error : ",e)
+            if self.closed.wait(self.interval):
+                return
+
+    def prune(self):
+        with self.db_pool.connection(autocommit = True) as connection:
+            with connection.cursor() as curr:
+                curr.execute(f"DELETE FROM todo_changes WHERE changed_at < now() - interval '{CHANGES_RETENTION}'")
+
+    def close(self):
+        self.closed.set()
+        self.thread.join()
+
+class TodoApp:
+    def __init__(self, batch_inserts=False, batch_max_delay_ms=BATCH_MAX_DELAY_MS, batch_max_size=BATCH_MAX_SIZE,
+                 cache=True, cache_ttl=CACHE_TTL, cache_listen=False, stream=True):
         self.app = Flask(__name__)
-        self.db_pool = psycopg2.pool.SimpleConnectionPool(
+        self.db_pool = ConnectionPool(
             1,20,
+            acquire_timeout = 5.0,
+            max_lifetime = 1800.0,
             user = "todo_user",
             password = "todo_password",
             host = "localhost",
@@ -16,29 +773,119 @@ class TodoApp:
             database = "todo_db"
         )
         self.init_db()
+        self.db_pool.statements = PREPARED_STATEMENTS  # the table exists from here on
+        self.batcher = InsertBatcher(self.db_pool, batch_max_delay_ms, batch_max_size) if batch_inserts else None
+        self.cache = TodoCache(cache_ttl) if cache else None
+        self.feed = ChangeFeed(self.db_pool) if stream else None
+        self.pruner = ChangeLogPruner(self.db_pool)
+        callbacks, on_connect = [], []
+        if self.cache is not None and cache_listen:
+            # Writes made by other workers reach this worker's cache through NOTIFY
+            callbacks.append(lambda payload: self.cache.invalidate(parse_change_ids(payload)))
+            on_connect.append(lambda: self.cache.invalidate(None))
+        if self.feed is not None:
+            callbacks.append(self.feed.notify)
+            on_connect.append(self.feed.notify)
+        # The cache and the stream share the one listener connection
+        self.listener = ChangeListener(self.db_pool.kwargs, callbacks, on_connect) if callbacks else None
         self.setup_routes()
 
     def init_db(self):
-        connection = self.db_pool.getconn()
-        try:
+        with self.db_pool.connection() as connection:
+            try:
+                with connection.cursor() as curr:
+                    curr.execute("""
+                        CREATE TABLE IF NOT EXISTS todos(
+                            id SERIAL PRIMARY KEY,
+                            task VARCHAR(100) NOT NULL,
+                            status BOOLEAN DEFAULT FALSE
+                        )
+                    """)
+                    curr.execute("CREATE INDEX IF NOT EXISTS todos_status_id ON todos (status, id)")
+                    curr.execute("ALTER TABLE todos ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now()")
+                    curr.execute("""
+                        CREATE TABLE IF NOT EXISTS todo_changes(
+                            id BIGSERIAL PRIMARY KEY,
+                            todo_id INTEGER NOT NULL,
+                            op VARCHAR(6) NOT NULL,
+                            task VARCHAR(100),
+                            status BOOLEAN,
+                            changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                        )
+                    """)
+                    curr.execute("ALTER TABLE todo_changes ADD COLUMN IF NOT EXISTS xid xid8 NOT NULL DEFAULT pg_current_xact_id()")
+                    curr.execute("CREATE INDEX IF NOT EXISTS todo_changes_changed_at ON todo_changes (changed_at)")
+                    curr.execute("CREATE INDEX IF NOT EXISTS todo_changes_xid_id ON todo_changes (xid, id)")
+                    # One row for the whole database, so every worker logs (or not) alike
+                    curr.execute("""
+                        CREATE TABLE IF NOT EXISTS todo_settings(
+                            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+                            log_changes BOOLEAN NOT NULL DEFAULT TRUE
+                        )
+                    """)
+                    curr.execute("INSERT INTO todo_settings DEFAULT VALUES ON CONFLICT DO NOTHING")
+                    # One notification per statement naming the todo ids it touched; while change
+                    # logging is on, the rows are logged for the stream first
+                    curr.execute(f"""
+                        CREATE OR REPLACE FUNCTION todos_notify_changed() RETURNS trigger AS $$
+                        DECLARE
+                            ids text;
+                        BEGIN
+                            IF (SELECT log_changes FROM todo_settings) THEN
+                                INSERT INTO todo_changes (todo_id, op, task, status)
+                                SELECT id, lower(TG_OP), task, status FROM changed ORDER BY id;
+                            END IF;
+                            SELECT CASE WHEN count(*) > {CHANGES_MAX_IDS} THEN '*' ELSE string_agg(id::text, ',') END
+                            INTO ids FROM changed;
+                            IF ids IS NOT NULL THEN
+                                PERFORM pg_notify('{CHANGES_CHANNEL}', ids);
+                            END IF;
+                            RETURN NULL;
+                        END
+                        $$ LANGUAGE plpgsql
+                    """)
+                    for event, transition in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+                        curr.execute(f"""
+                            CREATE OR REPLACE TRIGGER todos_notify_{event.lower()} AFTER {event} ON todos
+                            REFERENCING {transition} TABLE AS changed
+                            FOR EACH STATEMENT EXECUTE FUNCTION todos_notify_changed()
+                        """)
+                connection.commit() 
+                print("Table Create Successfully")
+            except Exception as e:
+                print("Error : ",e)
+
+    def set_change_logging(self, enabled):
+        # Database wide: with it off, streams in every worker stop receiving changes
+        with self.db_pool.connection(autocommit = True) as connection:
             with connection.cursor() as curr:
-                curr.execute("""
-                    CREATE TABLE IF NOT EXISTS todos(
-                        id SERIAL PRIMARY KEY,
-                        task VARCHAR(100) NOT NULL,
-                        status BOOLEAN DEFAULT FALSE
-                    )
-                """)
-            connection.commit() 
-            print("Table Create Successfully")
-        except Exception as e:
-            print("Error : ",e)
-        finally:
-            self.db_pool.putconn(connection)
+                curr.execute("UPDATE todo_settings SET log_changes = %s", (enabled,))
 
     def setup_routes(self):
         app = self.app
         db_pool = self.db_pool
+        batcher = self.batcher
+        cache = self.cache
+        feed = self.feed
+
+        def invalidate(ids=()):
+            # After the write is committed, so a read that misses from here on sees it
+            if cache is not None:
+                cache.invalidate(ids)
+
+        def cached_response(entry, headers=None):
+            response = Response(entry.body, mimetype = "application/json", headers = headers)
+            response.set_etag(entry.etag)
+            if entry.last_modified is not None:
+                response.last_modified = entry.last_modified
+            return response.make_conditional(request)
+
+        # Pool exhausted for longer than acquire_timeout : ask the client to retry
+        @app.errorhandler(PoolTimeout)
+        def pool_timeout(e):
+            return jsonify({
+                "error" : f"{e}"
+            }),503,{"Retry-After": "1"}
 
         # Root
         @app.route("/")
@@ -47,6 +894,38 @@ class TodoApp:
             "Success" : "Server is running on PORT 5000"
             }),200
 
+        # Metrics : Connection pool usage and wait times
+        @app.route("/metrics/pool",methods=['GET'])
+        def pool_metrics():
+            return jsonify(db_pool.metrics()),200
+
+        # Metrics : Create batching, when enabled
+        @app.route("/metrics/batcher",methods=['GET'])
+        def batcher_metrics():
+            if batcher is None:
+                return jsonify({
+                    "error" : "Insert batching is disabled"
+                }),404
+            return jsonify(batcher.metrics()),200
+
+        # Metrics : Change stream subscribers
+        @app.route("/metrics/stream",methods=['GET'])
+        def stream_metrics():
+            if feed is None:
+                return jsonify({
+                    "error" : "Change stream is disabled"
+                }),404
+            return jsonify(feed.metrics()),200
+
+        # Metrics : Read cache hits, misses and size
+        @app.route("/metrics/cache",methods=['GET'])
+        def cache_metrics():
+            if cache is None:
+                return jsonify({
+                    "error" : "Read cache is disabled"
+                }),404
+            return jsonify(cache.metrics()),200
+
         # Create : Add New Item into DB
         @app.route("/todos",methods=['POST'])
         def create_todo():
@@ -60,72 +939,266 @@ class TodoApp:
                     "error" : "Task is Required."
                 }),400
             
-
-            connection = db_pool.getconn()
-            try:
-                with connection.cursor() as curr:
-                    curr.execute("INSERT INTO todos (task) VALUES (%s) RETURNING id", (task,))
-                    todo_id = curr.fetchone()[0]
-                connection.commit()
+            if batcher is not None:
+                try:
+                    todo_id = batcher.insert(task)
+                except PoolTimeout:
+                    raise
+                except Exception as e:
+                    return jsonify({
+                        "error" : f"{e}"
+                    }),400
+                invalidate()
                 return jsonify({
                     "id" : todo_id,
                     "task" : task,
                     "status" : False
                 }),201
-            except Exception as e:
+
+            with db_pool.connection() as connection:
+                try:
+                    with connection.cursor() as curr:
+                        curr.execute("INSERT INTO todos (task) VALUES (%s) RETURNING id", (task,))
+                        todo_id = curr.fetchone()[0]
+                    connection.commit()
+                    invalidate()
+                    return jsonify({
+                        "id" : todo_id,
+                        "task" : task,
+                        "status" : False
+                    }),201
+                except Exception as e:
+                    return jsonify({
+                        "error" : f"{e}"
+                    }),400
+
+        # Create : Add many Items into DB in one transaction, from a JSON array or an
+        # NDJSON stream (?commit=chunk commits every BULK_CHUNK_SIZE rows instead)
+        @app.route("/todos/bulk",methods=['POST'])
+        def create_todos_bulk():
+            commit_each_chunk = request.args.get("commit") == "chunk"
+            if request.mimetype == "application/x-ndjson":
+                items = iter_ndjson(request.stream)
+            else:
+                items = request.get_json(silent = True)
+                if not isinstance(items, list):
+                    return jsonify({
+                        "error" : "Expected a JSON array of tasks"
+                    }),400
+                # The whole array is in memory already: reject it before touching the DB
+                for position, item in enumerate(items):
+                    try:
+                        validate_todo_item(item)
+                    except ValueError as e:
+                        return jsonify({
+                            "error" : f"Item {position}: {e}"
+                        }),400
+
+            ids = []
+            committed = 0
+            position = 0
+            with db_pool.connection() as connection:
+                try:
+                    with connection.cursor() as curr:
+                        chunk = []
+                        for item in items:
+                            chunk.append(validate_todo_item(item))
+                            position += 1
+                            if len(chunk) == BULK_CHUNK_SIZE:
+                                ids += copy_todos(curr, chunk)
+                                chunk = []
+                                if commit_each_chunk:
+                                    connection.commit()
+                                    committed = len(ids)
+                        if chunk:
+                            ids += copy_todos(curr, chunk)
+                    connection.commit()
+                except Exception as e:
+                    # Bad items and DB errors alike: earlier chunks may already be committed
+                    connection.rollback()
+                    if committed:
+                        invalidate()
+                    error = {"error": f"Item {position}: {e}" if isinstance(e, ValueError) else f"{e}"}
+                    if commit_each_chunk:
+                        error["committed_ids"] = ids[:committed]
+                    return jsonify(error),400
+            invalidate()
+            return jsonify({
+                "count" : len(ids),
+                "ids" : ids
+            }),201
+
+        # Read : Read Items from DB a page at a time (?after_id=&limit=&status=&order=),
+        # or all of them as a stream with ?export=ndjson|json
+        @app.route("/todos",methods=['GET'])
+        def read_todo():
+            try:
+                filters = parse_todo_filters(request.args)
+                limit = int(request.args.get("limit", PAGE_LIMIT_DEFAULT))
+            except ValueError as e:
                 return jsonify({
                     "error" : f"{e}"
                 }),400
-            finally:
-                db_pool.putconn(connection)
+            if limit < 1 or limit > PAGE_LIMIT_MAX:
+                return jsonify({
+                    "error" : f"limit must be between 1 and {PAGE_LIMIT_MAX}"
+                }),400
 
-        # Read : Read All Items from DB 
-        @app.route("/todos",methods=['GET'])
-        def read_todo():
+            export = request.args.get("export")
+            if export is not None:
+                if export not in ("ndjson", "json"):
+                    return jsonify({
+                        "error" : "export must be ndjson or json"
+                    }),400
+                return export_todos(filters, export)
+
+            key = cache.page_key(filters["status"], filters["after_id"], filters["descending"], limit) if cache else None
+            entry = cache.get(key) if cache else None
+            if entry is None:
+                version = cache.version if cache else None
+                with db_pool.connection() as connection:
+                    try:
+                        with connection.cursor() as curr:
+                            query, params = build_todo_query(limit = limit + 1, **filters)
+                            curr.execute(query, params)
+                            todos = curr.fetchall()
+                        connection.commit()
+                    except Exception as e:
+                        return jsonify({
+                            "error" : f"{e}"
+                        }),400 
+
+                next_after_id = None
+                if len(todos) > limit:
+                    # One extra row tells us there is a next page without a COUNT(*)
+                    todos = todos[:limit]
+                    next_after_id = todos[-1][0]
+                body = (app.json.dumps([todo_dict(todo) for todo in todos]) + "\n").encode()
+                entry = CachedResponse(body, cache.ttl if cache else 0, next_after_id = next_after_id)
+                if cache:
+                    cache.put(key, entry, version)
+
+            headers = {}
+            if entry.next_after_id is not None:
+                next_args = dict(request.args, after_id = entry.next_after_id)
+                headers["Link"] = f'<{request.base_url}?{urlencode(next_args)}>; rel="next"'
+                headers["X-Next-After-Id"] = str(entry.next_after_id)
+            return cached_response(entry, headers)
+
+        def export_todos(filters, export):
+            # A named (server-side) cursor fetches EXPORT_ITERSIZE rows at a time, so
+            # neither the worker nor psycopg2 ever holds the whole table
             connection = db_pool.getconn()
+            query, params = build_todo_query(**filters)
+
+            def generate():
+                with connection.cursor(name = "todos_export") as curr:
+                    curr.itersize = EXPORT_ITERSIZE
+                    curr.execute(query, params)
+                    first = True
+                    if export == "json":
+                        yield "["
+                    while True:
+                        rows = curr.fetchmany(EXPORT_ITERSIZE)
+                        if not rows:
+                            break
+                        if export == "ndjson":
+                            yield "".join(json.dumps(todo_dict(row)) + "\n" for row in rows)
+                        else:
+                            chunk = ",".join(json.dumps(todo_dict(row)) for row in rows)
+                            yield chunk if first else "," + chunk
+                        first = False
+                    if export == "json":
+                        yield "]"
+
+            response = Response(generate(), mimetype = "application/x-ndjson" if export == "ndjson" else "application/json")
+            # Runs when the stream ends or the client goes away; rolls back the read transaction
+            response.call_on_close(lambda: db_pool.putconn(connection))
+            return response
+
+        # Read : Server-sent stream of todo changes, resumable from Last-Event-ID
+        @app.route("/todos/stream",methods=['GET'])
+        def stream_todos():
+            if feed is None:
+                return jsonify({
+                    "error" : "Change stream is disabled"
+                }),404
+            last_event_id = request.headers.get("Last-Event-ID", request.args.get("last_event_id"))
             try:
-                with connection.cursor() as curr:
-                    curr.execute("SELECT id,task,status from todos")
-                    todos = curr.fetchall()
-                return jsonify(
-                    [
-                        {"id": id, "task": task, "status": status} for id, task, status in todos
-                    ]
-                ),200
-            except Exception as e:
+                last_event_id = parse_change_position(last_event_id) if last_event_id is not None else None
+            except ValueError:
                 return jsonify({
-                    "error" : f"{e}"
-                }),400 
-            finally:
-                db_pool.putconn(connection)
+                    "error" : "Last-Event-ID must be <xid>:<id>"
+                }),400
+
+            # Subscribe before reading the backlog so nothing falls between the two
+            subscriber = feed.subscribe()
+            try:
+                backlog = feed.backlog(last_event_id) if last_event_id is not None else []
+            except Exception:
+                feed.unsubscribe(subscriber)
+                raise
+
+            def generate():
+                try:
+                    yield f"retry: {STREAM_RETRY_MS}\n\n"
+                    if backlog is None:
+                        # Too far behind to replay: the client should refetch GET /todos
+                        yield "event: reset\ndata: {}\n\n"
+                    # Live batches can repeat what the backlog already sent
+                    position = last_event_id if backlog is not None else None
+                    for row in backlog or ():
+                        position = change_position(row)
+                        yield sse_event(row)
+                    while not (subscriber.overflowed and subscriber.queue.empty()):
+                        try:
+                            events = subscriber.queue.get(timeout = STREAM_HEARTBEAT)
+                        except queue.Empty:
+                            yield ": keepalive\n\n"
+                            continue
+                        if position is not None:
+                            events = [row for row in events if change_position(row) > position]
+                        if events:
+                            position = change_position(events[-1])
+                            yield "".join(sse_event(row) for row in events)
+                finally:
+                    feed.unsubscribe(subscriber)
+
+            return Response(generate(), mimetype = "text/event-stream", headers = {
+                "Cache-Control" : "no-cache",
+                "X-Accel-Buffering" : "no"
+            })
 
         # Read : Read Item By Id from DB
         @app.route("/todos/<int:id>",methods=['GET'])
         def read_todo_single(id):
-            connection = db_pool.getconn()
-            try:
-                with connection.cursor() as curr:
-                    curr.execute("SELECT id,task,status from todos WHERE id = %s",(id,))
+            entry = cache.get(("todo", id)) if cache else None
+            if entry is not None:
+                return cached_response(entry)
 
-                    todo = curr.fetchone()
+            version = cache.version if cache else None
+            with db_pool.connection() as connection:
+                try:
+                    with connection.cursor() as curr:
+                        curr.execute("SELECT id,task,status,updated_at from todos WHERE id = %s",(id,))
 
-                    if not todo:
-                        return jsonify({
-                            "error": f"Todo with ID = {id} not found"
-                        }), 404
+                        todo = curr.fetchone()
 
-                    todo_id, task, status = todo
+                        if not todo:
+                            return jsonify({
+                                "error": f"Todo with ID = {id} not found"
+                            }), 404
+                    connection.commit()
+                except Exception as e:
                     return jsonify({
-                        "id": todo_id,
-                        "task": task,
-                        "status": status
-                    }), 200
-            except Exception as e:
-                return jsonify({
-                    "error" : f"{e}"
-                }),400 
-            finally:
-                db_pool.putconn(connection)
+                        "error" : f"{e}"
+                    }),400 
+
+            body = (app.json.dumps(todo_dict(todo[:3])) + "\n").encode()
+            entry = CachedResponse(body, cache.ttl if cache else 0, last_modified = todo[3])
+            if cache:
+                cache.put(("todo", id), entry, version)
+            return cached_response(entry)
 
         # Update : Update Item by Id into DB
         @app.route("/todos/<int:id>",methods=['PUT'])
@@ -142,88 +1215,132 @@ class TodoApp:
             if status is not None:
                 status = bool(status)
 
-            connection = db_pool.getconn()
+            return write_todo(id, task, status)
 
+        # Update : Update only the given fields of an Item by Id
+        @app.route("/todos/<int:id>",methods=['PATCH'])
+        def patch_todo(id):
             try:
-                with connection.cursor() as curr:
-                    curr.execute("SELECT id FROM todos WHERE id = %s",(id,))
-
-                    if not curr.fetchone():
-                        return jsonify({
-                            "error" : "Todo Not Found"
-                        }),404
-                    
-                    update_query = "UPDATE todos SET "
-                    params = []
-
-                    if task is not None:
-                        update_query += "task = %s, "
-                        params.append(task)
-                    if status is not None:
-                        update_query += "status = %s, "
-                        params.append(status)
-                    update_query = update_query.rstrip(", ") + " WHERE id = %s"
-                    params.append(id)
-
-                    print("Update Query :",update_query)
-                    print("Params :", ", ".join(map(str, params)))
-                    
-                    curr.execute(update_query, params)
-                connection.commit()
+                task, status = parse_todo_changes(request.get_json(silent = True) or {})
+            except ValueError as e:
                 return jsonify({
-                    "id": id, 
-                    "task": task, 
-                    "status": status
-                    }),200
-            except Exception as e:
+                    "error" : f"{e}"
+                }),400
+            return write_todo(id, task, status)
+
+        def write_todo(id, task, status):
+            # One autocommitted statement: no SELECT first and no BEGIN/COMMIT, so a
+            # single round trip and no window for the row to vanish in between
+            with db_pool.connection(autocommit = True) as connection:
+                try:
+                    with connection.cursor() as curr:
+                        curr.execute("EXECUTE todo_update(%s, %s, %s)", (task, status, id))
+                        updated = curr.fetchone()
+                except Exception as e:
+                    return jsonify({
+                        "error" : f"{e}"
+                    }),400
+            if not updated:
                 return jsonify({
-                    "Error " :  f"{e}"
-                }),40
-            finally:
-                db_pool.putconn(connection)
+                    "error" : "Todo Not Found"
+                }),404
+            invalidate([id])
+            return jsonify(todo_dict(updated)),200
 
         # Delete : Delete Item by Id into DB
         @app.route("/todos/<int:id>",methods=['DELETE'])
         def delete_todo(id):
-            connection = db_pool.getconn()
+            with db_pool.connection(autocommit = True) as connection:
+                try:
+                    with connection.cursor() as curr:
+                        curr.execute("EXECUTE todo_delete(%s)", (id,))
+                        deleted = curr.fetchone()
+                except Exception as e:
+                    return jsonify({
+                        "error" : f"{e}"
+                    }),400
+            if not deleted:
+                return jsonify({"error": "Todo not found"}), 404
+            invalidate([id])
+            return jsonify(
+                {
+                    "message": "Todo deleted"
+                }
+                ),200
+
+        # Update : Update many Items by Id ({"ids": [...], "task"?, "status"?})
+        @app.route("/todos/bulk",methods=['PATCH'])
+        def update_todos_bulk():
+            data = request.get_json(silent = True) or {}
             try:
-                with connection.cursor() as curr:
-                    curr.execute("SELECT id FROM todos WHERE id = %s", (id,))
+                ids = parse_todo_ids(data)
+                task, status = parse_todo_changes(data)
+            except ValueError as e:
+                return jsonify({
+                    "error" : f"{e}"
+                }),400
+            with db_pool.connection(autocommit = True) as connection:
+                try:
+                    with connection.cursor() as curr:
+                        curr.execute("EXECUTE todo_update_many(%s, %s, %s)", (task, status, ids))
+                        updated = curr.fetchall()
+                except Exception as e:
+                    return jsonify({
+                        "error" : f"{e}"
+                    }),400
+            found = {row[0] for row in updated}
+            invalidate(found)
+            return jsonify({
+                "updated" : [todo_dict(row) for row in updated],
+                "not_found" : [id for id in ids if id not in found]
+            }),200
 
-                    if not curr.fetchone():
-                        return jsonify({"error": "Todo not found"}), 404
-                    
-                    curr.execute("DELETE FROM todos WHERE id = %s",(id,))
-                connection.commit()
-                return jsonify(
-                    {
-                        "message": "Todo deleted"
-                    }
-                    ),200
-            except Exception as e:
+        # Delete : Delete many Items by Id ({"ids": [...]})
+        @app.route("/todos/bulk",methods=['DELETE'])
+        def delete_todos_bulk():
+            try:
+                ids = parse_todo_ids(request.get_json(silent = True) or {})
+            except ValueError as e:
                 return jsonify({
-                    "Error" : f"{e}"
+                    "error" : f"{e}"
                 }),400
-            finally:
-                db_pool.putconn(connection)
+            with db_pool.connection(autocommit = True) as connection:
+                try:
+                    with connection.cursor() as curr:
+                        curr.execute("EXECUTE todo_delete_many(%s)", (ids,))
+                        deleted = [row[0] for row in curr.fetchall()]
+                except Exception as e:
+                    return jsonify({
+                        "error" : f"{e}"
+                    }),400
+            found = set(deleted)
+            invalidate(found)
+            return jsonify({
+                "deleted" : deleted,
+                "not_found" : [id for id in ids if id not in found]
+            }),200
 
         # Toggle : 
         @app.route("/todos/<int:id>/toggle", methods=['PATCH'])
         def toggle_status(id):
-            connection = db_pool.getconn()
-            try:
-                with connection.cursor() as curr:
-                    curr.execute("UPDATE todos SET status = NOT status WHERE id = %s RETURNING id, task, status", (id,))
-                    updated = curr.fetchone()
-                    if not updated:
-                        return jsonify({"error": "Todo not found"}), 404
-                connection.commit()
-                return jsonify({"id": updated[0], "task": updated[1], "status": updated[2]}), 200
-            except Exception as e:
-                return jsonify({"error": str(e)}), 400
-            finally:
-                db_pool.putconn(connection)
+            with db_pool.connection() as connection:
+                try:
+                    with connection.cursor() as curr:
+                        curr.execute("UPDATE todos SET status = NOT status, updated_at = now() WHERE id = %s RETURNING id, task, status", (id,))
+                        updated = curr.fetchone()
+                        if not updated:
+                            return jsonify({"error": "Todo not found"}), 404
+                    connection.commit()
+                    invalidate([id])
+                    return jsonify({"id": updated[0], "task": updated[1], "status": updated[2]}), 200
+                except Exception as e:
+                    return jsonify({"error": str(e)}), 400
 
 if __name__ == '__main__':
-    todo_app = TodoApp()         
+    todo_app = TodoApp(batch_inserts = os.environ.get("TODO_BATCH_INSERTS") == "1",
+                       cache = os.environ.get("TODO_CACHE") != "0",
+                       cache_listen = os.environ.get("TODO_CACHE_LISTEN") == "1",
+                       stream = os.environ.get("TODO_STREAM") != "0")         
+    if os.environ.get("TODO_CHANGE_LOG") in ("0", "1"):
+        todo_app.set_change_logging(os.environ["TODO_CHANGE_LOG"] == "1")
     todo_app.app.run(debug=True)  
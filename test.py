@@ -1,21 +1,142 @@
-import numpy as np
 import os
 import sys
+import abc
+import mmap
 import struct
+import bisect
+import threading
+import zlib
+import lzma
+import json
+import time
+import random
+import hmac
+import traceback
+import itertools
+import tempfile
+import socketserver
 from typing import Tuple, Optional, List
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from contextlib import contextmanager, nullcontext
 import platform
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # no advisory locking on this platform
+
 # Constants
 FILE_NAME = "smartcard.bin"
 FILE_SIZE = 32768
+STORAGE_BACKEND = "file"  # "file", "mmap" or "memory"
 ROOT_OFFSET_PTR = 0x0000
 MF_START_PTR = 0x0002
 WRITE_CURSOR_END = FILE_SIZE - 2 * 2  # uint16_t is 2 bytes
 READ_CURSOR_END = FILE_SIZE - 2
+FORMAT_VERSION_PTR = WRITE_CURSOR_END - 2
+GENERATION_PTR = FORMAT_VERSION_PTR - 2  # bumped by every writer, lets readers drop stale caches
+DATA_AREA_END = GENERATION_PTR  # allocations stop below the image trailer
 MAX_DATA_SIZE = 260
+MAX_SHORT_DATA_SIZE = 0xFF
+MAX_EXTENDED_DATA_SIZE = 0xFFFF
+MAX_APDU_SIZE = 4 + 3 + MAX_EXTENDED_DATA_SIZE + 2  # header, extended Lc, data, extended Le
 MAX_TLV_LEN = 256
 MAX_TLVS = 10
+MAX_LOGICAL_CHANNELS = 20
+
+# Fleet archive layout: header, template, per-card records, index, trailer
+FLEET_MAGIC = b"SCFA"
+FLEET_INDEX_MAGIC = b"SCFI"
+FLEET_VERSION = 1
+FLEET_PAGE_SIZE = 256
+FLEET_HEADER_FORMAT = "<4sHHIBI"  # magic, version, page size, image size, codec, template length
+FLEET_RECORD_TAG = b"C"
+FLEET_RECORD_FORMAT = "<HI"  # name length, payload length
+FLEET_INDEX_TAG = b"I"
+FLEET_INDEX_FORMAT = "<I"  # card count
+FLEET_INDEX_ENTRY_FORMAT = "<HQ"  # name length, record offset
+FLEET_TRAILER_FORMAT = "<Q4s"  # index offset, FLEET_INDEX_MAGIC
+FLEET_CODECS = {"none": 0, "zlib": 1, "lzma": 2}
+
+# Fleet analytics: one row per node / per image, decoded with numpy across the whole fleet
+FLEET_NODE_DTYPE = [("image", "<u4"), ("fid", "<u2"), ("type", "u1"), ("parent_fid", "<u2"), ("depth", "u1"),
+                    ("offset", "<u2"), ("fcp_offset", "<u2"), ("fcp_size", "u1"), ("data_size", "<u2"),
+                    ("sfi", "i1")]  # sfi -1: EF without SFI, or not an EF
+FLEET_IMAGE_DTYPE = [("image", "<u4"), ("version", "<u2"), ("generation", "<u2"), ("nodes", "<u4"),
+                     ("free", "<u4")]
+FLEET_MAX_DEPTH = 16  # deeper trees are taken as corrupt (or cyclic) and cut off
+FLEET_QUERY_OPS = ["==", "!=", "<=", ">=", "<", ">"]
+
+# APDU trace layout: header, then one record per command or reset
+TRACE_MAGIC = b"SCTR"
+TRACE_VERSION = 1
+TRACE_HEADER_FORMAT = "<4sH"  # magic, version
+TRACE_RECORD_FORMAT = "<BIQIIH"  # kind, session id, ns since capture start, command length, response length, SW
+TRACE_APDU = 0
+TRACE_RESET = 1
+TRACE_BUFFER_SIZE = 1 << 16
+
+# Directory index sidecar: header, then per directory its children (FID, offset, SFI, AID)
+INDEX_MAGIC = b"SCIX"
+INDEX_VERSION = 1
+INDEX_HEADER_FORMAT = "<4sHHHI"  # magic, version, image generation, write cursor, directory count
+INDEX_DIRECTORY_FORMAT = "<HH"  # directory offset, entry count
+INDEX_ENTRY_FORMAT = "<HHBB"  # FID, node offset, SFI (0: none), AID length
+
+# Wear sidecar: header, per-page write counts, then counters per INS
+WEAR_MAGIC = b"SCWR"
+WEAR_VERSION = 1
+WEAR_PAGE_SIZE = 64  # a typical EEPROM page
+WEAR_HEADER_FORMAT = "<4sHHI"  # magic, version, page size, page count
+WEAR_INS_COUNT_FORMAT = "<H"
+WEAR_INS_FORMAT = "<HQQQQ"  # INS, commands, payload bytes, bytes written, write calls
+WEAR_NO_INS = 0x100  # writes made outside any APDU (formatting, migration)
+
+# Fuzzing: the image every case forks from, and the starting corpus
+FUZZ_BASE_APDUS = [
+    "00E0000020621E8202782183023F00A5038001008A01058B032F060181020000C603900100",  # MF
+    "00E000001B62198202782183027F108A01058B032F060181020000C603900100",  # DF 7F10
+    "00E000001962178202412183026F018A01058B032F060180020020880108",  # transparent EF, SFI 1
+    "00E000001B621982044221001083026F028A01058B032F060180020040880110",  # linear EF, SFI 2
+    "00E000001B621982044621001083026F038A01058B032F060180020030880118",  # cyclic EF, SFI 3
+]
+FUZZ_SEED_APDUS = [
+    "00E000002462228202782183027F208407A00000008710028A01058B032F060181020000C603900100",
+    "00E000001662148202412183026F108A01058B032F060180020010",
+    "00A4000C023F00", "00A4000C027F10", "00A40004026F01", "00A40004026F02",
+    "00B0000010", "00B0810008", "00B00000000020", "00D600000411223344",
+    "00B2011410", "00B2010400", "00DC0114100102030405060708090A0B0C0D0E0F10",
+    "00A2001404FFFF", "00C0000000", "0070000001", "1070000000",
+    "00E000001B621982044221001083022F068A01058B032F060180020020880130",  # EF.ARR
+    "00DC0104108001019000800102A406830101950108",  # rule 1: read always, update with PIN 01
+    "002000010831323334FFFFFFFF", "0020000100",
+]
+FUZZ_INTERESTING_BYTES = [0x00, 0x01, 0x02, 0x04, 0x7F, 0x80, 0x81, 0xFE, 0xFF]
+FUZZ_MAX_CASE_LEN = 6
+FUZZ_MAX_CORPUS = 4096
+
+# On-image node layouts (little-endian, packed)
+MF_NODE_FORMAT = "<HHHHBHBH"
+DF_NODE_FORMAT = "<HHHBHHHBH"
+EF_NODE_FORMAT = "<HHHBHBH"
+NODE_SECOND_FORMAT = "<HHHH"
+MF_NODE_SIZE = struct.calcsize(MF_NODE_FORMAT)
+DF_NODE_SIZE = struct.calcsize(DF_NODE_FORMAT)
+EF_NODE_SIZE = struct.calcsize(EF_NODE_FORMAT)
+NODE_SECOND_SIZE = struct.calcsize(NODE_SECOND_FORMAT)
+NODE_PREFETCH_SIZE = DF_NODE_SIZE + 0xFF  # largest node header plus a full FCP
+
+# Image Format Versions
+IMAGE_FORMAT_V1 = 1  # children linked through NodeSecond chains
+IMAGE_FORMAT_V2 = 2  # children kept in a FID-sorted table per directory
+IMAGE_FORMAT_VERSION = IMAGE_FORMAT_V2  # version written for new images
+
+# Child table (v2): header (count, capacity) followed by (FID, node offset) entries
+CHILD_TABLE_HEADER_FORMAT = "<HH"
+CHILD_ENTRY_FORMAT = "<HH"
+CHILD_TABLE_HEADER_SIZE = struct.calcsize(CHILD_TABLE_HEADER_FORMAT)
+CHILD_ENTRY_SIZE = struct.calcsize(CHILD_ENTRY_FORMAT)
+CHILD_TABLE_INITIAL_CAPACITY = 4
 
 # File Type Defines
 IS_MF = 0xA0
@@ -40,6 +161,12 @@ INS_READ_BINARY = 0xB0
 INS_UPDATE_BINARY = 0xD6
 INS_READ_RECORD = 0xB2
 INS_UPDATE_RECORD = 0xDC
+INS_GET_RESPONSE = 0xC0
+INS_SEARCH_RECORD = 0xA2
+INS_MANAGE_CHANNEL = 0x70
+INS_VERIFY = 0x20
+READ_ONLY_INS = [INS_SELECT_FILE, INS_READ_BINARY, INS_READ_RECORD, INS_SEARCH_RECORD, INS_GET_RESPONSE,
+                 INS_MANAGE_CHANNEL, INS_VERIFY]
 
 # Status Words
 SW_SUCCESS = 0x9000
@@ -71,111 +198,667 @@ WRONG_PARAMETER = 0x6B00
 SW_INS_NOT_SUPPORTED = 0x6D00
 SW_CLA_NOT_SUPPORTED = 0x6E00
 BAD_LENGTH = 0x6C00
+SW_RESPONSE_BYTES_AVAILABLE = 0x6100
+SW_END_OF_FILE_REACHED = 0x6282
+SW_LOGICAL_CHANNEL_NOT_SUPPORTED = 0x6881
+SW_LAST_COMMAND_EXPECTED = 0x6883
+SW_VERIFY_FAILED = 0x63C0  # low nibble: tries left
+SW_AUTH_METHOD_BLOCKED = 0x6983
+
+# Exceptions escaping a command handler, first match wins; anything else is 6F00
+EXCEPTION_STATUS_WORDS = [
+    (struct.error, SW_MEMORY_FAILURE),  # node or table decoded from a corrupt image
+    (OSError, SW_MEMORY_FAILURE),
+]
+
+# Access control: EF.ARR rules (tag 8B) and the PINs that satisfy them
+ACCESS_READ = 0x01  # access mode byte (AM_DO, tag 80) bits for EFs
+ACCESS_UPDATE = 0x02
+PIN_LENGTH = 8  # PINs are padded with FF to this length
+PIN_MAX_RETRIES = 3
+PINS = {0x01: b"1234", 0x81: b"0000", 0x0A: b"88888888"}  # key reference -> PIN of the test personalisation
+
+# Group commit: writes become durable together, every interval or after enough writes
+GROUP_COMMIT_INTERVAL_MS = 5
+GROUP_COMMIT_MAX_WRITES = 256
+GROUP_COMMIT_PAGE_SIZE = mmap.ALLOCATIONGRANULARITY  # msync offsets must be aligned to this
+
+# Front Ends
+TCP_HOST = "127.0.0.1"
+TCP_PORT = 7816
+
+# Class Byte
+CLA_CHAINING = 0x10  # b5: more commands of the chain follow
 
 # Record Modes
 NEXT = 0x02
 PREVIOUS = 0x03
 ABS_CURR = 0x04
 
+# Search Record Modes (P2 b3-b1, and b3-b1 of the enhanced search indication)
+SEARCH_FORWARD = 0x04
+SEARCH_BACKWARD = 0x05
+SEARCH_ENHANCED = 0x06
+SEARCH_FROM_NEXT = 0x06
+SEARCH_FROM_PREVIOUS = 0x07
+SEARCH_FROM_VALUE = 0x08  # enhanced: start after the first occurrence of a byte value
+
 # Data Structures
 @dataclass
 class MFNode:
-    FID: np.uint16
-    ChildFID: np.uint16
-    ChildOffset: np.uint16
-    Status: np.uint8
-    Type: np.uint8
-    FCPOffset: np.uint16
-    FCP_total_size: np.uint8
-    NextOffset: np.uint16
+    FID: int
+    ChildFID: int
+    ChildOffset: int
+    Status: int
+    Type: int
+    FCPOffset: int
+    FCP_total_size: int
+    NextOffset: int
 
 @dataclass
 class NodeSecond:
-    ParentOffset: np.uint16
-    ChildFID: np.uint16
-    ChildOffset: np.uint16
-    NextOffset: np.uint16
+    ParentOffset: int
+    ChildFID: int
+    ChildOffset: int
+    NextOffset: int
 
 @dataclass
 class FileCursors:
-    write_offset: np.uint16
-    read_offset: np.uint16
+    write_offset: int
+    read_offset: int
 
 @dataclass
 class DFADFNode:
-    FID: np.uint16
-    ParentFID: np.uint16
-    ParentOffset: np.uint16
-    Type: np.uint8
-    ChildFID: np.uint16
-    ChildOffset: np.uint16
-    FCPOffset: np.uint16
-    FCP_total_size: np.uint8
-    NextOffset: np.uint16
+    FID: int
+    ParentFID: int
+    ParentOffset: int
+    Type: int
+    ChildFID: int
+    ChildOffset: int
+    FCPOffset: int
+    FCP_total_size: int
+    NextOffset: int
 
 @dataclass
 class EFNode:
-    FID: np.uint16
-    ParentOffset: np.uint16
-    ParentFID: np.uint16
-    Type: np.uint8
-    FCPOffset: np.uint16
-    FCP_total_size: np.uint8
-    DataOffset: np.uint16
+    FID: int
+    ParentOffset: int
+    ParentFID: int
+    Type: int
+    FCPOffset: int
+    FCP_total_size: int
+    DataOffset: int
 
 @dataclass
 class TLV:
-    tag: np.uint8
-    len: np.uint8
-    value: np.ndarray  # uint8 array of MAX_TLV_LEN
+    tag: int
+    len: int
+    value: bytes
 
 @dataclass
 class APDU:
-    cla: np.uint8
-    ins: np.uint8
-    p1: np.uint8
-    p2: np.uint8
-    lc: np.uint8
-    data: np.ndarray  # uint8 array of MAX_DATA_SIZE
-    data_len: np.uint8
-    le: np.uint8
-    type: np.uint8
-    FID: np.uint16
-    fileSize: np.uint16
-    RecordSize: np.uint16
-    NumberOfRecords: np.uint8
-    sfi: np.uint8
+    cla: int
+    ins: int
+    p1: int
+    p2: int
+    lc: int
+    data: bytearray  # MAX_DATA_SIZE bytes
+    data_len: int
+    le: int
+    type: int
+    FID: int
+    fileSize: int
+    RecordSize: int
+    NumberOfRecords: int
+    sfi: int
 
 @dataclass
 class Result:
-    value: np.uint16
-    sw: np.uint16
+    value: int
+    sw: int
 
 @dataclass
 class FileInfo:
-    fid: np.uint16
-    offset: np.uint16
-    type: np.uint8
+    fid: int
+    offset: int
+    type: int
 
 @dataclass
 class TagCheck:
     present: bool
     message: str
 
+@dataclass
+class WalkNode:
+    offset: int
+    depth: int
+    node: object  # MFNode, DFADFNode or EFNode
+    fcp: bytes
+
+@dataclass
+class DirectoryIndex:
+    entries: List[Tuple[int, int, int, bytes]] = field(default_factory=list)  # FID, node offset, SFI, AID
+    fids: dict = field(default_factory=dict)
+    sfis: dict = field(default_factory=dict)
+    aids: dict = field(default_factory=dict)
+
+@dataclass
+class AccessRule:
+    read: Tuple[int, ...]  # PIN bitmasks, any one of which grants the access
+    update: Tuple[int, ...]
+    arr_offset: int = C_NULL  # EF.ARR the rule was compiled from
+
+@dataclass
+class WearCounters:
+    commands: int = 0
+    payload_bytes: int = 0
+    bytes_written: int = 0
+    writes: int = 0
+
+    @property
+    def amplification(self) -> float:
+        return self.bytes_written / self.payload_bytes if self.payload_bytes else 0.0
+
+@dataclass
+class WearStats:
+    page_size: int
+    page_writes: List[int]
+    by_ins: dict  # INS (or WEAR_NO_INS) -> WearCounters
+
+@dataclass
+class TraceEntry:
+    kind: int
+    session: int  # CardSession.id of the front end session that issued it
+    timestamp_ns: int
+    command: bytes
+    response: bytes
+    sw: int
+
+    def apdu(self) -> Optional[APDU]:
+        return parse_apdu(self.command)[1]
+
+@dataclass
+class ReplayResult:
+    commands: int
+    mismatches: List[dict]
+    elapsed: float
+
+    @property
+    def commands_per_second(self) -> float:
+        return self.commands / self.elapsed if self.elapsed > 0 else 0.0
+
+@dataclass
+class FuzzReport:
+    executions: int
+    cases: int
+    elapsed: float
+    behaviours: set
+    lines: int
+    findings: List[dict]
+    corpus_size: int
+
+    @property
+    def executions_per_second(self) -> float:
+        return self.executions / self.elapsed if self.elapsed > 0 else 0.0
+
+@dataclass
+class SelectionState:
+    CurrentFID: int = C_NULL
+    CurrentOffset: int = C_NULL
+    CurrentFileType: int = 0xFF
+    ParentFID: int = C_NULL
+    ParentOffset: int = C_NULL
+    CurrentEF_FID: int = C_NULL
+    CurrentEF_Offset: int = C_NULL
+    CurrentEF_Type: int = 0xFF
+    record_pointer: int = 0xFF
+    chain_header: Optional[tuple] = None  # (CLA, INS, P1, P2) of an unfinished command chain
+    chain_data: bytearray = field(default_factory=bytearray)
+    pending_response: bytes = b""  # response bytes still to be fetched with GET RESPONSE
+    lock: object = field(default_factory=threading.RLock, compare=False, repr=False)
+
+@dataclass
+class CardSession:
+    # Everything one front end session owns on the card: its logical channels and
+    # the PINs it verified. Sessions only share the image itself.
+    channels: List[Optional[SelectionState]] = field(
+        default_factory=lambda: [SelectionState()] + [None] * (MAX_LOGICAL_CHANNELS - 1))
+    verified_pins: int = 0  # key references verified since power-up, one bit each (see get_pin_bit)
+    id: int = field(default_factory=lambda: next(session_ids), compare=False)  # tells sessions apart in traces
+    lock: object = field(default_factory=threading.Lock, compare=False, repr=False)
+
 # Global Variables
-CurrentFID = np.uint16(C_NULL)
-CurrentOffset = np.uint16(C_NULL)
-CurrentFileType = np.uint8(0xFF)
-ParentFID = np.uint16(C_NULL)
-ParentOffset = np.uint16(C_NULL)
-CurrentEF_FID = np.uint16(C_NULL)
-CurrentEF_Offset = np.uint16(C_NULL)
-CurrentEF_Type = np.uint8(0xFF)
-gFID = np.uint16(C_NULL)
-record_pointer = np.uint8(0xFF)
+gFID = C_NULL
+session_ids = itertools.count()
+default_session = CardSession()  # used by callers that do not bind a session of their own
+active_trace = None  # TraceWriter capturing process_apdu traffic, if any
+channel_context = threading.local()  # session and channel selection the calling thread is working on
+output_context = threading.local()  # quiet is set by silenced() for the calling thread only
+
+def current_session() -> CardSession:
+    return getattr(channel_context, "session", None) or default_session
+
+def current_selection() -> SelectionState:
+    return getattr(channel_context, "state", None) or current_session().channels[0]
+
+@contextmanager
+def bound_session(session: CardSession):
+    previous = getattr(channel_context, "session", None)
+    channel_context.session = session
+    try:
+        yield session
+    finally:
+        channel_context.session = previous
+
+# Storage Backends
+class Storage(abc.ABC):
+    def __init__(self):
+        self.local = threading.local()  # cursor and lock nesting are per thread
+        self.readers = 0
+        self.writer = None
+        self.lock_state = threading.Condition()
+        self.cache = {}
+        self.cache_generation = None
+        self.modified = False  # set by writes, lets an exclusive lock skip the generation bump
+        self.indexes = {}  # directory offset -> DirectoryIndex, built on first lookup
+        self.index_path = None  # optional sidecar the indexes are loaded from and saved to
+        self.index_loaded = False
+        self.indexes_dirty = False
+        self.access_rules = {}  # EF offset -> AccessRule, compiled at first selection
+        self.arr_offsets = set()  # EF.ARR files the cached rules were compiled from
+        self.wear = None  # WearTracker counting every write, if attached
+        self.pin_retries = {}  # key reference -> tries left, PIN_MAX_RETRIES when missing; shared by all sessions
+        self.pin_lock = threading.Lock()
+
+    @property
+    def position(self) -> int:
+        return getattr(self.local, "position", 0)
+
+    @position.setter
+    def position(self, value: int):
+        self.local.position = value
+
+    @property
+    def lock_depth(self) -> int:
+        return getattr(self.local, "depth", 0)
+
+    @property
+    def lock_exclusive(self) -> bool:
+        return getattr(self.local, "exclusive", False)
+
+    @abc.abstractmethod
+    def read_at(self, offset: int, size: int) -> bytes:
+        ...
+
+    def write_at(self, offset: int, data: bytes) -> int:
+        if self.cache:
+            self.cache.clear()
+        self.modified = True
+        if self.wear is not None:
+            self.wear.record(offset, len(data))
+        return self._write_at(offset, data)
+
+    @abc.abstractmethod
+    def _write_at(self, offset: int, data: bytes) -> int:
+        ...
+
+    def fileno(self) -> Optional[int]:
+        return None
+
+    def os_lock(self, operation: int):
+        fd = self.fileno()
+        if fd is not None and fcntl is not None:
+            fcntl.flock(fd, operation)
+
+    # Reader/writer lock over the whole image: threads of this process share one
+    # advisory flock, taken by the first reader or by the writer. Nests per thread.
+    def lock(self, exclusive: bool = False):
+        if self.lock_depth:
+            if exclusive and not self.lock_exclusive:
+                raise RuntimeError("Cannot upgrade a shared image lock to exclusive")
+            self.local.depth += 1
+            return
+        with self.lock_state:
+            if exclusive:
+                while self.writer is not None or self.readers:
+                    self.lock_state.wait()
+                self.writer = threading.get_ident()
+            else:
+                while self.writer is not None:
+                    self.lock_state.wait()
+                if self.readers == 0 and fcntl is not None:
+                    self.os_lock(fcntl.LOCK_SH)
+                self.readers += 1
+        if exclusive and fcntl is not None:
+            try:
+                self.os_lock(fcntl.LOCK_EX)
+            except BaseException:
+                with self.lock_state:
+                    self.writer = None
+                    self.lock_state.notify_all()
+                raise
+        self.local.depth = 1
+        self.local.exclusive = exclusive
+
+    def unlock(self):
+        if self.lock_depth == 0:
+            raise RuntimeError("Image is not locked")
+        self.local.depth -= 1
+        if self.local.depth:
+            return
+        with self.lock_state:
+            if self.local.exclusive:
+                if fcntl is not None:
+                    self.os_lock(fcntl.LOCK_UN)
+                self.writer = None
+            else:
+                self.readers -= 1
+                if self.readers == 0 and fcntl is not None:
+                    self.os_lock(fcntl.LOCK_UN)
+            self.local.exclusive = False
+            self.lock_state.notify_all()
+
+    def flush(self):
+        pass
+
+    def sync(self, ranges: Optional[List[Tuple[int, int]]] = None):
+        # Make written data durable; ranges is a hint of what was written
+        self.flush()
+
+    def commit_ticket(self) -> int:
+        return 0
+
+    def wait_durable(self, ticket: int) -> bool:
+        return True
+
+    @abc.abstractmethod
+    def size(self) -> int:
+        ...
+
+    def close(self):
+        if self.index_path is not None and self.indexes_dirty:
+            save_directory_indexes(self)
+        if self.wear is not None:
+            self.wear.flush()
+
+    # File-object style cursor on top of read_at/write_at, used by the card engine
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size()
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self.position = offset
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = max(self.size() - self.position, 0)
+        data = self.read_at(self.position, size)
+        self.position += len(data)
+        return data
+
+    def write(self, data) -> int:
+        written = self.write_at(self.position, bytes(data))
+        self.position += written
+        return written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class FileStorage(Storage):
+    def __init__(self, path: str, create: bool = False):
+        super().__init__()
+        self.path = path
+        if create:
+            # Never truncate: another process may be initialising the same image
+            self.fp = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o666), "rb+", buffering=0)
+        else:
+            self.fp = open(path, "rb+", buffering=0)
+        self.io_lock = threading.Lock()  # seek+read pairs where pread is unavailable
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        if hasattr(os, "pread"):
+            return os.pread(self.fp.fileno(), size, offset)
+        with self.io_lock:
+            self.fp.seek(offset)
+            return self.fp.read(size) or b""
+
+    def _write_at(self, offset: int, data: bytes) -> int:
+        if hasattr(os, "pwrite"):
+            return os.pwrite(self.fp.fileno(), data, offset)
+        with self.io_lock:
+            self.fp.seek(offset)
+            return self.fp.write(data)
+
+    def fileno(self) -> Optional[int]:
+        return self.fp.fileno()
+
+    def flush(self):
+        self.fp.flush()
+
+    def sync(self, ranges: Optional[List[Tuple[int, int]]] = None):
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def size(self) -> int:
+        return os.fstat(self.fp.fileno()).st_size
+
+    def close(self):
+        if not self.fp.closed:
+            super().close()
+            self.fp.close()
+
+
+class MmapStorage(Storage):
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.fp = open(path, "rb+")
+        self.mm = mmap.mmap(self.fp.fileno(), 0)
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        return self.mm[offset:offset + size]
+
+    def _write_at(self, offset: int, data: bytes) -> int:
+        end = offset + len(data)
+        if end > len(self.mm):
+            raise IOError(f"Write past end of mapped image ({end:04X} > {len(self.mm):04X})")
+        self.mm[offset:end] = data
+        return len(data)
+
+    def flush(self):
+        self.mm.flush()
+
+    def sync(self, ranges: Optional[List[Tuple[int, int]]] = None):
+        if ranges is None:
+            self.mm.flush()
+            return
+        for start, end in ranges:
+            self.mm.flush(start, end - start)  # ranges are page aligned
+
+    def fileno(self) -> Optional[int]:
+        return self.fp.fileno()
+
+    def size(self) -> int:
+        return len(self.mm)
+
+    def close(self):
+        if not self.mm.closed:
+            super().close()
+            self.mm.close()
+        if not self.fp.closed:
+            self.fp.close()
+
+
+class MemoryStorage(Storage):
+    def __init__(self, image: Optional[bytes] = None):
+        super().__init__()
+        self.buffer = bytearray(image) if image is not None else bytearray()
+
+    @classmethod
+    def from_bytes(cls, image: bytes) -> "MemoryStorage":
+        return cls(image)
+
+    @classmethod
+    def load(cls, path: str) -> "MemoryStorage":
+        with open(path, "rb") as f:
+            return cls(f.read())
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.buffer)
+
+    def dump(self, path: str):
+        with open(path, "wb") as f:
+            f.write(self.buffer)
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        return bytes(self.buffer[offset:offset + size])
+
+    def _write_at(self, offset: int, data: bytes) -> int:
+        end = offset + len(data)
+        if end > len(self.buffer):
+            # Behave like a sparse file: the gap reads back as zeros
+            self.buffer.extend(bytes(end - len(self.buffer)))
+        self.buffer[offset:end] = data
+        return len(data)
+
+    def size(self) -> int:
+        return len(self.buffer)
+
+    def fork(self) -> "MemoryStorage":
+        return MemoryStorage(self.buffer)
+
+
+class GroupCommitStorage(Storage):
+    # Writes go straight through to the wrapped storage, so other processes see them
+    # under the usual image lock, but flush() only records the dirty pages. A background
+    # thread makes them durable in one sync per group. In durable mode a writing command
+    # waits (after releasing the image lock) until its group is synced, and whatever
+    # arrives during a sync forms the next group; fast-ack answers at once and only
+    # bounds the loss window.
+    def __init__(self, inner: Storage, durable: bool = True, interval_ms: int = GROUP_COMMIT_INTERVAL_MS,
+                 max_writes: int = GROUP_COMMIT_MAX_WRITES):
+        super().__init__()
+        self.inner = inner
+        self.durable = durable
+        self.interval = interval_ms / 1000
+        self.max_writes = max_writes
+        self.commit_state = threading.Condition()
+        self.dirty_pages = set()
+        self.pending_writes = 0
+        self.write_seq = 0
+        self.durable_seq = 0
+        self.waiters = 0
+        self.commits = 0
+        self.error = None
+        self.closing = False
+        self.flusher = threading.Thread(target=self.run_flusher, name="group-commit", daemon=True)
+        self.flusher.start()
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        return self.inner.read_at(offset, size)
+
+    def _write_at(self, offset: int, data: bytes) -> int:
+        written = self.inner.write_at(offset, data)
+        with self.commit_state:
+            if data:
+                last = (offset + len(data) - 1) // GROUP_COMMIT_PAGE_SIZE
+                self.dirty_pages.update(range(offset // GROUP_COMMIT_PAGE_SIZE, last + 1))
+            self.write_seq += 1
+            self.pending_writes += 1
+            if self.pending_writes == 1 or self.pending_writes >= self.max_writes:
+                self.commit_state.notify_all()
+        return written
+
+    def fileno(self) -> Optional[int]:
+        return self.inner.fileno()
+
+    def flush(self):
+        pass  # the flusher thread syncs
+
+    def sync(self, ranges: Optional[List[Tuple[int, int]]] = None):
+        self.wait_durable(self.commit_ticket())
+
+    def commit_ticket(self) -> int:
+        with self.commit_state:
+            return self.write_seq
+
+    def wait_durable(self, ticket: int) -> bool:
+        if not self.durable:
+            return True
+        with self.commit_state:
+            self.waiters += 1
+            self.commit_state.notify_all()
+            try:
+                self.commit_state.wait_for(lambda: self.durable_seq >= ticket or self.error is not None or self.closing)
+            finally:
+                self.waiters -= 1
+            return self.durable_seq >= ticket
+
+    def size(self) -> int:
+        return self.inner.size()
+
+    def page_ranges(self, pages) -> List[Tuple[int, int]]:
+        ranges = []
+        for page in sorted(pages):
+            start = page * GROUP_COMMIT_PAGE_SIZE
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], start + GROUP_COMMIT_PAGE_SIZE)
+            else:
+                ranges.append((start, start + GROUP_COMMIT_PAGE_SIZE))
+        return [(start, min(end, self.inner.size())) for start, end in ranges]
+
+    def run_flusher(self):
+        while True:
+            with self.commit_state:
+                self.commit_state.wait_for(lambda: self.pending_writes or self.closing)
+                # Nobody waiting: let the group fill up for at most one interval
+                self.commit_state.wait_for(lambda: self.waiters or self.pending_writes >= self.max_writes
+                                           or self.closing, self.interval)
+                seq, pages = self.write_seq, self.dirty_pages
+                self.dirty_pages, self.pending_writes = set(), 0
+                closing = self.closing
+            if seq != self.durable_seq:
+                try:
+                    self.inner.sync(self.page_ranges(pages))
+                except Exception as exc:
+                    with self.commit_state:
+                        self.error = exc
+                        self.commit_state.notify_all()
+                    print_infof("Group commit failed: %s\n", "red", exc)
+                    return
+                with self.commit_state:
+                    self.durable_seq = seq
+                    self.commits += 1
+                    self.commit_state.notify_all()
+            if closing:
+                return
+
+    def close(self):
+        with self.commit_state:
+            if self.closing:
+                return
+            self.closing = True
+            self.commit_state.notify_all()
+        # The flusher syncs what is still pending before it exits, unless a failed
+        # sync stopped it already; the images are closed either way
+        self.flusher.join()
+        super().close()
+        self.inner.close()
 
 # Helper Functions
 def print_colored_text(message: str, color: str, end: str = "\n"):
+    if is_quiet():
+        return
     colors = {
         'red': '\033[91m',
         'green': '\033[92m',
@@ -187,7 +870,28 @@ def print_colored_text(message: str, color: str, end: str = "\n"):
     }
     print(f"{colors.get(color, colors['blue'])}{message}{colors['reset']}", end=end)
 
+def is_quiet() -> bool:
+    return getattr(output_context, "quiet", False)
+
+@contextmanager
+def silenced():
+    # Quiets the output helpers for the calling thread only, so fuzz or replay runs
+    # never mute the sessions other threads are serving. Much cheaper than
+    # redirecting stdout, since nothing is formatted or written at all.
+    previous = is_quiet()
+    output_context.quiet = True
+    try:
+        yield
+    finally:
+        output_context.quiet = previous
+
+def print_message(*args, **kwargs):
+    if not is_quiet():
+        print(*args, **kwargs)
+
 def print_infof(fmt: str, color: str, *args):
+    if is_quiet():
+        return
     message = fmt % args
     print_colored_text(message, color, end="")
 
@@ -196,23 +900,93 @@ def strcasecmp(s1: str, s2: str) -> int:
     s2_lower = s2.lower()
     return (s1_lower > s2_lower) - (s1_lower < s2_lower)
 
-def is_record_ef(ef_type: np.uint8) -> bool:
+def is_record_ef(ef_type: int) -> bool:
     return ef_type in [EF_LINEAN_UNSHAREABLE, EF_LINEAR_SHAREABLE,
                       EF_CYCLIC_UNSHAREABLE, EF_CYCLIC_SHAREABLE]
 
-def is_valid_ef_type(type: np.uint8) -> bool:
+def is_valid_ef_type(type: int) -> bool:
     return type in [EF_TRANSPARENT_SHAREABLE, EF_TRANSPARENT_UNSHAREABLE] or is_record_ef(type)
 
-def is_valid_df(type: np.uint8) -> bool:
+def is_valid_df(type: int) -> bool:
     return type in [IS_DF, IS_ADF]
 
-def is_valid_file_type(type: np.uint8) -> bool:
+def is_valid_file_type(type: int) -> bool:
     return is_valid_df(type) or is_valid_ef_type(type)
 
+# Node Encoding
+def read_u8(fp, offset: int) -> int:
+    data = fp.read_at(offset, 1)
+    if len(data) != 1:
+        raise IOError(f"Short read at {offset:04X}")
+    return data[0]
+
+def read_u16(fp, offset: int) -> int:
+    data = fp.read_at(offset, 2)
+    if len(data) != 2:
+        raise IOError(f"Short read at {offset:04X}")
+    return int.from_bytes(data, "little")
+
+def write_changed(fp, offset: int, old: bytes, new: bytes) -> int:
+    # Rewrite only the span that differs, e.g. the one pointer of a node that changed
+    start = 0
+    while start < len(new) and start < len(old) and old[start] == new[start]:
+        start += 1
+    if start == len(new):
+        return 0
+    end = len(new)
+    if len(old) == len(new):
+        while old[end - 1] == new[end - 1]:
+            end -= 1
+    return fp.write_at(offset + start, new[start:end])
+
+def write_u16(fp, offset: int, value: int):
+    fp.write_at(offset, struct.pack("<H", value & 0xFFFF))
+
+def read_mf_node(fp, offset: int) -> Optional[MFNode]:
+    data = fp.read_at(offset, MF_NODE_SIZE)
+    if len(data) != MF_NODE_SIZE:
+        return None
+    return MFNode(*struct.unpack(MF_NODE_FORMAT, data))
+
+def read_df_node(fp, offset: int) -> Optional[DFADFNode]:
+    data = fp.read_at(offset, DF_NODE_SIZE)
+    if len(data) != DF_NODE_SIZE:
+        return None
+    return DFADFNode(*struct.unpack(DF_NODE_FORMAT, data))
+
+def read_ef_node(fp, offset: int) -> Optional[EFNode]:
+    data = fp.read_at(offset, EF_NODE_SIZE)
+    if len(data) != EF_NODE_SIZE:
+        return None
+    return EFNode(*struct.unpack(EF_NODE_FORMAT, data))
+
+def read_node_second(fp, offset: int) -> Optional[NodeSecond]:
+    data = fp.read_at(offset, NODE_SECOND_SIZE)
+    if len(data) != NODE_SECOND_SIZE:
+        return None
+    return NodeSecond(*struct.unpack(NODE_SECOND_FORMAT, data))
+
+def pack_mf_node(node: MFNode) -> bytes:
+    return struct.pack(MF_NODE_FORMAT, node.FID, node.ChildFID, node.ChildOffset,
+                       node.Status, node.Type, node.FCPOffset,
+                       node.FCP_total_size, node.NextOffset)
+
+def pack_df_node(node: DFADFNode) -> bytes:
+    return struct.pack(DF_NODE_FORMAT, node.FID, node.ParentFID, node.ParentOffset,
+                       node.Type, node.ChildFID, node.ChildOffset,
+                       node.FCPOffset, node.FCP_total_size, node.NextOffset)
+
+def pack_ef_node(node: EFNode) -> bytes:
+    return struct.pack(EF_NODE_FORMAT, node.FID, node.ParentOffset, node.ParentFID,
+                       node.Type, node.FCPOffset, node.FCP_total_size, node.DataOffset)
+
+def pack_node_second(node: NodeSecond) -> bytes:
+    return struct.pack(NODE_SECOND_FORMAT, node.ParentOffset, node.ChildFID,
+                       node.ChildOffset, node.NextOffset)
+
 def get_root_offset(fp) -> Result:
-    fp.seek(ROOT_OFFSET_PTR)
     try:
-        value = np.frombuffer(fp.read(2), dtype=np.uint16)[0]
+        value = read_u16(fp, ROOT_OFFSET_PTR)
         return Result(value=value, sw=SW_SUCCESS)
     except:
         print_colored_text("Failed to read root offset", "red")
@@ -226,178 +1000,165 @@ def check_required_tags(tags: List[TagCheck]) -> bool:
             all_present = False
     return all_present
 
-def extract_file_size(fcp_data: np.ndarray, fcp_len: np.uint16) -> np.uint16:
+def extract_file_size(fcp_data: bytes, fcp_len: int) -> int:
+    fcp_len = min(fcp_len, len(fcp_data))
     pos = 2
-    while pos < fcp_len:
-        if fcp_data[pos] == 0x80 and fcp_data[pos + 1] == 2:
-            return np.uint16((fcp_data[pos + 2] << 8) | fcp_data[pos + 3])
-        pos += 2 + fcp_data[pos + 1]
-    return np.uint16(0)
-
-def extract_fcp_info(fp, ef_node: EFNode, record_len: np.ndarray, file_size: np.ndarray) -> bool:
-    fcp_data = np.zeros(ef_node.FCP_total_size, dtype=np.uint8)
-    fp.seek(ef_node.FCPOffset)
+    while pos + 2 <= fcp_len:
+        length = fcp_data[pos + 1]
+        if pos + 2 + length > fcp_len:
+            break
+        if fcp_data[pos] == 0x80 and length == 2:
+            return (fcp_data[pos + 2] << 8) | fcp_data[pos + 3]
+        pos += 2 + length
+    return 0
+
+def extract_fcp_info(fp, ef_node: EFNode, record_len: List[int], file_size: List[int]) -> bool:
     try:
-        fcp_data[:] = np.frombuffer(fp.read(ef_node.FCP_total_size), dtype=np.uint8)
+        fcp_data = fp.read_at(ef_node.FCPOffset, ef_node.FCP_total_size)
         pos = 2
-        while pos < ef_node.FCP_total_size:
+        while pos + 2 <= len(fcp_data):
             tag = fcp_data[pos]
-            len = fcp_data[pos + 1]
-            if tag == 0x82 and len >= 4:
-                record_len[0] = np.uint16((fcp_data[pos + 4] << 8) | fcp_data[pos + 5])
-            elif tag == 0x80 and len >= 2:
-                file_size[0] = np.uint16((fcp_data[pos + 2] << 8) | fcp_data[pos + 3])
-            pos += 2 + len
+            length = fcp_data[pos + 1]
+            if pos + 2 + length > len(fcp_data):
+                return False
+            if tag == 0x82 and length >= 4:
+                record_len[0] = (fcp_data[pos + 4] << 8) | fcp_data[pos + 5]
+            elif tag == 0x80 and length >= 2:
+                file_size[0] = (fcp_data[pos + 2] << 8) | fcp_data[pos + 3]
+            pos += 2 + length
         return True
     except:
         return False
 
-def get_parent_info(fp, root_offset: np.uint16) -> FileInfo:
+def get_parent_info(fp, root_offset: int) -> FileInfo:
+    sel = current_selection()
     parent = FileInfo(fid=MF_FID, offset=root_offset, type=IS_MF)
-    if CurrentFID == MF_FID:
+    if sel.CurrentFID == MF_FID:
         return parent
-    
-    parent.fid = CurrentFID
-    parent.offset = CurrentOffset
+
+    parent.fid = sel.CurrentFID
+    parent.offset = sel.CurrentOffset
     parent.type = IS_DF
     try:
-        fp.seek(parent.offset + 4)  # Offset to FCPOffset in DF_ADF_node
-        fcp_offset = np.frombuffer(fp.read(2), dtype=np.uint16)[0]
-        fp.seek(parent.offset + 6)  # Offset to FCP_total_size
-        fcp_size = np.frombuffer(fp.read(1), dtype=np.uint8)[0]
-        
-        if fcp_size > 0 and fcp_size <= MAX_TLV_LEN:
-            fcp_data = np.zeros(fcp_size, dtype=np.uint8)
-            fp.seek(fcp_offset)
-            fcp_data[:] = np.frombuffer(fp.read(fcp_size), dtype=np.uint8)
-            pos = 2
-            while pos < fcp_size:
-                if fcp_data[pos] == 0x84:
-                    parent.type = IS_ADF
-                    break
-                if pos + 1 >= fcp_size:
-                    break
-                len = fcp_data[pos + 1]
-                if pos + 2 + len > fcp_size:
-                    break
-                pos += 2 + len
+        node = read_df_node(fp, parent.offset)
+        if node is not None and is_valid_df(node.Type):
+            parent.type = node.Type
     except:
         pass
     return parent
 
-def validate_parent_type(parent_type: np.uint8) -> np.uint16:
+def validate_parent_type(parent_type: int) -> int:
     if parent_type not in [IS_MF, IS_DF, IS_ADF]:
-        print(f"Cannot create child under EF node (parent type: {parent_type:02X})")
+        print_message(f"Cannot create child under EF node (parent type: {parent_type:02X})")
         return SW_INCORRECT_P1P2
     return SW_SUCCESS
 
-def write_fcp_data(fp, fcp_offset: np.uint16, apdu: APDU) -> np.uint16:
+def write_fcp_data(fp, fcp_offset: int, apdu: APDU) -> int:
     fp.seek(fcp_offset)
     try:
-        fp.write(apdu.data[:apdu.lc].tobytes())
+        fp.write(bytes(apdu.data[:apdu.lc]))
         fp.flush()
         return SW_SUCCESS
     except:
-        print("Failed to write FCP data")
+        print_message("Failed to write FCP data")
         return SW_MEMORY_FAILURE
 
-def get_node_size(type: np.uint8) -> int:
-    return struct.calcsize("<HHHHBHBH") if is_valid_ef_type(type) else struct.calcsize("<HHHHBHHBH")
+def get_node_size(type: int) -> int:
+    return EF_NODE_SIZE if is_valid_ef_type(type) else DF_NODE_SIZE
 
-def read_and_validate_node(fp, offset: np.uint16, target_fid: np.uint16, expected_type: np.uint8, node_type_name: str) -> Tuple[np.uint16, Optional[object]]:
+def read_and_validate_node(fp, offset: int, target_fid: int, expected_type: int, node_type_name: str) -> Tuple[int, Optional[object]]:
     if offset == C_NULL:
-        print(f"Invalid offset for {node_type_name}")
+        print_message(f"Invalid offset for {node_type_name}")
         return SW_FILE_NOT_FOUND, None
-    
+
     try:
-        fp.seek(offset)
         if expected_type == IS_MF:
-            node_data = np.frombuffer(fp.read(struct.calcsize("<HHHHBHBH")), dtype=np.uint8)
-            node = MFNode(
-                FID=np.uint16((node_data[0] << 8) | node_data[1]),
-                ChildFID=np.uint16((node_data[2] << 8) | node_data[3]),
-                ChildOffset=np.uint16((node_data[4] << 8) | node_data[5]),
-                Status=node_data[6],
-                Type=node_data[7],
-                FCPOffset=np.uint16((node_data[8] << 8) | node_data[9]),
-                FCP_total_size=node_data[10],
-                NextOffset=np.uint16((node_data[11] << 8) | node_data[12])
-            )
+            node = read_mf_node(fp, offset)
         elif expected_type in [IS_DF, IS_ADF]:
-            node_data = np.frombuffer(fp.read(struct.calcsize("<HHHHBHHBH")), dtype=np.uint8)
-            node = DFADFNode(
-                FID=np.uint16((node_data[0] << 8) | node_data[1]),
-                ParentFID=np.uint16((node_data[2] << 8) | node_data[3]),
-                ParentOffset=np.uint16((node_data[4] << 8) | node_data[5]),
-                Type=node_data[6],
-                ChildFID=np.uint16((node_data[7] << 8) | node_data[8]),
-                ChildOffset=np.uint16((node_data[9] << 8) | node_data[10]),
-                FCPOffset=np.uint16((node_data[11] << 8) | node_data[12]),
-                FCP_total_size=node_data[13],
-                NextOffset=np.uint16((node_data[14] << 8) | node_data[15])
-            )
+            node = read_df_node(fp, offset)
         else:
-            node_data = np.frombuffer(fp.read(struct.calcsize("<HHHBHBH")), dtype=np.uint8)
-            node = EFNode(
-                FID=np.uint16((node_data[0] << 8) | node_data[1]),
-                ParentOffset=np.uint16((node_data[2] << 8) | node_data[3]),
-                ParentFID=np.uint16((node_data[4] << 8) | node_data[5]),
-                Type=node_data[6],
-                FCPOffset=np.uint16((node_data[7] << 8) | node_data[8]),
-                FCP_total_size=node_data[9],
-                DataOffset=np.uint16((node_data[10] << 8) | node_data[11])
-            )
-        
+            node = read_ef_node(fp, offset)
+        if node is None:
+            raise IOError(f"Short read at {offset:04X}")
+
         node_fid = node.FID
         node_type = node.Type
 
         if node_fid != target_fid or (expected_type != IS_MF and node_type != expected_type):
-            print(f"Invalid {node_type_name} node at {offset:04X} (FID: {node_fid:04X}, Type: {node_type:02X})")
+            print_message(f"Invalid {node_type_name} node at {offset:04X} (FID: {node_fid:04X}, Type: {node_type:02X})")
             return SW_FILE_INVALID, None
-        
+
         return SW_SUCCESS, node
     except:
-        print(f"Failed to read {node_type_name} node at {offset:04X}")
+        print_message(f"Failed to read {node_type_name} node at {offset:04X}")
         return SW_MEMORY_FAILURE, None
 
-def save_cursors(fp, write_offset: np.uint16, read_offset: np.uint16):
-    fp.seek(WRITE_CURSOR_END)
-    fp.write(np.array([write_offset], dtype=np.uint16).tobytes())
-    fp.seek(READ_CURSOR_END)
-    fp.write(np.array([read_offset], dtype=np.uint16).tobytes())
+def save_cursors(fp, write_offset: int, read_offset: int):
+    write_u16(fp, WRITE_CURSOR_END, write_offset)
+    write_u16(fp, READ_CURSOR_END, read_offset)
     fp.flush()
 
 def init_cursors(fp):
     try:
-        fp.seek(WRITE_CURSOR_END)
-        write_offset = np.frombuffer(fp.read(2), dtype=np.uint16)[0]
-        fp.seek(READ_CURSOR_END)
-        read_offset = np.frombuffer(fp.read(2), dtype=np.uint16)[0]
-        
+        write_offset = read_u16(fp, WRITE_CURSOR_END)
+        read_offset = read_u16(fp, READ_CURSOR_END)
+
         if write_offset >= FILE_SIZE or write_offset == C_NULL:
-            save_cursors(fp, np.uint16(0), np.uint16(0))
+            save_cursors(fp, 0, 0)
     except:
-        print("Failed to read cursors")
-        save_cursors(fp, np.uint16(0), np.uint16(0))
+        print_message("Failed to read cursors")
+        save_cursors(fp, 0, 0)
 
 def load_cursors(fp) -> FileCursors:
-    fp.seek(WRITE_CURSOR_END)
-    write_offset = np.frombuffer(fp.read(2), dtype=np.uint16)[0]
-    fp.seek(READ_CURSOR_END)
-    read_offset = np.frombuffer(fp.read(2), dtype=np.uint16)[0]
+    write_offset = read_u16(fp, WRITE_CURSOR_END)
+    read_offset = read_u16(fp, READ_CURSOR_END)
     return FileCursors(write_offset=write_offset, read_offset=read_offset)
 
-def calculate_available_memory(fp) -> np.uint16:
+def get_generation(fp) -> int:
+    try:
+        return read_u16(fp, GENERATION_PTR)
+    except OSError:
+        return C_NULL  # image not initialised yet
+
+def sync_generation(fp):
+    # Another process may have written the image since our caches were filled
+    generation = get_generation(fp)
+    if generation != fp.cache_generation:
+        fp.cache.clear()
+        fp.indexes.clear()
+        drop_access_rules(fp)
+        fp.cache_generation = generation
+
+def bump_generation(fp):
+    generation = (get_generation(fp) + 1) & 0xFFFF
+    write_u16(fp, GENERATION_PTR, generation)
+    fp.flush()
+    fp.cache_generation = generation
+
+@contextmanager
+def image_lock(fp, exclusive: bool = False):
+    fp.lock(exclusive)
+    try:
+        if fp.lock_depth == 1:
+            sync_generation(fp)
+            if exclusive:
+                fp.modified = False
+        yield fp
+    finally:
+        try:
+            if exclusive and fp.lock_depth == 1 and fp.modified:
+                bump_generation(fp)
+        finally:
+            fp.unlock()
+
+def calculate_available_memory(fp) -> int:
     cursors = load_cursors(fp)
-    if cursors.write_offset > WRITE_CURSOR_END:
-        return np.uint16(0)
-    return np.uint16(WRITE_CURSOR_END - cursors.write_offset)
+    if cursors.write_offset > DATA_AREA_END:
+        return 0
+    return (DATA_AREA_END - cursors.write_offset) & 0xFFFF
 
-def print_fcp(apdu: APDU, fp, offset: np.uint16, file_type: np.uint8) -> np.uint16:
-    fcp_data = np.zeros(MAX_TLV_LEN, dtype=np.uint8)
-    
+def print_fcp(apdu: APDU, fp, offset: int, file_type: int) -> int:
     # Read the correct node and extract FCP offset/size
-    fp.seek(offset)
     if file_type == IS_MF:
         sw, node = read_and_validate_node(fp, offset, apdu.FID, IS_MF, "MF")
         if sw != SW_SUCCESS:
@@ -417,30 +1178,31 @@ def print_fcp(apdu: APDU, fp, offset: np.uint16, file_type: np.uint8) -> np.uint
         fcp_offset = node.FCPOffset
         fcp_size = node.FCP_total_size
     else:
-        print(f"Invalid file type {file_type:02X} for FCP read")
+        print_message(f"Invalid file type {file_type:02X} for FCP read")
         return SW_INCORRECT_P1P2
 
     # Read FCP data
     try:
-        fp.seek(fcp_offset)
-        fcp_data[:fcp_size] = np.frombuffer(fp.read(fcp_size), dtype=np.uint8)
+        fcp_data = fp.read_at(fcp_offset, fcp_size)
+        if len(fcp_data) != fcp_size:
+            raise IOError(f"Short read at {fcp_offset:04X}")
     except:
-        print(f"Failed to read FCP data at offset {fcp_offset:04X}")
+        print_message(f"Failed to read FCP data at offset {fcp_offset:04X}")
         return SW_TECHNICAL_PROBLEM
 
     print_colored_text("Response: ", "blue", end="")
-    
+
     if file_type == IS_MF:
         print_infof("62 %02X ", "green", fcp_size + 2)  # +2 for outer TLV
         i = 2
         has_a5_or_85 = False
         avail = calculate_available_memory(fp)
-        
+
         while i < fcp_size:
             tag = fcp_data[i]
             len_ = fcp_data[i + 1]
             tlv_len = 2 + len_
-            
+
             if tag in [0xA5, 0x85]:
                 has_a5_or_85 = True
                 print_infof("%02X 04 83 02 %02X %02X ", "green", tag, avail >> 8, avail & 0xFF)
@@ -449,25 +1211,25 @@ def print_fcp(apdu: APDU, fp, offset: np.uint16, file_type: np.uint8) -> np.uint
                 for j in range(len_):
                     print_infof("%02X ", "green", fcp_data[i + 2 + j])
             i += tlv_len
-        
+
         if not has_a5_or_85:
             print_infof("A5 04 83 02 %02X %02X ", "green", avail >> 8, avail & 0xFF)
-    
+
     elif is_record_ef(file_type):
         print_infof("62 %02X ", "green", fcp_size - 1)  # +1 for extra byte in 82
         i = 2
-        
+
         while i < fcp_size:
             tag = fcp_data[i]
             len_ = fcp_data[i + 1]
             tlv_len = 2 + len_
-            
+
             if tag == 0x82 and len_ == 4:
                 print_infof("82 05 ", "green")
                 for j in range(4):
                     print_infof("%02X ", "green", fcp_data[i + 2 + j])
                 rec_size = (fcp_data[i + 4] << 8) | fcp_data[i + 5]
-                
+
                 file_size = 0
                 temp = 2
                 while temp < fcp_size:
@@ -475,15 +1237,15 @@ def print_fcp(apdu: APDU, fp, offset: np.uint16, file_type: np.uint8) -> np.uint
                         file_size = (fcp_data[temp + 2] << 8) | fcp_data[temp + 3]
                         break
                     temp += 2 + fcp_data[temp + 1]
-                
-                record_count = np.uint8(0 if rec_size == 0 else file_size // rec_size)
+
+                record_count = (0 if rec_size == 0 else file_size // rec_size) & 0xFF
                 print_infof("%02X ", "green", record_count)
             else:
                 print_infof("%02X %02X ", "green", tag, len_)
                 for j in range(len_):
                     print_infof("%02X ", "green", fcp_data[i + 2 + j])
             i += tlv_len
-    
+
     elif file_type in [IS_DF, IS_ADF]:
         for i in range(fcp_size):
             print_infof("%02X ", "green", fcp_data[i])
@@ -491,127 +1253,100 @@ def print_fcp(apdu: APDU, fp, offset: np.uint16, file_type: np.uint8) -> np.uint
         print_infof("62 %02X ", "green", fcp_size)
         for i in range(fcp_size):
             print_infof("%02X ", "green", fcp_data[i])
-    
-    print()
+
+    print_message()
     return SW_SUCCESS
 
 def clear_screen():
     os.system('cls' if platform.system() == 'Windows' else 'clear')
 
-def update_write_cursor(fp, new_offset: np.uint16):
-    fp.seek(WRITE_CURSOR_END)
-    fp.write(np.array([new_offset], dtype=np.uint16).tobytes())
+def update_write_cursor(fp, new_offset: int):
+    write_u16(fp, WRITE_CURSOR_END, new_offset)
     fp.flush()
 
-def get_next_write_position(fp, required_size: np.uint16) -> np.uint16:
+def get_next_write_position(fp, required_size: int) -> int:
     cursors = load_cursors(fp)
     current_write_pos = cursors.write_offset
     new_write_pos = current_write_pos + required_size
-    
-    if new_write_pos > WRITE_CURSOR_END:
-        print("Not enough memory available for write operation.")
+
+    if new_write_pos > DATA_AREA_END:
+        print_message("Not enough memory available for write operation.")
         return SW_NOT_ENOUGH_MEMORY
-    
+
     update_write_cursor(fp, new_write_pos)
     return current_write_pos
 
 def create_empty_file(fp):
-    buffer = np.full(FILE_SIZE, 0xFF, dtype=np.uint8)
-    fp.seek(0)
-    fp.write(buffer.tobytes())
+    fp.write_at(0, b'\xff' * FILE_SIZE)
     fp.flush()
 
-def update_current_selection(fp, fid_selected: np.uint16, offset_selected: np.uint16, 
-                           type_selected: np.uint8, parent_fid_of_sel: np.uint16, 
-                           parent_off_of_sel: np.uint16, type_of_parent_dir: np.uint8):
-    global CurrentFID, CurrentOffset, CurrentFileType, ParentFID, ParentOffset
-    global CurrentEF_FID, CurrentEF_Offset, CurrentEF_Type, record_pointer
-    
+def update_current_selection(fp, fid_selected: int, offset_selected: int,
+                           type_selected: int, parent_fid_of_sel: int,
+                           parent_off_of_sel: int, type_of_parent_dir: int):
+    sel = current_selection()
+
     if offset_selected >= FILE_SIZE:
-        print(f"Invalid offset selected {offset_selected:04X}")
+        print_message(f"Invalid offset selected {offset_selected:04X}")
         return
-    
+
     if is_valid_ef_type(type_selected):
-        CurrentEF_FID = fid_selected
-        CurrentEF_Offset = offset_selected
-        CurrentEF_Type = type_selected
-        
+        sel.CurrentEF_FID = fid_selected
+        sel.CurrentEF_Offset = offset_selected
+        sel.CurrentEF_Type = type_selected
+
         if parent_fid_of_sel != C_NULL and parent_off_of_sel != C_NULL:
-            CurrentFID = parent_fid_of_sel
-            CurrentOffset = parent_off_of_sel
+            sel.CurrentFID = parent_fid_of_sel
+            sel.CurrentOffset = parent_off_of_sel
             if parent_fid_of_sel == MF_FID:
-                CurrentFileType = IS_MF
+                sel.CurrentFileType = IS_MF
             else:
                 try:
-                    fp.seek(parent_off_of_sel + 6)  # Offset to type in DF_ADF_node
-                    parent_type = np.frombuffer(fp.read(1), dtype=np.uint8)[0]
-                    CurrentFileType = parent_type
+                    sel.CurrentFileType = read_u8(fp, parent_off_of_sel + 6)  # Offset to type in DF_ADF_node
                 except:
-                    CurrentFileType = IS_DF
+                    sel.CurrentFileType = IS_DF
         else:
-            print(f"Invalid parent info for EF selection (FID: {parent_fid_of_sel:04X}, Offset: {parent_off_of_sel:04X})")
-            CurrentFID = C_NULL
-            CurrentOffset = C_NULL
-            CurrentFileType = np.uint8(0xFF)
+            print_message(f"Invalid parent info for EF selection (FID: {parent_fid_of_sel:04X}, Offset: {parent_off_of_sel:04X})")
+            sel.CurrentFID = C_NULL
+            sel.CurrentOffset = C_NULL
+            sel.CurrentFileType = 0xFF
     else:
-        CurrentEF_FID = C_NULL
-        CurrentEF_Offset = C_NULL
-        CurrentEF_Type = np.uint8(0xFF)
-        CurrentFID = fid_selected
-        CurrentOffset = offset_selected
-        CurrentFileType = type_selected
-    
+        sel.CurrentEF_FID = C_NULL
+        sel.CurrentEF_Offset = C_NULL
+        sel.CurrentEF_Type = 0xFF
+        sel.CurrentFID = fid_selected
+        sel.CurrentOffset = offset_selected
+        sel.CurrentFileType = type_selected
+
     if type_selected == IS_MF:
-        ParentFID = C_NULL
-        ParentOffset = C_NULL
+        sel.ParentFID = C_NULL
+        sel.ParentOffset = C_NULL
     elif offset_selected != C_NULL:
         try:
             if type_selected in [IS_DF, IS_ADF]:
-                fp.seek(offset_selected)
-                node_data = np.frombuffer(fp.read(struct.calcsize("<HHHHBHHBH")), dtype=np.uint8)
-                node = DFADFNode(
-                    FID=np.uint16((node_data[0] << 8) | node_data[1]),
-                    ParentFID=np.uint16((node_data[2] << 8) | node_data[3]),
-                    ParentOffset=np.uint16((node_data[4] << 8) | node_data[5]),
-                    Type=node_data[6],
-                    ChildFID=np.uint16((node_data[7] << 8) | node_data[8]),
-                    ChildOffset=np.uint16((node_data[9] << 8) | node_data[10]),
-                    FCPOffset=np.uint16((node_data[11] << 8) | node_data[12]),
-                    FCP_total_size=node_data[13],
-                    NextOffset=np.uint16((node_data[14] << 8) | node_data[15])
-                )
-                ParentFID = node.ParentFID
-                ParentOffset = node.ParentOffset
+                node = read_df_node(fp, offset_selected)
+                sel.ParentFID = node.ParentFID
+                sel.ParentOffset = node.ParentOffset
             elif is_valid_ef_type(type_selected):
-                fp.seek(offset_selected)
-                node_data = np.frombuffer(fp.read(struct.calcsize("<HHHBHBH")), dtype=np.uint8)
-                node = EFNode(
-                    FID=np.uint16((node_data[0] << 8) | node_data[1]),
-                    ParentOffset=np.uint16((node_data[2] << 8) | node_data[3]),
-                    ParentFID=np.uint16((node_data[4] << 8) | node_data[5]),
-                    Type=node_data[6],
-                    FCPOffset=np.uint16((node_data[7] << 8) | node_data[8]),
-                    FCP_total_size=node_data[9],
-                    DataOffset=np.uint16((node_data[10] << 8) | node_data[11])
-                )
-                ParentFID = node.ParentFID
-                ParentOffset = node.ParentOffset
+                node = read_ef_node(fp, offset_selected)
+                sel.ParentFID = node.ParentFID
+                sel.ParentOffset = node.ParentOffset
         except:
-            print(f"Failed to read node at {offset_selected:04X}")
-            ParentFID = C_NULL
-            ParentOffset = C_NULL
-    
-    record_pointer = np.uint8(0xFF)
+            print_message(f"Failed to read node at {offset_selected:04X}")
+            sel.ParentFID = C_NULL
+            sel.ParentOffset = C_NULL
+
+    sel.record_pointer = 0xFF
 
-def get_directory_type_string(type: np.uint8) -> str:
+def get_directory_type_string(type: int) -> str:
+    sel = current_selection()
     return {
         IS_MF: "MF",
         IS_DF: "DF",
         IS_ADF: "ADF",
-        0xFF: "None" if CurrentFID == C_NULL else "Unknown"
+        0xFF: "None" if sel.CurrentFID == C_NULL else "Unknown"
     }.get(type, "Unknown")
 
-def get_ef_type_string(type: np.uint8) -> str:
+def get_ef_type_string(type: int) -> str:
     return {
         EF_TRANSPARENT_SHAREABLE: "EF-Transparent",
         EF_LINEAR_SHAREABLE: "EF-Linear",
@@ -621,7 +1356,7 @@ def get_ef_type_string(type: np.uint8) -> str:
         EF_CYCLIC_UNSHAREABLE: "EF-Cyclic UnShareable"
     }.get(type, "Unknown EF")
 
-def get_tag_name(tag: np.uint8) -> str:
+def get_tag_name(tag: int) -> str:
     return {
         0x82: "File Descriptor",
         0x83: "File Identifier",
@@ -644,15 +1379,15 @@ def print_apdu(apdu: APDU):
     print_infof("  P2  : %02X\n", "yellow", apdu.p2)
     print_infof("  Lc  : %02X (%d bytes)\n", "yellow", apdu.lc, apdu.lc)
     print_infof("  Le  : %02X \n", "yellow", apdu.le)
-    
+
     if apdu.lc > 0:
         print_colored_text("  Data: ", "yellow", end="")
         for i in range(apdu.lc):
             print_infof("%02X ", "green", apdu.data[i])
-        print()
+        print_message()
     else:
         print_colored_text("  Data: None\n", "red")
-    
+
     print_infof("  Type: %02X\n", "yellow", apdu.type)
     print_infof("  FID : %04X\n", "yellow", apdu.FID)
     print_infof("  SFI : %02X\n", "yellow", apdu.sfi)
@@ -661,7 +1396,7 @@ def print_apdu(apdu: APDU):
     print_infof("  RECORD NUMBER : %04X\n", "yellow", apdu.NumberOfRecords)
     print_colored_text("==================================\n", "cyan")
 
-def getFileTypeName(fileType: np.uint8) -> str:
+def getFileTypeName(fileType: int) -> str:
     return {
         IS_MF: "MF",
         IS_DF: "DF",
@@ -674,40 +1409,77 @@ def getFileTypeName(fileType: np.uint8) -> str:
         EF_CYCLIC_SHAREABLE: "EF Cyclic"
     }.get(fileType, "Unknown")
 
-def initialize_smartcard_file():
-    try:
-        fp = open(FILE_NAME, "rb+")
-    except FileNotFoundError:
-        fp = open(FILE_NAME, "wb+")
+def get_ins_name(ins: int) -> str:
+    return {
+        INS_SELECT_FILE: "SELECT FILE",
+        INS_CREATE_FILE: "CREATE FILE",
+        INS_READ_BINARY: "READ BINARY",
+        INS_UPDATE_BINARY: "UPDATE BINARY",
+        INS_READ_RECORD: "READ RECORD",
+        INS_UPDATE_RECORD: "UPDATE RECORD",
+        INS_SEARCH_RECORD: "SEARCH RECORD",
+        INS_GET_RESPONSE: "GET RESPONSE",
+        INS_MANAGE_CHANNEL: "MANAGE CHANNEL",
+        INS_VERIFY: "VERIFY",
+        WEAR_NO_INS: "(no APDU)"
+    }.get(ins, f"INS {ins:02X}")
+
+def open_storage(backend: str = STORAGE_BACKEND, path: str = FILE_NAME, index_path: Optional[str] = None) -> Storage:
+    if backend == "memory":
+        fp = MemoryStorage.load(path) if os.path.exists(path) else MemoryStorage()
+    elif backend == "mmap":
+        fp = MmapStorage(path)
+    elif backend == "file":
+        fp = FileStorage(path)
+    else:
+        raise ValueError(f"Unknown storage backend '{backend}'")
+    fp.index_path = index_path
+    return fp
+
+def initialize_smartcard_file(backend: str = STORAGE_BACKEND, path: str = FILE_NAME, image: Optional[bytes] = None,
+                              index_path: Optional[str] = None) -> Storage:
+    if image is not None:
+        if backend != "memory":
+            raise ValueError("An in-RAM image can only be loaded into the memory backend")
+        fp = MemoryStorage.from_bytes(image)
+    elif backend == "memory":
+        fp = MemoryStorage()
         create_empty_file(fp)
-        init_cursors(fp)
     else:
-        init_cursors(fp)
+        with FileStorage(path, create=True) as blank, image_lock(blank, exclusive=True):
+            if blank.size() == 0:
+                create_empty_file(blank)
+        fp = open_storage(backend, path)
+    fp.index_path = index_path
+    try:
+        with image_lock(fp, exclusive=True):
+            check_image_trailer(fp)
+            init_cursors(fp)
+    except BaseException:
+        fp.close()
+        raise
     return fp
 
+def check_image_trailer(fp):
+    # The generation and format version words were EF data space in v1 images: if
+    # data already reaches into them, the first write would overwrite it
+    if get_image_version(fp) == IMAGE_FORMAT_V2:
+        return
+    write_offset = read_u16(fp, WRITE_CURSOR_END)
+    if write_offset != C_NULL and DATA_AREA_END < write_offset < FILE_SIZE:
+        raise IOError(f"v1 image data reaches {write_offset:04X}, past the trailer at {DATA_AREA_END:04X}; "
+                      "it cannot be opened for writing")
+
 def handle_power_up_selection(fp):
-    global CurrentFID, CurrentOffset, CurrentFileType
-    fp.seek(ROOT_OFFSET_PTR)
-    root_offset = np.frombuffer(fp.read(2), dtype=np.uint16)[0]
-    
+    root_offset = read_u16(fp, ROOT_OFFSET_PTR)
+
     if root_offset != 0xFFFF:
-        fp.seek(root_offset)
-        node_data = np.frombuffer(fp.read(struct.calcsize("<HHHHBHBH")), dtype=np.uint8)
-        node = MFNode(
-            FID=np.uint16((node_data[0] << 8) | node_data[1]),
-            ChildFID=np.uint16((node_data[2] << 8) | node_data[3]),
-            ChildOffset=np.uint16((node_data[4] << 8) | node_data[5]),
-            Status=node_data[6],
-            Type=node_data[7],
-            FCPOffset=np.uint16((node_data[8] << 8) | node_data[9]),
-            FCP_total_size=node_data[10],
-            NextOffset=np.uint16((node_data[11] << 8) | node_data[12])
-        )
-        if node.FID == MF_FID:
-            update_current_selection(fp, MF_FID, root_offset, IS_MF, C_NULL, C_NULL, np.uint8(0xFF))
+        node = read_mf_node(fp, root_offset)
+        if node is not None and node.FID == MF_FID:
+            update_current_selection(fp, MF_FID, root_offset, IS_MF, C_NULL, C_NULL, 0xFF)
             print_colored_text("Power-up: MF automatically selected.\n", "blue")
 
-def get_status_description(status_word: np.uint16) -> str:
+def get_status_description(status_word: int) -> str:
     status_dict = {
         SW_SUCCESS: "Success",
         SW_WRONG_LENGTH: "Wrong length",
@@ -726,44 +1498,51 @@ def get_status_description(status_word: np.uint16) -> str:
         SW_FILE_ALREADY_EXIST: "File Already Exists",
         WRONG_PARAMETER: "Wrong parameters (P1 or P2)",
         SW_COMMAND_IMCOMPATIBLE: "Command incompatible with file structure",
+        SW_CONDITIONS_NOT_SATISFIED: "Conditions of use not satisfied",
+        SW_END_OF_FILE_REACHED: "End of file reached before reading Ne bytes",
+        SW_LOGICAL_CHANNEL_NOT_SUPPORTED: "Logical channel not supported or not open",
+        SW_LAST_COMMAND_EXPECTED: "Last command of the chain expected",
+        SW_SECURITY_STATUS_NOT_SATISFIED: "Security status not satisfied",
+        SW_REFERENCED_DATA_NOT_FOUND: "Referenced data not found",
         ZERO: "Invalid Input Command (custom)"
     }
     if status_word & 0xFF00 == 0x6C00:
         return "bad length"
+    if status_word & 0xFF00 == SW_RESPONSE_BYTES_AVAILABLE:
+        return f"{status_word & 0xFF or 256} response bytes still available"
+    if status_word & 0xFFF0 == SW_VERIFY_FAILED:
+        return f"Verification failed, {status_word & 0x0F} tries left"
     return status_dict.get(status_word, f"Unknown status: {status_word:04X}")
 
 def print_current_selection_state():
+    sel = current_selection()
     print_colored_text("\n========== Current Selection State ==========\n", "cyan")
-    dir_type = get_directory_type_string(CurrentFileType)
-    print_infof("Current Directory: %s (FID: %04X)\n", "yellow", dir_type, CurrentFID)
-    
-    if CurrentEF_FID != C_NULL:
-        ef_type = get_ef_type_string(CurrentEF_Type)
-        print_infof("Current EF       : FID %04X (%s)\n", "yellow", CurrentEF_FID, ef_type)
+    dir_type = get_directory_type_string(sel.CurrentFileType)
+    print_infof("Current Directory: %s (FID: %04X)\n", "yellow", dir_type, sel.CurrentFID)
+
+    if sel.CurrentEF_FID != C_NULL:
+        ef_type = get_ef_type_string(sel.CurrentEF_Type)
+        print_infof("Current EF       : FID %04X (%s)\n", "yellow", sel.CurrentEF_FID, ef_type)
     else:
         print_colored_text("Current EF       : None Selected\n", "red")
-    
+
     print_colored_text("=============================================\n", "cyan")
 
 def reset_global_state():
-    global CurrentFID, CurrentOffset, CurrentFileType, ParentFID, ParentOffset
-    global CurrentEF_FID, CurrentEF_Offset, CurrentEF_Type, gFID, record_pointer
-    CurrentFID = C_NULL
-    CurrentOffset = C_NULL
-    CurrentFileType = np.uint8(0xFF)
-    ParentFID = C_NULL
-    ParentOffset = C_NULL
-    CurrentEF_FID = C_NULL
-    CurrentEF_Offset = C_NULL
-    CurrentEF_Type = np.uint8(0xFF)
+    global gFID
+    session = current_session()
+    with session.lock:
+        session.channels[0] = SelectionState()
+        for channel in range(1, MAX_LOGICAL_CHANNELS):
+            session.channels[channel] = None
+        session.verified_pins = 0
     gFID = C_NULL
-    record_pointer = np.uint8(0xFF)
 
 def handle_special_commands(input_str: str, fp, apdu: APDU) -> bool:
     input_str = input_str.lower()
     if input_str == "memory":
         avail = calculate_available_memory(fp)
-        print_colored_text(f"Available Memory: {avail} bytes (4 Bytes for Cursor Pointer)\n", "green")
+        print_colored_text(f"Available Memory: {avail} bytes ({FILE_SIZE - DATA_AREA_END} Bytes for Cursors, Format Version and Generation)\n", "green")
         return True
     elif input_str == "apdu":
         print_apdu(apdu)
@@ -776,30 +1555,35 @@ def handle_special_commands(input_str: str, fp, apdu: APDU) -> bool:
         clear_screen()
         reset_global_state()
         handle_power_up_selection(fp)
+        if active_trace is not None:
+            active_trace.record_reset()
         print_current_selection_state()
         print_colored_text("Smartcard state reset to power-up condition\n", "green")
         return True
     return False
 
-def parse_hex_string(hex_str: str, buffer: np.ndarray, buffer_size: int) -> int:
+def parse_hex_string(hex_str: str, buffer: bytearray, buffer_size: int) -> int:
     hex_digits = ''.join(c for c in hex_str if c != ' ')
     if len(hex_digits) % 2 != 0:
         hex_digits += '0'
-    
+
     len_ = 0
     for i in range(0, len(hex_digits), 2):
         if i // 2 >= buffer_size:
             return -1
         try:
             byte = int(hex_digits[i:i+2], 16)
-            buffer[len_] = byte
+            if len_ < len(buffer):
+                buffer[len_] = byte
+            else:
+                buffer.append(byte)
             len_ += 1
         except ValueError:
             return -1
     return len_
 
 
-def parse_tlv_list(buffer: np.ndarray, total_len: int, tlvs: List[TLV], max_tlvs: int) -> int:
+def parse_tlv_list(buffer: bytes, total_len: int, tlvs: List[TLV], max_tlvs: int) -> int:
     global gFID
     if buffer is None or total_len <= 0 or max_tlvs <= 0:
         return -1
@@ -818,20 +1602,19 @@ def parse_tlv_list(buffer: np.ndarray, total_len: int, tlvs: List[TLV], max_tlvs
         if pos + len_ > total_len or len_ > MAX_TLV_LEN:
             return -1
 
-        tlvs[count] = TLV(tag=tag, len=len_, value=np.zeros(MAX_TLV_LEN, dtype=np.uint8))
-        tlvs[count].value[:len_] = buffer[pos:pos + len_]
+        tlvs[count] = TLV(tag=tag, len=len_, value=bytes(buffer[pos:pos + len_]))
 
-        if tag == 0x83:
-            gFID = np.uint16((tlvs[count].value[0] << 8) | tlvs[count].value[1])
+        if tag == 0x83 and len_ == 2:
+            gFID = (tlvs[count].value[0] << 8) | tlvs[count].value[1]
 
         pos += len_
         count += 1
 
     return count
 
-def process_mf_df_ef(data: np.ndarray, len: int, apdu: APDU) -> np.uint16:
-    print("Process MF/DF/ADF")
-    tlvs = [TLV(tag=np.uint8(0), len=np.uint8(0), value=np.zeros(MAX_TLV_LEN, dtype=np.uint8)) for _ in range(MAX_TLVS)]
+def process_mf_df_ef(data: bytes, len: int, apdu: APDU) -> int:
+    print_message("Process MF/DF/ADF")
+    tlvs = [TLV(tag=0, len=0, value=b"") for _ in range(MAX_TLVS)]
     count = parse_tlv_list(data, len, tlvs, MAX_TLVS)
 
     if count < 0:
@@ -857,8 +1640,8 @@ def process_mf_df_ef(data: np.ndarray, len: int, apdu: APDU) -> np.uint16:
     has_88 = False
     is_sharable = False
     is_unsharable = False
-    record_Size = np.uint16(0)
-    fileSize = np.uint16(0)
+    record_Size = 0
+    fileSize = 0
 
     for i in range(count):
         tlv = tlvs[i]
@@ -891,7 +1674,7 @@ def process_mf_df_ef(data: np.ndarray, len: int, apdu: APDU) -> np.uint16:
                     is_df = False
                     is_mf = False
                     if (is_ef and (ef_linear or ef_cyclic)):
-                        record_Size = np.uint16((tlv.value[2] << 8) | tlv.value[3])
+                        record_Size = (tlv.value[2] << 8) | tlv.value[3]
                         apdu.RecordSize = record_Size
                 else:
                     return SW_DATA_INVALID
@@ -928,7 +1711,7 @@ def process_mf_df_ef(data: np.ndarray, len: int, apdu: APDU) -> np.uint16:
         if tlv.tag == 0x80:
             if tlv.len != 2 or not is_ef:
                 return SW_DATA_INVALID
-            file_size = np.uint16((tlv.value[0] << 8) | tlv.value[1])
+            file_size = (tlv.value[0] << 8) | tlv.value[1]
             if file_size == 0:
                 print_colored_text("File size cannot be zero\n", "red")
                 return SW_DATA_INVALID
@@ -976,7 +1759,7 @@ def process_mf_df_ef(data: np.ndarray, len: int, apdu: APDU) -> np.uint16:
                 if (raw_sfi & 0x07) != 0x00:
                     print_infof("Invalid SFI: last 3 bits must be 000 (got %02X)\n", "red", raw_sfi)
                     return SW_DATA_INVALID
-                apdu.sfi = raw_sfi
+                apdu.sfi = raw_sfi >> 3  # the SFI itself, as get_ef_sfi reads it back
             else:
                 print_infof("Invalid SFI tag length: %d\n", "red", tlv.len)
                 return SW_DATA_INVALID
@@ -1063,665 +1846,471 @@ def process_mf_df_ef(data: np.ndarray, len: int, apdu: APDU) -> np.uint16:
     print_colored_text("Mandatory and allowed tags check passed.\n", "blue")
 
     if is_mf:
-        apdu.type = np.uint8(0xA0)
+        apdu.type = 0xA0
     elif is_df:
-        apdu.type = np.uint8(0xB0)
+        apdu.type = 0xB0
     elif is_adf:
-        apdu.type = np.uint8(0xC0)
+        apdu.type = 0xC0
     elif is_ef:
         if ef_transparent:
-            apdu.type = np.uint8(0x41 if is_sharable else 0x01)
+            apdu.type = 0x41 if is_sharable else 0x01
         elif ef_linear:
-            apdu.type = np.uint8(0x42 if is_sharable else 0x02)
+            apdu.type = 0x42 if is_sharable else 0x02
         elif ef_cyclic:
-            apdu.type = np.uint8(0x46 if is_sharable else 0x06)
+            apdu.type = 0x46 if is_sharable else 0x06
 
     return SW_SUCCESS
 
-def check_duplicate_sfi(fp, parent_offset: np.uint16, new_sfi: np.uint8, new_fid: np.uint16) -> np.uint16:
+# Directory Children
+def get_image_version(fp) -> int:
     try:
-        fp.seek(parent_offset)
-        parent_fid = np.frombuffer(fp.read(2), dtype=np.uint16)[0]
-        
-        fp.seek(parent_offset)
-        mf_node_data = np.frombuffer(fp.read(struct.calcsize("<HHHHBHBH")), dtype=np.uint8)
-        if len(mf_node_data) == struct.calcsize("<HHHHBHBH") and mf_node_data[7] == IS_MF:
-            mf_node = MFNode(
-                FID=np.uint16((mf_node_data[0] << 8) | mf_node_data[1]),
-                ChildFID=np.uint16((mf_node_data[2] << 8) | mf_node_data[3]),
-                ChildOffset=np.uint16((mf_node_data[4] << 8) | mf_node_data[5]),
-                Status=mf_node_data[6],
-                Type=mf_node_data[7],
-                FCPOffset=np.uint16((mf_node_data[8] << 8) | mf_node_data[9]),
-                FCP_total_size=mf_node_data[10],
-                NextOffset=np.uint16((mf_node_data[11] << 8) | mf_node_data[12])
-            )
-            parent_type = mf_node.Type
-            child_fid = mf_node.ChildFID
-            child_offset = mf_node.ChildOffset
-            next_offset = mf_node.NextOffset
-        else:
-            fp.seek(parent_offset)
-            df_node_data = np.frombuffer(fp.read(struct.calcsize("<HHHHBHHBH")), dtype=np.uint8)
-            if len(df_node_data) != struct.calcsize("<HHHHBHHBH"):
-                return SW_MEMORY_FAILURE
-            df_node = DFADFNode(
-                FID=np.uint16((df_node_data[0] << 8) | df_node_data[1]),
-                ParentFID=np.uint16((df_node_data[2] << 8) | df_node_data[3]),
-                ParentOffset=np.uint16((df_node_data[4] << 8) | df_node_data[5]),
-                Type=df_node_data[6],
-                ChildFID=np.uint16((df_node_data[7] << 8) | df_node_data[8]),
-                ChildOffset=np.uint16((df_node_data[9] << 8) | df_node_data[10]),
-                FCPOffset=np.uint16((df_node_data[11] << 8) | df_node_data[12]),
-                FCP_total_size=df_node_data[13],
-                NextOffset=np.uint16((df_node_data[14] << 8) | df_node_data[15])
-            )
-            parent_type = df_node.Type
-            child_fid = df_node.ChildFID
-            child_offset = df_node.ChildOffset
-            next_offset = df_node.NextOffset
-
-        if parent_type not in [IS_MF, IS_DF, IS_ADF]:
-            return SW_FILE_INVALID
-
-        if child_fid == 0 and child_offset == ZERO and next_offset == ZERO:
-            return SW_SUCCESS
+        version = read_u16(fp, FORMAT_VERSION_PTR)
+    except OSError:
+        return IMAGE_FORMAT_V1
+    return IMAGE_FORMAT_V2 if version == IMAGE_FORMAT_V2 else IMAGE_FORMAT_V1
 
-        while child_fid != 0 and child_offset != C_NULL:
-            fp.seek(child_offset)
-            ef_node_data = np.frombuffer(fp.read(struct.calcsize("<HHHBHBH")), dtype=np.uint8)
-            if len(ef_node_data) != struct.calcsize("<HHHBHBH"):
-                return SW_MEMORY_FAILURE
-            ef_node = EFNode(
-                FID=np.uint16((ef_node_data[0] << 8) | ef_node_data[1]),
-                ParentOffset=np.uint16((ef_node_data[2] << 8) | ef_node_data[3]),
-                ParentFID=np.uint16((ef_node_data[4] << 8) | ef_node_data[5]),
-                Type=ef_node_data[6],
-                FCPOffset=np.uint16((ef_node_data[7] << 8) | ef_node_data[8]),
-                FCP_total_size=ef_node_data[9],
-                DataOffset=np.uint16((ef_node_data[10] << 8) | ef_node_data[11])
-            )
-
-            if is_valid_ef_type(ef_node.Type) and child_fid != new_fid:
-                if ef_node.FCP_total_size > MAX_TLV_LEN:
-                    return SW_MEMORY_FAILURE
-                fp.seek(ef_node.FCPOffset)
-                fcp_data = np.frombuffer(fp.read(ef_node.FCP_total_size), dtype=np.uint8)
-                pos = 2
-                sfi_found = False
-                while pos + 2 <= ef_node.FCP_total_size:
-                    tag = fcp_data[pos]
-                    length = fcp_data[pos + 1]
-                    if length == 0 or pos + 2 + length > ef_node.FCP_total_size:
-                        break
-                    if tag == 0x88:
-                        sfi_found = True
-                        if fcp_data[pos + 2] == new_sfi:
-                            return SW_FILE_ALREADY_EXIST
-                    pos += 2 + length
-                if not sfi_found and (child_fid & 0xFF) == new_sfi:
-                    return SW_FILE_ALREADY_EXIST
-
-            if next_offset == 0 or next_offset == C_NULL:
-                break
-
-            fp.seek(next_offset)
-            node2_data = np.frombuffer(fp.read(struct.calcsize("<HHHH")), dtype=np.uint8)
-            if len(node2_data) != struct.calcsize("<HHHH"):
-                return SW_MEMORY_FAILURE
-            node2 = NodeSecond(
-                ParentOffset=np.uint16((node2_data[0] << 8) | node2_data[1]),
-                ChildFID=np.uint16((node2_data[2] << 8) | node2_data[3]),
-                ChildOffset=np.uint16((node2_data[4] << 8) | node2_data[5]),
-                NextOffset=np.uint16((node2_data[6] << 8) | node2_data[7])
-            )
-            child_fid = node2.ChildFID
-            child_offset = node2.ChildOffset
-            next_offset = node2.NextOffset
+def set_image_version(fp, version: int):
+    write_u16(fp, FORMAT_VERSION_PTR, version)
+    fp.flush()
 
-        return SW_SUCCESS
-    except:
+def read_directory_node(fp, offset: int):
+    # MF and DF/ADF nodes both start with their FID
+    if read_u16(fp, offset) == MF_FID:
+        return read_mf_node(fp, offset)
+    return read_df_node(fp, offset)
+
+def pack_directory_node(node) -> bytes:
+    return pack_mf_node(node) if isinstance(node, MFNode) else pack_df_node(node)
+
+def read_child_chain(fp, dir_node) -> List[Tuple[int, int]]:
+    children = []
+    if dir_node.ChildFID != ZERO and dir_node.ChildOffset not in [ZERO, C_NULL]:
+        children.append((dir_node.ChildFID, dir_node.ChildOffset))
+    next_offset = dir_node.NextOffset
+    seen = set()
+    while next_offset != ZERO and next_offset != C_NULL and next_offset < FILE_SIZE:
+        if next_offset in seen:
+            raise IOError(f"NodeSecond chain loops back to {next_offset:04X}")
+        seen.add(next_offset)
+        node2 = read_node_second(fp, next_offset)
+        if node2 is None:
+            raise IOError(f"Failed to read NodeSecond at offset {next_offset:04X}")
+        children.append((node2.ChildFID, node2.ChildOffset))
+        next_offset = node2.NextOffset
+    return children
+
+def read_child_table(fp, table_offset: int) -> List[Tuple[int, int]]:
+    if table_offset == ZERO or table_offset == C_NULL:
+        return []
+    count, capacity = struct.unpack(CHILD_TABLE_HEADER_FORMAT, fp.read_at(table_offset, CHILD_TABLE_HEADER_SIZE))
+    if count > capacity:
+        raise IOError(f"Corrupt child table at {table_offset:04X} ({count} > {capacity})")
+    data = fp.read_at(table_offset + CHILD_TABLE_HEADER_SIZE, count * CHILD_ENTRY_SIZE)
+    if len(data) != count * CHILD_ENTRY_SIZE:
+        raise IOError(f"Short child table at {table_offset:04X}")
+    return list(struct.iter_unpack(CHILD_ENTRY_FORMAT, data))
+
+def pack_child_table(entries: List[Tuple[int, int]], capacity: int) -> bytes:
+    table = struct.pack(CHILD_TABLE_HEADER_FORMAT, len(entries), capacity)
+    table += b''.join(struct.pack(CHILD_ENTRY_FORMAT, fid, offset) for fid, offset in entries)
+    return table + b'\xff' * ((capacity - len(entries)) * CHILD_ENTRY_SIZE)
+
+def list_children(fp, dir_node) -> List[Tuple[int, int]]:
+    if get_image_version(fp) == IMAGE_FORMAT_V2:
+        return read_child_table(fp, dir_node.ChildOffset)
+    return read_child_chain(fp, dir_node)
+
+def insert_child_entry(fp, parent_offset: int, new_fid: int, new_node_offset: int) -> int:
+    dir_node = read_directory_node(fp, parent_offset)
+    if dir_node is None:
+        print_message(f"Failed to read directory node at {parent_offset:04X}")
         return SW_MEMORY_FAILURE
 
-def check_fid_in_df_and_children(fp, df_offset: np.uint16, new_fid: np.uint16) -> np.uint16:
-    print(f"Checking for duplicate FID {new_fid:04X} in DF/ADF at offset {df_offset:04X}")
-    try:
-        fp.seek(df_offset)
-        df_node_data = np.frombuffer(fp.read(struct.calcsize("<HHHHBHHBH")), dtype=np.uint8)
-        if len(df_node_data) != struct.calcsize("<HHHHBHHBH"):
-            print(f"Failed to read DF/ADF node at offset {df_offset:04X}")
-            return SW_MEMORY_FAILURE
-        df_node = DFADFNode(
-            FID=np.uint16((df_node_data[0] << 8) | df_node_data[1]),
-            ParentFID=np.uint16((df_node_data[2] << 8) | df_node_data[3]),
-            ParentOffset=np.uint16((df_node_data[4] << 8) | df_node_data[5]),
-            Type=df_node_data[6],
-            ChildFID=np.uint16((df_node_data[7] << 8) | df_node_data[8]),
-            ChildOffset=np.uint16((df_node_data[9] << 8) | df_node_data[10]),
-            FCPOffset=np.uint16((df_node_data[11] << 8) | df_node_data[12]),
-            FCP_total_size=df_node_data[13],
-            NextOffset=np.uint16((df_node_data[14] << 8) | df_node_data[15])
-        )
-
-        if df_node.FID == new_fid:
-            print(f"Error: Duplicate FID {new_fid:04X} found as DF/ADF FID at {df_offset:04X}")
-            return SW_FILE_ALREADY_EXIST
+    table_offset = dir_node.ChildOffset
+    capacity = 0
+    if table_offset != ZERO and table_offset != C_NULL:
+        capacity = read_u16(fp, table_offset + 2)
+    entries = read_child_table(fp, table_offset)
 
-        if df_node.ChildFID == new_fid:
-            print(f"Error: Duplicate FID {new_fid:04X} found as DF/ADF ChildFID at {df_offset:04X}")
-            return SW_FILE_ALREADY_EXIST
-
-        if df_node.ChildOffset != C_NULL and df_node.ChildOffset < FILE_SIZE:
-            fp.seek(df_node.ChildOffset)
-            child_fid = np.frombuffer(fp.read(2), dtype=np.uint16)[0]
-            fp.seek(df_node.ChildOffset + 6)  # Offset to type in DF_ADF_node
-            child_type = np.frombuffer(fp.read(1), dtype=np.uint8)[0]
-            
-            if child_fid == new_fid:
-                print(f"Error: Duplicate FID {new_fid:04X} found in child node at {df_node.ChildOffset:04X}")
-                return SW_FILE_ALREADY_EXIST
+    pos = bisect.bisect_left([fid for fid, _ in entries], new_fid)
+    if pos < len(entries) and entries[pos][0] == new_fid:
+        return SW_FILE_ALREADY_EXIST
+    entries.insert(pos, (new_fid, new_node_offset))
 
-            if child_type in [IS_DF, IS_ADF]:
-                status = check_fid_in_df_and_children(fp, df_node.ChildOffset, new_fid)
-                if status != SW_SUCCESS:
-                    return status
-
-        next_offset = df_node.NextOffset
-        while next_offset != ZERO and next_offset != C_NULL and next_offset < FILE_SIZE:
-            fp.seek(next_offset)
-            node2_data = np.frombuffer(fp.read(struct.calcsize("<HHHH")), dtype=np.uint8)
-            if len(node2_data) != struct.calcsize("<HHHH"):
-                print(f"Failed to read NodeSecond at offset {next_offset:04X}")
-                return SW_MEMORY_FAILURE
-            node2 = NodeSecond(
-                ParentOffset=np.uint16((node2_data[0] << 8) | node2_data[1]),
-                ChildFID=np.uint16((node2_data[2] << 8) | node2_data[3]),
-                ChildOffset=np.uint16((node2_data[4] << 8) | node2_data[5]),
-                NextOffset=np.uint16((node2_data[6] << 8) | node2_data[7])
-            )
-
-            if node2.ChildFID == new_fid:
-                print(f"Error: Duplicate FID {new_fid:04X} found in NodeSecond ChildFID at {next_offset:04X}")
-                return SW_FILE_ALREADY_EXIST
+    if len(entries) <= capacity:
+        # Shift the tail up by one entry and bump the count
+        tail = b''.join(struct.pack(CHILD_ENTRY_FORMAT, fid, offset) for fid, offset in entries[pos:])
+        fp.write_at(table_offset + CHILD_TABLE_HEADER_SIZE + pos * CHILD_ENTRY_SIZE, tail)
+        write_u16(fp, table_offset, len(entries))
+        fp.flush()
+        return SW_SUCCESS
 
-            if node2.ChildOffset != C_NULL and node2.ChildOffset < FILE_SIZE:
-                fp.seek(node2.ChildOffset)
-                child_fid = np.frombuffer(fp.read(2), dtype=np.uint16)[0]
-                fp.seek(node2.ChildOffset + 6)
-                child_type = np.frombuffer(fp.read(1), dtype=np.uint8)[0]
-                
-                if child_fid == new_fid:
-                    print(f"Error: Duplicate FID {new_fid:04X} found in child node at {node2.ChildOffset:04X}")
-                    return SW_FILE_ALREADY_EXIST
+    # Table is full: reallocate with double the capacity, then repoint the directory
+    new_capacity = max(CHILD_TABLE_INITIAL_CAPACITY, capacity * 2)
+    new_table_offset = get_next_write_position(fp, CHILD_TABLE_HEADER_SIZE + new_capacity * CHILD_ENTRY_SIZE)
+    if new_table_offset == SW_NOT_ENOUGH_MEMORY:
+        return SW_NOT_ENOUGH_MEMORY
+    fp.write_at(new_table_offset, pack_child_table(entries, new_capacity))
+    fp.flush()
 
-                if child_type in [IS_DF, IS_ADF]:
-                    status = check_fid_in_df_and_children(fp, node2.ChildOffset, new_fid)
-                    if status != SW_SUCCESS:
-                        return status
+    old = pack_directory_node(dir_node)
+    dir_node.ChildFID = ZERO
+    dir_node.ChildOffset = new_table_offset
+    dir_node.NextOffset = ZERO
+    write_changed(fp, parent_offset, old, pack_directory_node(dir_node))
+    fp.flush()
+    return SW_SUCCESS
 
-            next_offset = node2.NextOffset
+def find_fcp_tag(fcp_data: bytes, tag: int) -> Optional[bytes]:
+    pos = 2
+    while pos + 2 <= len(fcp_data):
+        length = fcp_data[pos + 1]
+        if pos + 2 + length > len(fcp_data):
+            return None
+        if fcp_data[pos] == tag:
+            return fcp_data[pos + 2:pos + 2 + length]
+        pos += 2 + length
+    return None
+
+def read_node_region(fp, offset: int, depth: int = 0) -> WalkNode:
+    # One read covers the node header and, for freshly allocated files, its FCP.
+    # Under a lock the raw region is cached; writes and generation changes drop it.
+    region = fp.cache.get(offset) if fp.lock_depth else None
+    if region is None:
+        region = fp.read_at(offset, NODE_PREFETCH_SIZE)
+        if fp.lock_depth:
+            fp.cache[offset] = region
+    if len(region) < EF_NODE_SIZE:
+        raise IOError(f"Short read of node at {offset:04X}")
+    if int.from_bytes(region[0:2], "little") == MF_FID:
+        node = MFNode(*struct.unpack_from(MF_NODE_FORMAT, region))
+    elif is_valid_df(region[6]):
+        node = DFADFNode(*struct.unpack_from(DF_NODE_FORMAT, region))
+    else:
+        node = EFNode(*struct.unpack_from(EF_NODE_FORMAT, region))
 
+    start = node.FCPOffset - offset
+    if 0 <= start and start + node.FCP_total_size <= len(region):
+        fcp = region[start:start + node.FCP_total_size]
+    else:
+        fcp = fp.read_at(node.FCPOffset, node.FCP_total_size)
+    return WalkNode(offset=offset, depth=depth, node=node, fcp=fcp)
+
+def walk(fp, start_offset: int, depth: Optional[int] = None):
+    stack = [(start_offset, 0)]
+    visited = set()
+    while stack:
+        offset, level = stack.pop()
+        if offset in visited:
+            raise IOError(f"Cycle in file tree: node at {offset:04X} reached twice")
+        visited.add(offset)
+
+        entry = read_node_region(fp, offset, level)
+        yield entry
+
+        if entry.node.Type in [IS_MF, IS_DF, IS_ADF] and (depth is None or level < depth):
+            children = list_children(fp, entry.node)
+            for child_fid, child_offset in reversed(children):
+                if child_offset != ZERO and child_offset != C_NULL and child_offset < FILE_SIZE:
+                    stack.append((child_offset, level + 1))
+
+def add_index_entry(index: DirectoryIndex, fid: int, offset: int, sfi: int, aid: bytes):
+    # Lookups keep the first match in child order, as a linear search of the children would
+    index.entries.append((fid, offset, sfi, aid))
+    index.fids.setdefault(fid, offset)
+    if sfi:
+        index.sfis.setdefault(sfi, offset)
+    if aid:
+        index.aids.setdefault(aid, offset)
+
+def index_child(index: DirectoryIndex, fid: int, entry: WalkNode):
+    sfi, aid = 0, b""
+    if is_valid_ef_type(entry.node.Type):
+        sfi = get_ef_sfi(entry.node.FID, entry.fcp) or 0
+    elif entry.node.Type in [IS_DF, IS_ADF]:
+        aid = bytes(find_fcp_tag(entry.fcp, 0x84) or b"")
+    add_index_entry(index, fid, entry.offset, sfi, aid)
+
+def build_directory_index(fp, dir_offset: int) -> DirectoryIndex:
+    index = DirectoryIndex()
+    for child_fid, child_offset in list_children(fp, read_directory_node(fp, dir_offset)):
+        if child_offset != ZERO and child_offset != C_NULL and child_offset < FILE_SIZE:
+            index_child(index, child_fid, read_node_region(fp, child_offset, 1))
+    return index
+
+def get_directory_index(fp, dir_offset: int) -> DirectoryIndex:
+    # Nothing is indexed at power-up: a directory's children are indexed the first
+    # time it is searched. Indexes are only kept while a lock pins the generation.
+    if not fp.lock_depth:
+        return build_directory_index(fp, dir_offset)
+    index = fp.indexes.get(dir_offset)
+    if index is None and fp.index_path is not None and not fp.index_loaded:
+        load_directory_indexes(fp)
+        index = fp.indexes.get(dir_offset)
+    if index is None:
+        index = build_directory_index(fp, dir_offset)
+        fp.indexes[dir_offset] = index
+        fp.indexes_dirty = True
+    return index
+
+def index_new_child(fp, parent_offset: int, fid: int, offset: int):
+    index = fp.indexes.get(parent_offset)
+    if index is not None:
+        index_child(index, fid, read_node_region(fp, offset, 1))
+        fp.indexes_dirty = True
+
+def find_df_by_name(fp, dir_offset: int, name: bytes) -> int:
+    aids = get_directory_index(fp, dir_offset).aids
+    if name in aids:
+        return aids[name]
+    for aid, offset in aids.items():
+        if aid.startswith(name):  # right-truncated DF name
+            return offset
+    return C_NULL
+
+def load_directory_indexes(fp) -> bool:
+    # The sidecar is only trusted for the exact image state it was saved from
+    fp.index_loaded = True
+    try:
+        with open(fp.index_path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return False
+    try:
+        magic, version, generation, write_offset, count = struct.unpack_from(INDEX_HEADER_FORMAT, data)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            print_infof("Ignoring index sidecar %s: not an index file\n", "yellow", fp.index_path)
+            return False
+        if generation != get_generation(fp) or write_offset != load_cursors(fp).write_offset:
+            return False
+        pos = struct.calcsize(INDEX_HEADER_FORMAT)
+        indexes = {}
+        for _ in range(count):
+            dir_offset, entry_count = struct.unpack_from(INDEX_DIRECTORY_FORMAT, data, pos)
+            pos += struct.calcsize(INDEX_DIRECTORY_FORMAT)
+            index = DirectoryIndex()
+            for _ in range(entry_count):
+                fid, offset, sfi, aid_len = struct.unpack_from(INDEX_ENTRY_FORMAT, data, pos)
+                pos += struct.calcsize(INDEX_ENTRY_FORMAT)
+                add_index_entry(index, fid, offset, sfi, data[pos:pos + aid_len])
+                pos += aid_len
+            indexes[dir_offset] = index
+    except struct.error:
+        print_infof("Ignoring truncated index sidecar %s\n", "yellow", fp.index_path)
+        return False
+    for dir_offset, index in indexes.items():
+        fp.indexes.setdefault(dir_offset, index)
+    return True
+
+def save_directory_indexes(fp) -> bool:
+    with image_lock(fp):
+        if not fp.indexes:
+            return False
+        parts = [struct.pack(INDEX_HEADER_FORMAT, INDEX_MAGIC, INDEX_VERSION, get_generation(fp),
+                             load_cursors(fp).write_offset, len(fp.indexes))]
+        for dir_offset, index in sorted(fp.indexes.items()):
+            parts.append(struct.pack(INDEX_DIRECTORY_FORMAT, dir_offset, len(index.entries)))
+            for fid, offset, sfi, aid in index.entries:
+                parts.append(struct.pack(INDEX_ENTRY_FORMAT, fid, offset, sfi, len(aid)) + aid)
+    # A temp file of our own in the same directory, so processes saving at once never
+    # share one and readers only ever see a complete sidecar
+    f = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(fp.index_path)), delete=False)
+    try:
+        with f:
+            f.write(b"".join(parts))
+        os.replace(f.name, fp.index_path)
+    except BaseException:
+        os.unlink(f.name)
+        raise
+    fp.indexes_dirty = False
+    return True
+
+def check_duplicate_sfi(fp, parent_offset: int, new_sfi: int, new_fid: int) -> int:
+    try:
+        for entry in walk(fp, parent_offset, depth=1):
+            node = entry.node
+            if entry.depth == 0:
+                if node.Type not in [IS_MF, IS_DF, IS_ADF]:
+                    return SW_FILE_INVALID
+                continue
+            if not is_valid_ef_type(node.Type) or node.FID == new_fid:
+                continue
+            if get_ef_sfi(node.FID, entry.fcp) == new_sfi:
+                return SW_FILE_ALREADY_EXIST
         return SW_SUCCESS
     except:
-        print(f"Failed to read DF/ADF node at offset {df_offset:04X}")
         return SW_MEMORY_FAILURE
 
-def check_fid_in_mf_and_children(fp, mf_offset: np.uint32, new_fid: np.uint16) -> np.uint16:
-    print(f"Checking for duplicate FID {new_fid:04X} starting at MF offset {mf_offset:04X}")
-    try:
-        fp.seek(mf_offset)
-        mf_node_data = np.frombuffer(fp.read(struct.calcsize("<HHHHBHBH")), dtype=np.uint8)
-        if len(mf_node_data) != struct.calcsize("<HHHHBHBH"):
-            print(f"Failed to read MF node at offset {mf_offset:04X}")
-            return SW_MEMORY_FAILURE
-        mf_node = MFNode(
-            FID=np.uint16((mf_node_data[0] << 8) | mf_node_data[1]),
-            ChildFID=np.uint16((mf_node_data[2] << 8) | mf_node_data[3]),
-            ChildOffset=np.uint16((mf_node_data[4] << 8) | mf_node_data[5]),
-            Status=mf_node_data[6],
-            Type=mf_node_data[7],
-            FCPOffset=np.uint16((mf_node_data[8] << 8) | mf_node_data[9]),
-            FCP_total_size=mf_node_data[10],
-            NextOffset=np.uint16((mf_node_data[11] << 8) | mf_node_data[12])
-        )
-
-        if mf_node.FID == new_fid:
-            print(f"Error: Duplicate FID {new_fid:04X} found as MF's FID")
-            return SW_FILE_ALREADY_EXIST
-
-        if mf_node.ChildFID == new_fid:
-            print(f"Error: Duplicate FID {new_fid:04X} found as MF's ChildFID")
+def find_fid_in_tree(fp, start_offset: int, new_fid: int) -> int:
+    for entry in walk(fp, start_offset):
+        if entry.node.FID == new_fid:
+            print_message(f"Error: Duplicate FID {new_fid:04X} found in node at {entry.offset:04X}")
             return SW_FILE_ALREADY_EXIST
+    return SW_SUCCESS
 
-        if mf_node.ChildOffset != C_NULL and mf_node.ChildOffset < FILE_SIZE:
-            fp.seek(mf_node.ChildOffset)
-            child_fid = np.frombuffer(fp.read(2), dtype=np.uint16)[0]
-            if child_fid == new_fid:
-                print(f"Error: Duplicate FID {new_fid:04X} found in MF's child node at {mf_node.ChildOffset:04X}")
-                return SW_FILE_ALREADY_EXIST
-
-        next_offset = mf_node.NextOffset
-        while next_offset != ZERO and next_offset != C_NULL and next_offset < FILE_SIZE:
-            fp.seek(next_offset)
-            node2_data = np.frombuffer(fp.read(struct.calcsize("<HHHH")), dtype=np.uint8)
-            if len(node2_data) != struct.calcsize("<HHHH"):
-                print(f"Failed to read NodeSecond at offset {next_offset:04X}")
-                return SW_MEMORY_FAILURE
-            node2 = NodeSecond(
-                ParentOffset=np.uint16((node2_data[0] << 8) | node2_data[1]),
-                ChildFID=np.uint16((node2_data[2] << 8) | node2_data[3]),
-                ChildOffset=np.uint16((node2_data[4] << 8) | node2_data[5]),
-                NextOffset=np.uint16((node2_data[6] << 8) | node2_data[7])
-            )
-
-            if node2.ChildFID == new_fid:
-                print(f"Error: Duplicate FID {new_fid:04X} found in NodeSecond ChildFID at {next_offset:04X}")
-                return SW_FILE_ALREADY_EXIST
-
-            if node2.ChildOffset != C_NULL and node2.ChildOffset < FILE_SIZE:
-                fp.seek(node2.ChildOffset)
-                child_fid = np.frombuffer(fp.read(2), dtype=np.uint16)[0]
-                fp.seek(node2.ChildOffset + 6)
-                child_type = np.frombuffer(fp.read(1), dtype=np.uint8)[0]
-                
-                if child_fid == new_fid:
-                    print(f"Error: Duplicate FID {new_fid:04X} found in child node at {node2.ChildOffset:04X}")
-                    return SW_FILE_ALREADY_EXIST
-
-                if child_type in [IS_DF, IS_ADF]:
-                    status = check_fid_in_df_and_children(fp, node2.ChildOffset, new_fid)
-                    if status != SW_SUCCESS:
-                        return status
-
-            next_offset = node2.NextOffset
+def check_fid_in_df_and_children(fp, df_offset: int, new_fid: int) -> int:
+    print_message(f"Checking for duplicate FID {new_fid:04X} in DF/ADF at offset {df_offset:04X}")
+    try:
+        return find_fid_in_tree(fp, df_offset, new_fid)
+    except:
+        print_message(f"Failed to read DF/ADF node at offset {df_offset:04X}")
+        return SW_MEMORY_FAILURE
 
-        return SW_SUCCESS
+def check_fid_in_mf_and_children(fp, mf_offset: int, new_fid: int) -> int:
+    print_message(f"Checking for duplicate FID {new_fid:04X} starting at MF offset {mf_offset:04X}")
+    try:
+        return find_fid_in_tree(fp, mf_offset, new_fid)
     except:
-        print(f"Failed to read MF node at offset {mf_offset:04X}")
+        print_message(f"Failed to read MF node at offset {mf_offset:04X}")
         return SW_MEMORY_FAILURE
-    
-def check_fid_in_parent_and_siblings(fp, parent_offset: np.uint16, new_fid: np.uint16) -> np.uint16:
-    print(f"Checking for duplicate FID {new_fid:04X} in parent and siblings at offset {parent_offset:04X}")
+
+def check_fid_in_parent_and_siblings(fp, parent_offset: int, new_fid: int) -> int:
+    print_message(f"Checking for duplicate FID {new_fid:04X} in parent and siblings at offset {parent_offset:04X}")
     try:
-        fp.seek(parent_offset)
-        parent_node_data = np.frombuffer(fp.read(struct.calcsize("<HHHHBHHBH")), dtype=np.uint8)
-        if len(parent_node_data) != struct.calcsize("<HHHHBHHBH"):
-            print(f"Failed to read parent node at offset {parent_offset:04X}")
+        parent_node = read_df_node(fp, parent_offset)
+        if parent_node is None:
+            print_message(f"Failed to read parent node at offset {parent_offset:04X}")
             return SW_MEMORY_FAILURE
-        parent_node = DFADFNode(
-            FID=np.uint16((parent_node_data[0] << 8) | parent_node_data[1]),
-            ParentFID=np.uint16((parent_node_data[2] << 8) | parent_node_data[3]),
-            ParentOffset=np.uint16((parent_node_data[4] << 8) | parent_node_data[5]),
-            Type=parent_node_data[6],
-            ChildFID=np.uint16((parent_node_data[7] << 8) | parent_node_data[8]),
-            ChildOffset=np.uint16((parent_node_data[9] << 8) | parent_node_data[10]),
-            FCPOffset=np.uint16((parent_node_data[11] << 8) | parent_node_data[12]),
-            FCP_total_size=parent_node_data[13],
-            NextOffset=np.uint16((parent_node_data[14] << 8) | parent_node_data[15])
-        )
-
-        if parent_node.FID == new_fid:
-            print(f"Error: New FID {new_fid:04X} matches parent FID {parent_node.FID:04X}")
-            return SW_FILE_ALREADY_EXIST
-
-        if parent_node.ChildFID == new_fid:
-            print(f"Error: Duplicate FID {new_fid:04X} found in parent's ChildFID at {parent_offset:04X}")
-            return SW_FILE_ALREADY_EXIST
 
         if parent_node.ParentFID == new_fid:
-            print(f"Error: Duplicate FID {new_fid:04X} found in parent's ParentFID at {parent_offset:04X}")
+            print_message(f"Error: Duplicate FID {new_fid:04X} found in parent's ParentFID at {parent_offset:04X}")
             return SW_FILE_ALREADY_EXIST
 
-        if parent_node.ChildOffset != C_NULL and parent_node.ChildOffset < FILE_SIZE:
-            fp.seek(parent_node.ChildOffset)
-            child_fid = np.frombuffer(fp.read(2), dtype=np.uint16)[0]
-            fp.seek(parent_node.ChildOffset + 6)  # Offset to type in DF_ADF_node
-            child_type = np.frombuffer(fp.read(1), dtype=np.uint8)[0]
-
-            if child_fid == new_fid:
-                print(f"Error: Duplicate FID {new_fid:04X} found in parent's child node at {parent_node.ChildOffset:04X}")
-                return SW_FILE_ALREADY_EXIST
-
-            if is_valid_df(child_type):
-                status = check_fid_in_df_and_children(fp, parent_node.ChildOffset, new_fid)
-                if status != SW_SUCCESS:
-                    return status
-
-        next_offset = parent_node.NextOffset
-        while next_offset != ZERO and next_offset != C_NULL and next_offset < FILE_SIZE:
-            fp.seek(next_offset)
-            node2_data = np.frombuffer(fp.read(struct.calcsize("<HHHH")), dtype=np.uint8)
-            if len(node2_data) != struct.calcsize("<HHHH"):
-                print(f"Failed to read NodeSecond at offset {next_offset:04X}")
-                return SW_MEMORY_FAILURE
-            node2 = NodeSecond(
-                ParentOffset=np.uint16((node2_data[0] << 8) | node2_data[1]),
-                ChildFID=np.uint16((node2_data[2] << 8) | node2_data[3]),
-                ChildOffset=np.uint16((node2_data[4] << 8) | node2_data[5]),
-                NextOffset=np.uint16((node2_data[6] << 8) | node2_data[7])
-            )
-
-            if node2.ChildFID == new_fid:
-                print(f"Error: Duplicate FID {new_fid:04X} found in NodeSecond ChildFID at {next_offset:04X}")
-                return SW_FILE_ALREADY_EXIST
-
-            if node2.ChildOffset != C_NULL and node2.ChildOffset < FILE_SIZE:
-                fp.seek(node2.ChildOffset)
-                child_fid = np.frombuffer(fp.read(2), dtype=np.uint16)[0]
-                fp.seek(node2.ChildOffset + 6)
-                child_type = np.frombuffer(fp.read(1), dtype=np.uint8)[0]
-
-                if child_fid == new_fid:
-                    print(f"Error: Duplicate FID {new_fid:04X} found in sibling child node at {node2.ChildOffset:04X}")
-                    return SW_FILE_ALREADY_EXIST
-
-                if is_valid_df(child_type):
-                    status = check_fid_in_df_and_children(fp, node2.ChildOffset, new_fid)
-                    if status != SW_SUCCESS:
-                        return status
-
-            next_offset = node2.NextOffset
-
+        # A DF directly under the MF is checked against the whole tree, which covers its own subtree
         if parent_node.ParentFID == MF_FID and parent_node.ParentOffset != C_NULL:
-            return check_fid_in_mf_and_children(fp, parent_node.ParentOffset, new_fid)
-
-        return SW_SUCCESS
+            return find_fid_in_tree(fp, parent_node.ParentOffset, new_fid)
+        return find_fid_in_tree(fp, parent_offset, new_fid)
     except:
-        print(f"Failed to read parent node at offset {parent_offset:04X}")
+        print_message(f"Failed to read parent node at offset {parent_offset:04X}")
         return SW_MEMORY_FAILURE
-    
-def check_duplicate_fid_df(fp, parent_offset: np.uint16, new_fid: np.uint16) -> np.uint16:
-    print(f"Checking for duplicate FID {new_fid:04X} under DF/ADF at offset {parent_offset:04X}")
+
+def check_duplicate_fid_df(fp, parent_offset: int, new_fid: int) -> int:
+    print_message(f"Checking for duplicate FID {new_fid:04X} under DF/ADF at offset {parent_offset:04X}")
     try:
-        fp.seek(parent_offset)
-        df_node_data = np.frombuffer(fp.read(struct.calcsize("<HHHHBHHBH")), dtype=np.uint8)
-        if len(df_node_data) != struct.calcsize("<HHHHBHHBH"):
-            print(f"Failed to read parent DF/ADF node at offset {parent_offset:04X}")
+        df_node = read_df_node(fp, parent_offset)
+        if df_node is None:
+            print_message(f"Failed to read parent DF/ADF node at offset {parent_offset:04X}")
             return SW_MEMORY_FAILURE
-        df_node = DFADFNode(
-            FID=np.uint16((df_node_data[0] << 8) | df_node_data[1]),
-            ParentFID=np.uint16((df_node_data[2] << 8) | df_node_data[3]),
-            ParentOffset=np.uint16((df_node_data[4] << 8) | df_node_data[5]),
-            Type=df_node_data[6],
-            ChildFID=np.uint16((df_node_data[7] << 8) | df_node_data[8]),
-            ChildOffset=np.uint16((df_node_data[9] << 8) | df_node_data[10]),
-            FCPOffset=np.uint16((df_node_data[11] << 8) | df_node_data[12]),
-            FCP_total_size=df_node_data[13],
-            NextOffset=np.uint16((df_node_data[14] << 8) | df_node_data[15])
-        )
 
         if df_node.FID == new_fid:
-            print(f"Error: New FID {new_fid:04X} matches parent FID {df_node.FID:04X}")
+            print_message(f"Error: New FID {new_fid:04X} matches parent FID {df_node.FID:04X}")
             return SW_FILE_ALREADY_EXIST
 
-        if df_node.ChildFID == new_fid:
-            print(f"Error: Duplicate FID {new_fid:04X} found in parent's ChildFID at {parent_offset:04X}")
+        child_offset = get_directory_index(fp, parent_offset).fids.get(new_fid, C_NULL)
+        if child_offset != C_NULL:
+            print_message(f"Error: Duplicate FID {new_fid:04X} found in child node at {child_offset:04X}")
             return SW_FILE_ALREADY_EXIST
 
-        if df_node.ChildOffset != C_NULL and df_node.ChildOffset < FILE_SIZE:
-            fp.seek(df_node.ChildOffset)
-            child_fid = np.frombuffer(fp.read(2), dtype=np.uint16)[0]
-            if child_fid == new_fid:
-                print(f"Error: Duplicate FID {new_fid:04X} found in child node at {df_node.ChildOffset:04X}")
-                return SW_FILE_ALREADY_EXIST
-
-        next_offset = df_node.NextOffset
-        while next_offset != ZERO and next_offset != C_NULL and next_offset < FILE_SIZE:
-            fp.seek(next_offset)
-            node2_data = np.frombuffer(fp.read(struct.calcsize("<HHHH")), dtype=np.uint8)
-            if len(node2_data) != struct.calcsize("<HHHH"):
-                print(f"Failed to read NodeSecond at offset {next_offset:04X}")
-                return SW_MEMORY_FAILURE
-            node2 = NodeSecond(
-                ParentOffset=np.uint16((node2_data[0] << 8) | node2_data[1]),
-                ChildFID=np.uint16((node2_data[2] << 8) | node2_data[3]),
-                ChildOffset=np.uint16((node2_data[4] << 8) | node2_data[5]),
-                NextOffset=np.uint16((node2_data[6] << 8) | node2_data[7])
-            )
-
-            if node2.ChildFID == new_fid:
-                print(f"Error: Duplicate FID {new_fid:04X} found in NodeSecond ChildFID at {next_offset:04X}")
-                return SW_FILE_ALREADY_EXIST
-
-            if node2.ChildOffset != C_NULL and node2.ChildOffset < FILE_SIZE:
-                fp.seek(node2.ChildOffset)
-                child_fid = np.frombuffer(fp.read(2), dtype=np.uint16)[0]
-                if child_fid == new_fid:
-                    print(f"Error: Duplicate FID {new_fid:04X} found in child node at {node2.ChildOffset:04X}")
-                    return SW_FILE_ALREADY_EXIST
-
-            next_offset = node2.NextOffset
-
         return SW_SUCCESS
     except:
-        print(f"Failed to read parent DF/ADF node at offset {parent_offset:04X}")
+        print_message(f"Failed to read parent DF/ADF node at offset {parent_offset:04X}")
         return SW_MEMORY_FAILURE
 
 
-def add_to_mf_chain(fp, parent_offset: np.uint16, new_fid: np.uint16, new_node_offset: np.uint16) -> np.uint16:
+def append_node_second(fp, parent_offset: int, new_fid: int, new_node_offset: int) -> int:
+    new_node2_offset = get_next_write_position(fp, NODE_SECOND_SIZE)
+    if new_node2_offset == SW_NOT_ENOUGH_MEMORY:
+        return SW_NOT_ENOUGH_MEMORY
+
+    node2 = NodeSecond(
+        ParentOffset=parent_offset,
+        ChildFID=new_fid,
+        ChildOffset=new_node_offset,
+        NextOffset=ZERO
+    )
+    fp.seek(new_node2_offset)
+    fp.write(pack_node_second(node2))
+    fp.flush()
+    return new_node2_offset
+
+def link_to_chain_tail(fp, first_offset: int, new_node2_offset: int) -> int:
+    current_offset = first_offset
+    while True:
+        prev_node = read_node_second(fp, current_offset)
+        if prev_node is None:
+            print_message("Failed to read NodeSecond")
+            return SW_MEMORY_FAILURE
+        if prev_node.NextOffset == ZERO:
+            break
+        current_offset = prev_node.NextOffset
+
+    old = pack_node_second(prev_node)
+    prev_node.NextOffset = new_node2_offset
+    write_changed(fp, current_offset, old, pack_node_second(prev_node))
+    fp.flush()
+    return SW_SUCCESS
+
+def add_to_mf_chain(fp, parent_offset: int, new_fid: int, new_node_offset: int) -> int:
     try:
-        fp.seek(parent_offset)
-        mf_node_data = np.frombuffer(fp.read(struct.calcsize("<HHHHBHBH")), dtype=np.uint8)
-        if len(mf_node_data) != struct.calcsize("<HHHHBHBH"):
-            print("Failed to read MF node")
+        mf_node = read_mf_node(fp, parent_offset)
+        if mf_node is None:
+            print_message("Failed to read MF node")
             return SW_MEMORY_FAILURE
-        mf_node = MFNode(
-            FID=np.uint16((mf_node_data[0] << 8) | mf_node_data[1]),
-            ChildFID=np.uint16((mf_node_data[2] << 8) | mf_node_data[3]),
-            ChildOffset=np.uint16((mf_node_data[4] << 8) | mf_node_data[5]),
-            Status=mf_node_data[6],
-            Type=mf_node_data[7],
-            FCPOffset=np.uint16((mf_node_data[8] << 8) | mf_node_data[9]),
-            FCP_total_size=mf_node_data[10],
-            NextOffset=np.uint16((mf_node_data[11] << 8) | mf_node_data[12])
-        )
 
+        old = pack_mf_node(mf_node)
         if mf_node.ChildFID == ZERO:
             mf_node.ChildFID = new_fid
             mf_node.ChildOffset = new_node_offset
-            fp.seek(parent_offset)
-            fp.write(struct.pack("<HHHHBHBH", mf_node.FID, mf_node.ChildFID, mf_node.ChildOffset,
-                                mf_node.Status, mf_node.Type, mf_node.FCPOffset,
-                                mf_node.FCP_total_size, mf_node.NextOffset))
+            write_changed(fp, parent_offset, old, pack_mf_node(mf_node))
             fp.flush()
             return SW_SUCCESS
 
-        current_offset = parent_offset
-        last_offset = C_NULL
+        new_node2_offset = append_node_second(fp, parent_offset, new_fid, new_node_offset)
+        if new_node2_offset == SW_NOT_ENOUGH_MEMORY:
+            return SW_NOT_ENOUGH_MEMORY
 
         if mf_node.NextOffset == ZERO:
-            new_node2_offset = get_next_write_position(fp, struct.calcsize("<HHHH"))
-            if new_node2_offset == SW_NOT_ENOUGH_MEMORY:
-                return SW_NOT_ENOUGH_MEMORY
-
-            node2 = NodeSecond(
-                ParentOffset=parent_offset,
-                ChildFID=new_fid,
-                ChildOffset=new_node_offset,
-                NextOffset=ZERO
-            )
-            fp.seek(new_node2_offset)
-            fp.write(struct.pack("<HHHH", node2.ParentOffset, node2.ChildFID,
-                                node2.ChildOffset, node2.NextOffset))
-            fp.flush()
-
             mf_node.NextOffset = new_node2_offset
-            fp.seek(parent_offset)
-            fp.write(struct.pack("<HHHHBHBH", mf_node.FID, mf_node.ChildFID, mf_node.ChildOffset,
-                                mf_node.Status, mf_node.Type, mf_node.FCPOffset,
-                                mf_node.FCP_total_size, mf_node.NextOffset))
+            write_changed(fp, parent_offset, old, pack_mf_node(mf_node))
             fp.flush()
             return SW_SUCCESS
 
-        current_offset = mf_node.NextOffset
-        while True:
-            fp.seek(current_offset)
-            node2_data = np.frombuffer(fp.read(struct.calcsize("<HHHH")), dtype=np.uint8)
-            if len(node2_data) != struct.calcsize("<HHHH"):
-                print("Failed to read NodeSecond")
-                return SW_MEMORY_FAILURE
-            node2 = NodeSecond(
-                ParentOffset=np.uint16((node2_data[0] << 8) | node2_data[1]),
-                ChildFID=np.uint16((node2_data[2] << 8) | node2_data[3]),
-                ChildOffset=np.uint16((node2_data[4] << 8) | node2_data[5]),
-                NextOffset=np.uint16((node2_data[6] << 8) | node2_data[7])
-            )
-
-            if node2.NextOffset == ZERO:
-                last_offset = current_offset
-                break
-            current_offset = node2.NextOffset
-
-        new_node2_offset = get_next_write_position(fp, struct.calcsize("<HHHH"))
-        if new_node2_offset == SW_NOT_ENOUGH_MEMORY:
-            return SW_NOT_ENOUGH_MEMORY
-
-        node2 = NodeSecond(
-            ParentOffset=parent_offset,
-            ChildFID=new_fid,
-            ChildOffset=new_node_offset,
-            NextOffset=ZERO
-        )
-        fp.seek(new_node2_offset)
-        fp.write(struct.pack("<HHHH", node2.ParentOffset, node2.ChildFID,
-                            node2.ChildOffset, node2.NextOffset))
-        fp.flush()
-
-        fp.seek(last_offset)
-        prev_node_data = np.frombuffer(fp.read(struct.calcsize("<HHHH")), dtype=np.uint8)
-        prev_node = NodeSecond(
-            ParentOffset=np.uint16((prev_node_data[0] << 8) | prev_node_data[1]),
-            ChildFID=np.uint16((prev_node_data[2] << 8) | prev_node_data[3]),
-            ChildOffset=np.uint16((prev_node_data[4] << 8) | prev_node_data[5]),
-            NextOffset=np.uint16((prev_node_data[6] << 8) | prev_node_data[7])
-        )
-        prev_node.NextOffset = new_node2_offset
-        fp.seek(last_offset)
-        fp.write(struct.pack("<HHHH", prev_node.ParentOffset, prev_node.ChildFID,
-                            prev_node.ChildOffset, prev_node.NextOffset))
-        fp.flush()
-
-        return SW_SUCCESS
+        return link_to_chain_tail(fp, mf_node.NextOffset, new_node2_offset)
     except:
-        print("Failed to add to MF chain")
+        print_message("Failed to add to MF chain")
         return SW_MEMORY_FAILURE
 
 
-def add_to_df_chain(fp, parent_offset: np.uint16, new_fid: np.uint16, new_node_offset: np.uint16) -> np.uint16:
+def add_to_df_chain(fp, parent_offset: int, new_fid: int, new_node_offset: int) -> int:
     try:
-        fp.seek(parent_offset)
-        df_node_data = np.frombuffer(fp.read(struct.calcsize("<HHHHBHHBH")), dtype=np.uint8)
-        if len(df_node_data) != struct.calcsize("<HHHHBHHBH"):
-            print("Failed to read DF/ADF node")
+        df_node = read_df_node(fp, parent_offset)
+        if df_node is None:
+            print_message("Failed to read DF/ADF node")
             return SW_MEMORY_FAILURE
-        df_node = DFADFNode(
-            FID=np.uint16((df_node_data[0] << 8) | df_node_data[1]),
-            ParentFID=np.uint16((df_node_data[2] << 8) | df_node_data[3]),
-            ParentOffset=np.uint16((df_node_data[4] << 8) | df_node_data[5]),
-            Type=df_node_data[6],
-            ChildFID=np.uint16((df_node_data[7] << 8) | df_node_data[8]),
-            ChildOffset=np.uint16((df_node_data[9] << 8) | df_node_data[10]),
-            FCPOffset=np.uint16((df_node_data[11] << 8) | df_node_data[12]),
-            FCP_total_size=df_node_data[13],
-            NextOffset=np.uint16((df_node_data[14] << 8) | df_node_data[15])
-        )
 
+        old = pack_df_node(df_node)
         if df_node.ChildFID == ZERO:
             df_node.ChildFID = new_fid
             df_node.ChildOffset = new_node_offset
-            fp.seek(parent_offset)
-            fp.write(struct.pack("<HHHHBHHBH", df_node.FID, df_node.ParentFID, df_node.ParentOffset,
-                                df_node.Type, df_node.ChildFID, df_node.ChildOffset,
-                                df_node.FCPOffset, df_node.FCP_total_size, df_node.NextOffset))
+            write_changed(fp, parent_offset, old, pack_df_node(df_node))
             fp.flush()
-            
-            fp.seek(parent_offset)
-            verify_node_data = np.frombuffer(fp.read(struct.calcsize("<HHHHBHHBH")), dtype=np.uint8)
             return SW_SUCCESS
 
-        current_offset = parent_offset
-        last_offset = C_NULL
+        new_node2_offset = append_node_second(fp, parent_offset, new_fid, new_node_offset)
+        if new_node2_offset == SW_NOT_ENOUGH_MEMORY:
+            return SW_NOT_ENOUGH_MEMORY
 
         if df_node.NextOffset == ZERO:
-            new_node2_offset = get_next_write_position(fp, struct.calcsize("<HHHH"))
-            if new_node2_offset == SW_NOT_ENOUGH_MEMORY:
-                return SW_NOT_ENOUGH_MEMORY
-
-            node2 = NodeSecond(
-                ParentOffset=parent_offset,
-                ChildFID=new_fid,
-                ChildOffset=new_node_offset,
-                NextOffset=ZERO
-            )
-            fp.seek(new_node2_offset)
-            fp.write(struct.pack("<HHHH", node2.ParentOffset, node2.ChildFID,
-                                node2.ChildOffset, node2.NextOffset))
-            fp.flush()
-
             df_node.NextOffset = new_node2_offset
-            fp.seek(parent_offset)
-            fp.write(struct.pack("<HHHHBHHBH", df_node.FID, df_node.ParentFID, df_node.ParentOffset,
-                                df_node.Type, df_node.ChildFID, df_node.ChildOffset,
-                                df_node.FCPOffset, df_node.FCP_total_size, df_node.NextOffset))
+            write_changed(fp, parent_offset, old, pack_df_node(df_node))
             fp.flush()
             return SW_SUCCESS
 
-        current_offset = df_node.NextOffset
-        while True:
-            fp.seek(current_offset)
-            node2_data = np.frombuffer(fp.read(struct.calcsize("<HHHH")), dtype=np.uint8)
-            if len(node2_data) != struct.calcsize("<HHHH"):
-                print("Failed to read NodeSecond")
-                return SW_MEMORY_FAILURE
-            node2 = NodeSecond(
-                ParentOffset=np.uint16((node2_data[0] << 8) | node2_data[1]),
-                ChildFID=np.uint16((node2_data[2] << 8) | node2_data[3]),
-                ChildOffset=np.uint16((node2_data[4] << 8) | node2_data[5]),
-                NextOffset=np.uint16((node2_data[6] << 8) | node2_data[7])
-            )
-
-            if node2.NextOffset == ZERO:
-                last_offset = current_offset
-                break
-            current_offset = node2.NextOffset
-
-        new_node2_offset = get_next_write_position(fp, struct.calcsize("<HHHH"))
-        if new_node2_offset == SW_NOT_ENOUGH_MEMORY:
-            return SW_NOT_ENOUGH_MEMORY
-
-        node2 = NodeSecond(
-            ParentOffset=parent_offset,
-            ChildFID=new_fid,
-            ChildOffset=new_node_offset,
-            NextOffset=ZERO
-        )
-        fp.seek(new_node2_offset)
-        fp.write(struct.pack("<HHHH", node2.ParentOffset, node2.ChildFID,
-                            node2.ChildOffset, node2.NextOffset))
-        fp.flush()
-
-        fp.seek(last_offset)
-        prev_node_data = np.frombuffer(fp.read(struct.calcsize("<HHHH")), dtype=np.uint8)
-        prev_node = NodeSecond(
-            ParentOffset=np.uint16((prev_node_data[0] << 8) | prev_node_data[1]),
-            ChildFID=np.uint16((prev_node_data[2] << 8) | prev_node_data[3]),
-            ChildOffset=np.uint16((prev_node_data[4] << 8) | prev_node_data[5]),
-            NextOffset=np.uint16((prev_node_data[6] << 8) | prev_node_data[7])
-        )
-        prev_node.NextOffset = new_node2_offset
-        fp.seek(last_offset)
-        fp.write(struct.pack("<HHHH", prev_node.ParentOffset, prev_node.ChildFID,
-                            prev_node.ChildOffset, prev_node.NextOffset))
-        fp.flush()
-
-        return SW_SUCCESS
+        return link_to_chain_tail(fp, df_node.NextOffset, new_node2_offset)
     except:
-        print("Failed to add to DF chain")
+        print_message("Failed to add to DF chain")
         return SW_MEMORY_FAILURE
 
-def check_duplicate_fid(fp, parent_offset: np.uint16, parent_fid: np.uint16, fid: np.uint16, type: np.uint8) -> np.uint16:
+def add_child(fp, parent_offset: int, parent_fid: int, new_fid: int, new_node_offset: int) -> int:
+    if get_image_version(fp) == IMAGE_FORMAT_V2:
+        return insert_child_entry(fp, parent_offset, new_fid, new_node_offset)
+    if parent_fid == MF_FID:
+        return add_to_mf_chain(fp, parent_offset, new_fid, new_node_offset)
+    return add_to_df_chain(fp, parent_offset, new_fid, new_node_offset)
+
+def check_duplicate_fid(fp, parent_offset: int, parent_fid: int, fid: int, type: int) -> int:
     if fid == parent_fid:
-        print(f"FID {fid:04X} cannot match parent FID {parent_fid:04X}")
+        print_message(f"FID {fid:04X} cannot match parent FID {parent_fid:04X}")
         return SW_FILE_ALREADY_EXIST
     if parent_fid == MF_FID:
         return check_fid_in_mf_and_children(fp, parent_offset, fid)
@@ -1730,7 +2319,7 @@ def check_duplicate_fid(fp, parent_offset: np.uint16, parent_fid: np.uint16, fid
     else:
         return check_duplicate_fid_df(fp, parent_offset, fid)
 
-def write_mf_node(fp, apdu: APDU) -> np.uint16:
+def write_mf_node(fp, apdu: APDU) -> int:
     if apdu.FID != MF_FID:
         print_infof("Invalid FID %04X for MF (must be 3F00)\n", "red", apdu.FID)
         return SW_DATA_INVALID
@@ -1739,35 +2328,32 @@ def write_mf_node(fp, apdu: APDU) -> np.uint16:
         FID=apdu.FID,
         ChildFID=ZERO,
         ChildOffset=ZERO,
-        Status=np.uint8(0x01),
+        Status=0x01,
         Type=IS_MF,
-        FCPOffset=MF_START_PTR + struct.calcsize("<HHHHBHBH"),
+        FCPOffset=MF_START_PTR + MF_NODE_SIZE,
         FCP_total_size=apdu.lc,
         NextOffset=ZERO
     )
     try:
         fp.seek(MF_START_PTR)
-        fp.write(struct.pack("<HHHHBHBH", mf_node.FID, mf_node.ChildFID, mf_node.ChildOffset,
-                            mf_node.Status, mf_node.Type, mf_node.FCPOffset,
-                            mf_node.FCP_total_size, mf_node.NextOffset))
-        
+        fp.write(pack_mf_node(mf_node))
+
         fp.seek(mf_node.FCPOffset)
-        fp.write(apdu.data[:mf_node.FCP_total_size].tobytes())
+        fp.write(bytes(apdu.data[:mf_node.FCP_total_size]))
         fp.flush()
 
-        mf_offset = np.uint16(MF_START_PTR)
-        fp.seek(ROOT_OFFSET_PTR)
-        fp.write(np.array([mf_offset], dtype=np.uint16).tobytes())
+        write_u16(fp, ROOT_OFFSET_PTR, MF_START_PTR)
+        set_image_version(fp, IMAGE_FORMAT_VERSION)
 
         update_write_cursor(fp, mf_node.FCPOffset + mf_node.FCP_total_size)
-        update_current_selection(fp, apdu.FID, MF_START_PTR, IS_MF, C_NULL, C_NULL, np.uint8(0xFF))
+        update_current_selection(fp, apdu.FID, MF_START_PTR, IS_MF, C_NULL, C_NULL, 0xFF)
         print_colored_text("MF created and selected\n", "green")
         return SW_SUCCESS
     except:
         print_colored_text("Failed to write MF node or FCP data\n", "red")
         return SW_MEMORY_FAILURE
 
-def write_df_adf_node(fp, apdu: APDU, new_file_offset: np.uint16, parent_offset: np.uint16, parent_fid: np.uint16) -> np.uint16:
+def write_df_adf_node(fp, apdu: APDU, new_file_offset: int, parent_offset: int, parent_fid: int) -> int:
     df_node = DFADFNode(
         FID=apdu.FID,
         ParentFID=parent_fid,
@@ -1775,49 +2361,47 @@ def write_df_adf_node(fp, apdu: APDU, new_file_offset: np.uint16, parent_offset:
         Type=apdu.type,
         ChildFID=ZERO,
         ChildOffset=ZERO,
-        FCPOffset=new_file_offset + struct.calcsize("<HHHHBHHBH"),
+        FCPOffset=new_file_offset + DF_NODE_SIZE,
         FCP_total_size=apdu.lc,
         NextOffset=ZERO
     )
     try:
         fp.seek(new_file_offset)
-        fp.write(struct.pack("<HHHHBHHBH", df_node.FID, df_node.ParentFID, df_node.ParentOffset,
-                            df_node.Type, df_node.ChildFID, df_node.ChildOffset,
-                            df_node.FCPOffset, df_node.FCP_total_size, df_node.NextOffset))
+        fp.write(pack_df_node(df_node))
         fp.flush()
         return SW_SUCCESS
     except:
-        print("Failed to write DF/ADF node")
+        print_message("Failed to write DF/ADF node")
         return SW_MEMORY_FAILURE
 
-def write_ef_node(fp, apdu: APDU, new_file_offset: np.uint16, parent_offset: np.uint16, parent_fid: np.uint16, data_offset: np.uint16) -> np.uint16:
+def write_ef_node(fp, apdu: APDU, new_file_offset: int, parent_offset: int, parent_fid: int, data_offset: int) -> int:
     ef_node = EFNode(
         FID=apdu.FID,
         ParentOffset=parent_offset,
         ParentFID=parent_fid,
         Type=apdu.type,
-        FCPOffset=new_file_offset + struct.calcsize("<HHHBHBH"),
+        FCPOffset=new_file_offset + EF_NODE_SIZE,
         FCP_total_size=apdu.lc,
         DataOffset=data_offset if apdu.fileSize > 0 else C_NULL
     )
     try:
         fp.seek(new_file_offset)
-        fp.write(struct.pack("<HHHBHBH", ef_node.FID, ef_node.ParentOffset, ef_node.ParentFID,
-                            ef_node.Type, ef_node.FCPOffset, ef_node.FCP_total_size, ef_node.DataOffset))
+        fp.write(pack_ef_node(ef_node))
         fp.flush()
 
-        if apdu.fileSize > 0:
-            record_buffer = np.full(apdu.fileSize, 0xFF, dtype=np.uint8)
+        # Fresh allocations come from the erased area, so the fill is usually a no-op
+        blank = b'\xff' * apdu.fileSize
+        if apdu.fileSize > 0 and fp.read_at(data_offset, apdu.fileSize) != blank:
             fp.seek(data_offset)
-            fp.write(record_buffer.tobytes())
+            fp.write(blank)
             fp.flush()
 
         return SW_SUCCESS
     except:
-        print("Failed to write EF node or data")
+        print_message("Failed to write EF node or data")
         return SW_MEMORY_FAILURE
 
-def create_file(apdu: APDU, fp) -> np.uint16:
+def create_file(apdu: APDU, fp) -> int:
     if apdu.type == IS_MF:
         root_res = get_root_offset(fp)
         if root_res.sw != SW_SUCCESS:
@@ -1845,27 +2429,27 @@ def create_file(apdu: APDU, fp) -> np.uint16:
 
     status = check_duplicate_fid(fp, parent.offset, parent.fid, apdu.FID, apdu.type)
     if status != SW_SUCCESS:
-        print(f"Duplicate FID {apdu.FID:04X} found or invalid. File creation rejected.")
+        print_message(f"Duplicate FID {apdu.FID:04X} found or invalid. File creation rejected.")
         return status
 
     if is_valid_ef_type(apdu.type) and apdu.sfi != 0x00:
         status = check_duplicate_sfi(fp, parent.offset, apdu.sfi, apdu.FID)
-        print(f"check_duplicate_sfi status: {status:04X}")
+        print_message(f"check_duplicate_sfi status: {status:04X}")
         if status != SW_SUCCESS:
-            print(f"Duplicate SFI {apdu.sfi:02X} found. EF creation rejected.")
+            print_message(f"Duplicate SFI {apdu.sfi:02X} found. EF creation rejected.")
             return status
 
     node_size = get_node_size(apdu.type)
-    total_size = np.uint16(node_size + apdu.lc)
+    total_size = node_size + apdu.lc
     if is_valid_ef_type(apdu.type):
         total_size += apdu.fileSize
 
     new_file_offset = get_next_write_position(fp, total_size)
     if new_file_offset == SW_NOT_ENOUGH_MEMORY:
-        print("Not enough memory for file creation")
+        print_message("Not enough memory for file creation")
         return SW_NOT_ENOUGH_MEMORY
 
-    fcp_offset = np.uint16(new_file_offset + node_size)
+    fcp_offset = new_file_offset + node_size
     data_offset = fcp_offset + apdu.lc
 
     if is_valid_df(apdu.type):
@@ -1879,14 +2463,16 @@ def create_file(apdu: APDU, fp) -> np.uint16:
     if status != SW_SUCCESS:
         return status
 
-    status = add_to_mf_chain(fp, parent.offset, apdu.FID, new_file_offset) if parent.fid == MF_FID else add_to_df_chain(fp, parent.offset, apdu.FID, new_file_offset)
+    status = add_child(fp, parent.offset, parent.fid, apdu.FID, new_file_offset)
     if status != SW_SUCCESS:
-        print(f"Failed to add file to parent chain: {status:04X}")
+        print_message(f"Failed to add file to parent chain: {status:04X}")
         return status
+    index_new_child(fp, parent.offset, apdu.FID, new_file_offset)
+    drop_access_rules(fp)  # the new file may be the EF.ARR a cached rule found missing
 
     if is_valid_df(apdu.type):
-        update_current_selection(fp, apdu.FID, new_file_offset, apdu.type, parent.fid, parent.offset, np.uint8(0xFF))
-        print(f"{'ADF' if apdu.type == IS_ADF else 'DF'} created and selected")
+        update_current_selection(fp, apdu.FID, new_file_offset, apdu.type, parent.fid, parent.offset, 0xFF)
+        print_message(f"{'ADF' if apdu.type == IS_ADF else 'DF'} created and selected")
     else:
         update_current_selection(fp, apdu.FID, new_file_offset, apdu.type, parent.fid, parent.offset,
                                 IS_MF if parent.fid == MF_FID else parent.type)
@@ -1895,6 +2481,2080 @@ def create_file(apdu: APDU, fp) -> np.uint16:
     return SW_SUCCESS
 
 
+# Record Files
+def get_ef_sfi(fid: int, fcp_data: bytes) -> Optional[int]:
+    sfi = find_fcp_tag(fcp_data, 0x88)
+    if sfi is None:
+        return fid & 0x1F
+    if len(sfi) == 0:
+        return None  # SFI explicitly not supported
+    return sfi[0] >> 3
+
+def resolve_ef(fp, sfi: int, access: int) -> Tuple[int, Optional[EFNode]]:
+    sel = current_selection()
+    if sfi == 0:
+        if sel.CurrentEF_FID == C_NULL or sel.CurrentEF_Offset == C_NULL:
+            print_colored_text("No current EF selected\n", "red")
+            return SW_COMMAND_NOT_ALLOWED, None
+        ef_node = read_ef_node(fp, sel.CurrentEF_Offset)
+        if ef_node is None:
+            return SW_MEMORY_FAILURE, None
+    else:
+        if sel.CurrentOffset == C_NULL:
+            return SW_COMMAND_NOT_ALLOWED, None
+        offset = get_directory_index(fp, sel.CurrentOffset).sfis.get(sfi, C_NULL)
+        if offset == C_NULL:
+            print_infof("No EF with SFI %02X under current directory\n", "red", sfi)
+            return SW_FILE_NOT_FOUND, None
+        ef_node = read_ef_node(fp, offset)
+        if ef_node is None:
+            return SW_MEMORY_FAILURE, None
+        update_current_selection(fp, ef_node.FID, offset, ef_node.Type, sel.CurrentFID, sel.CurrentOffset, sel.CurrentFileType)
+    if not check_access(fp, sel.CurrentEF_Offset, access):
+        print_infof("Access to EF %04X denied\n", "red", ef_node.FID)
+        return SW_SECURITY_STATUS_NOT_SATISFIED, None
+    return SW_SUCCESS, ef_node
+
+def resolve_record_ef(fp, sfi: int, access: int) -> Tuple[int, Optional[EFNode]]:
+    sw, ef_node = resolve_ef(fp, sfi, access)
+    if sw == SW_SUCCESS and not is_record_ef(ef_node.Type):
+        return SW_COMMAND_IMCOMPATIBLE, None
+    return sw, ef_node
+
+def get_record_layout(fp, ef_node: EFNode) -> Tuple[int, int]:
+    record_len = [0]
+    file_size = [0]
+    if not extract_fcp_info(fp, ef_node, record_len, file_size) or record_len[0] == 0:
+        return 0, 0
+    return record_len[0], file_size[0] // record_len[0]
+
+def get_record_number(ef_node: EFNode, mode: int, p1: int, record_count: int) -> int:
+    sel = current_selection()
+    cyclic = ef_node.Type in [EF_CYCLIC_SHAREABLE, EF_CYCLIC_UNSHAREABLE]
+    if mode == ABS_CURR:
+        return p1 if p1 != 0 else sel.record_pointer
+    if mode == NEXT:
+        number = 1 if sel.record_pointer == 0xFF else sel.record_pointer + 1
+        return 1 if cyclic and number > record_count else number
+    if mode == PREVIOUS:
+        number = record_count if sel.record_pointer == 0xFF else sel.record_pointer - 1
+        return record_count if cyclic and number < 1 else number
+    return -1
+
+def get_search_order(mode: int, start: int, record_count: int) -> List[int]:
+    if mode == SEARCH_FORWARD:
+        return list(range(start, record_count + 1))
+    if mode == SEARCH_BACKWARD:
+        return list(range(start, 0, -1))
+    if mode == SEARCH_FROM_NEXT:
+        return list(range(start + 1, record_count + 1))
+    if mode == SEARCH_FROM_PREVIOUS:
+        return list(range(start - 1, 0, -1))
+    return []
+
+def find_matching_records(area: bytes, record_size: int, record_count: int, pattern: bytes,
+                          offset: int = 0, after_value: Optional[int] = None) -> List[bool]:
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+
+    if np is None:
+        matches = []
+        for i in range(record_count):
+            record = area[i * record_size:(i + 1) * record_size]
+            start = offset
+            if after_value is not None:
+                start = record.find(bytes([after_value])) + 1
+                if start == 0:
+                    matches.append(False)
+                    continue
+            matches.append(record.find(pattern, start) >= 0)
+        return matches
+
+    # View the record area as an (n_records x record_size) matrix. hits[r, p] says whether
+    # the pattern starts at position offset + p of record r; each pattern byte is one
+    # column-slice comparison across all records at once.
+    records = np.frombuffer(area, dtype=np.uint8, count=record_count * record_size).reshape(record_count, record_size)
+    positions = record_size - offset - len(pattern) + 1
+    if positions <= 0:
+        return [False] * record_count
+    hits = records[:, offset:offset + positions] == pattern[0]
+    for k in range(1, len(pattern)):
+        hits &= records[:, offset + k:offset + k + positions] == pattern[k]
+    if after_value is not None:
+        found = records == after_value
+        first = np.where(found.any(axis=1), found.argmax(axis=1) + 1, record_size + 1)
+        hits &= np.arange(hits.shape[1]) >= first[:, None]
+    return hits.any(axis=1).tolist()
+
+def search_record(apdu: APDU, fp) -> Tuple[int, bytes]:
+    sel = current_selection()
+    sw, ef_node = resolve_record_ef(fp, apdu.p2 >> 3, ACCESS_READ)
+    if sw != SW_SUCCESS:
+        return sw, b""
+
+    record_size, record_count = get_record_layout(fp, ef_node)
+    if record_count == 0:
+        return SW_RECORD_NOT_FOUND, b""
+
+    data = bytes(apdu.data[:apdu.lc])
+    mode = apdu.p2 & 0x07
+    offset = 0
+    after_value = None
+    if mode in [SEARCH_FORWARD, SEARCH_BACKWARD]:
+        pattern = data
+    elif mode == SEARCH_ENHANCED:
+        if len(data) < 2:
+            return SW_WRONG_LENGTH, b""
+        indication, position = data[0], data[1]
+        mode = indication & 0x07
+        if mode not in [SEARCH_FORWARD, SEARCH_BACKWARD, SEARCH_FROM_NEXT, SEARCH_FROM_PREVIOUS] or indication & 0xF0:
+            return SW_DATA_INVALID, b""
+        if indication & SEARCH_FROM_VALUE:
+            after_value = position
+        else:
+            offset = position
+        pattern = data[2:]
+    else:
+        return SW_INCORRECT_P1P2, b""
+
+    if len(pattern) == 0:
+        return SW_WRONG_LENGTH, b""
+    if offset >= record_size:
+        return SW_DATA_INVALID, b""
+
+    start = apdu.p1
+    if start == 0:
+        if sel.record_pointer == 0xFF and mode in [SEARCH_FROM_NEXT, SEARCH_FROM_PREVIOUS]:
+            return SW_RECORD_NOT_FOUND, b""
+        start = sel.record_pointer if sel.record_pointer != 0xFF else (1 if mode == SEARCH_FORWARD else record_count)
+    if start > record_count:
+        return SW_RECORD_NOT_FOUND, b""
+
+    area = fp.read_at(ef_node.DataOffset, record_size * record_count)
+    if len(area) != record_size * record_count:
+        return SW_MEMORY_FAILURE, b""
+    matches = find_matching_records(area, record_size, record_count, pattern, offset, after_value)
+
+    found = [number for number in get_search_order(mode, start, record_count) if matches[number - 1]]
+    if found:
+        sel.record_pointer = found[0]
+    return SW_SUCCESS, bytes(found)
+
+def read_record(apdu: APDU, fp) -> Tuple[int, bytes]:
+    sel = current_selection()
+    sw, ef_node = resolve_record_ef(fp, apdu.p2 >> 3, ACCESS_READ)
+    if sw != SW_SUCCESS:
+        return sw, b""
+
+    record_size, record_count = get_record_layout(fp, ef_node)
+    mode = apdu.p2 & 0x07
+    number = get_record_number(ef_node, mode, apdu.p1, record_count)
+    if number == -1:
+        return SW_INCORRECT_P1P2, b""
+    if number == 0xFF or number < 1 or number > record_count:
+        return SW_RECORD_NOT_FOUND, b""
+
+    record = fp.read_at(ef_node.DataOffset + (number - 1) * record_size, record_size)
+    if len(record) != record_size:
+        return SW_MEMORY_FAILURE, b""
+    if mode != ABS_CURR or apdu.p1 == 0:
+        sel.record_pointer = number
+    if 0 < apdu.le < record_size:
+        return BAD_LENGTH | (record_size & 0xFF), b""
+    return SW_SUCCESS, record
+
+def update_record(apdu: APDU, fp) -> Tuple[int, bytes]:
+    sel = current_selection()
+    sw, ef_node = resolve_record_ef(fp, apdu.p2 >> 3, ACCESS_UPDATE)
+    if sw != SW_SUCCESS:
+        return sw, b""
+
+    record_size, record_count = get_record_layout(fp, ef_node)
+    mode = apdu.p2 & 0x07
+    number = get_record_number(ef_node, mode, apdu.p1, record_count)
+    if number == -1:
+        return SW_INCORRECT_P1P2, b""
+    if number == 0xFF or number < 1 or number > record_count:
+        return SW_RECORD_NOT_FOUND, b""
+    if apdu.lc != record_size:
+        return SW_WRONG_LENGTH, b""
+
+    fp.write_at(ef_node.DataOffset + (number - 1) * record_size, bytes(apdu.data[:apdu.lc]))
+    fp.flush()
+    if sel.CurrentEF_Offset in fp.arr_offsets:
+        drop_access_rules(fp)
+    if mode != ABS_CURR or apdu.p1 == 0:
+        sel.record_pointer = number
+    return SW_SUCCESS, b""
+
+
+# Transparent Files
+def get_binary_target(fp, apdu: APDU, access: int) -> Tuple[int, Optional[EFNode], int]:
+    if apdu.p1 & 0x80:
+        if apdu.p1 & 0x60:
+            return SW_INCORRECT_P1P2, None, 0
+        sfi, offset = apdu.p1 & 0x1F, apdu.p2
+    else:
+        sfi, offset = 0, (apdu.p1 << 8) | apdu.p2
+    sw, ef_node = resolve_ef(fp, sfi, access)
+    if sw == SW_SUCCESS and ef_node.Type not in [EF_TRANSPARENT_SHAREABLE, EF_TRANSPARENT_UNSHAREABLE]:
+        return SW_COMMAND_IMCOMPATIBLE, None, 0
+    return sw, ef_node, offset
+
+def get_transparent_size(fp, ef_node: EFNode) -> int:
+    record_len = [0]
+    file_size = [0]
+    if not extract_fcp_info(fp, ef_node, record_len, file_size):
+        return 0
+    return file_size[0]
+
+def read_binary(apdu: APDU, fp) -> Tuple[int, bytes]:
+    sw, ef_node, offset = get_binary_target(fp, apdu, ACCESS_READ)
+    if sw != SW_SUCCESS:
+        return sw, b""
+
+    file_size = get_transparent_size(fp, ef_node)
+    if offset >= file_size:
+        return WRONG_PARAMETER, b""
+    available = file_size - offset
+    length = available if apdu.le == 0 else min(apdu.le, available)
+    data = fp.read_at(ef_node.DataOffset + offset, length)
+    if len(data) != length:
+        return SW_MEMORY_FAILURE, b""
+    # Le of all zeros asks for "as much as possible", so only an explicit Ne can overrun
+    if apdu.le > available and apdu.le not in [MAX_SHORT_DATA_SIZE + 1, MAX_EXTENDED_DATA_SIZE + 1]:
+        return SW_END_OF_FILE_REACHED, data
+    return SW_SUCCESS, data
+
+def update_binary(apdu: APDU, fp) -> Tuple[int, bytes]:
+    sw, ef_node, offset = get_binary_target(fp, apdu, ACCESS_UPDATE)
+    if sw != SW_SUCCESS:
+        return sw, b""
+
+    file_size = get_transparent_size(fp, ef_node)
+    if offset >= file_size:
+        return WRONG_PARAMETER, b""
+    if apdu.lc == 0 or offset + apdu.lc > file_size:
+        return SW_WRONG_LENGTH, b""
+    fp.write_at(ef_node.DataOffset + offset, bytes(apdu.data[:apdu.lc]))
+    fp.flush()
+    if current_selection().CurrentEF_Offset in fp.arr_offsets:
+        drop_access_rules(fp)
+    return SW_SUCCESS, b""
+
+
+# Access Control
+def get_pin_bit(key_reference: int) -> int:
+    # Global PINs (01-1F) take the low bits, specific ones (81-9F) the next 32
+    return 1 << ((key_reference & 0x1F) + (32 if key_reference & 0x80 else 0))
+
+def iter_tlvs(data: bytes) -> List[Tuple[int, bytes]]:
+    tlvs = []
+    pos = 0
+    while pos + 2 <= len(data) and data[pos] not in [0x00, 0xFF]:  # records are padded with FF
+        length = data[pos + 1]
+        if pos + 2 + length > len(data):
+            break
+        tlvs.append((data[pos], data[pos + 2:pos + 2 + length]))
+        pos += 2 + length
+    return tlvs
+
+def compile_security_condition(tag: int, value: bytes) -> List[int]:
+    # A condition becomes the PIN bitmasks that satisfy it: [0] is ALWAYS, [] is NEVER
+    if tag == 0x90:
+        return [0]
+    if tag == 0xA4:
+        key_reference = dict(iter_tlvs(value)).get(0x83)
+        return [get_pin_bit(key_reference[0])] if key_reference and len(key_reference) == 1 else []
+    if tag == 0xA0:  # OR template
+        return [mask for inner_tag, inner in iter_tlvs(value) for mask in compile_security_condition(inner_tag, inner)]
+    if tag == 0xAF:  # AND template
+        masks = [0]
+        for inner_tag, inner in iter_tlvs(value):
+            masks = [mask | other for mask in masks for other in compile_security_condition(inner_tag, inner)]
+        return masks
+    return []  # NEVER (97) and secure messaging conditions, which this card cannot satisfy
+
+def compile_access_rule(record: bytes, arr_offset: int) -> AccessRule:
+    # Expanded format: each AM_DO applies to the SC_DOs after it, any one of which suffices
+    read, update = set(), set()
+    access_mode = 0
+    for tag, value in iter_tlvs(record):
+        if tag == 0x80:
+            access_mode = value[0] if len(value) == 1 else 0
+        elif 0x81 <= tag <= 0x8F:
+            access_mode = 0  # command header AM_DOs do not cover READ/UPDATE here
+        else:
+            masks = compile_security_condition(tag, value)
+            if access_mode & ACCESS_READ:
+                read.update(masks)
+            if access_mode & ACCESS_UPDATE:
+                update.update(masks)
+    return AccessRule(tuple(sorted(read)), tuple(sorted(update)), arr_offset)
+
+def find_arr_file(fp, dir_offset: int, arr_fid: int) -> int:
+    # EF.ARR is looked up in the file's directory first, then in each parent up to the MF
+    visited = set()
+    while dir_offset not in visited and dir_offset != C_NULL and dir_offset < FILE_SIZE:
+        visited.add(dir_offset)
+        offset = get_directory_index(fp, dir_offset).fids.get(arr_fid, C_NULL)
+        if offset != C_NULL:
+            return offset
+        node = read_directory_node(fp, dir_offset)
+        if isinstance(node, MFNode):
+            break
+        dir_offset = node.ParentOffset
+    return C_NULL
+
+def compile_file_access_rule(fp, ef_offset: int) -> AccessRule:
+    entry = read_node_region(fp, ef_offset)
+    reference = find_fcp_tag(entry.fcp, 0x8B)
+    if reference is None:
+        return AccessRule((0,), (0,))
+    if len(reference) != 3:
+        # A corrupt security attribute locks the file rather than opening it
+        print_infof("EF %04X has a malformed 8B security attribute\n", "red", entry.node.FID)
+        return AccessRule((), ())
+    arr_fid, number = (reference[0] << 8) | reference[1], reference[2]
+    arr_offset = find_arr_file(fp, entry.node.ParentOffset, arr_fid)
+    arr_node = read_ef_node(fp, arr_offset) if arr_offset != C_NULL else None
+    if arr_node is None or not is_record_ef(arr_node.Type):
+        # Images without the referenced EF.ARR predate access control and stay open
+        return AccessRule((0,), (0,))
+    record_size, record_count = get_record_layout(fp, arr_node)
+    if number < 1 or number > record_count:
+        print_infof("EF %04X refers to missing rule %d of EF.ARR %04X\n", "red", entry.node.FID, number, arr_fid)
+        return AccessRule((), (), arr_offset)
+    record = fp.read_at(arr_node.DataOffset + (number - 1) * record_size, record_size)
+    if not iter_tlvs(record):
+        return AccessRule((0,), (0,), arr_offset)  # erased rule, so a new EF.ARR can be personalised
+    return compile_access_rule(record, arr_offset)
+
+def get_access_rule(fp, ef_offset: int) -> AccessRule:
+    # Compiled once per file, on first selection, and kept under a lock like the
+    # directory indexes; rewriting an EF.ARR or the generation moving drops them all
+    if not fp.lock_depth:
+        return compile_file_access_rule(fp, ef_offset)
+    rule = fp.access_rules.get(ef_offset)
+    if rule is None:
+        rule = compile_file_access_rule(fp, ef_offset)
+        fp.access_rules[ef_offset] = rule
+        if rule.arr_offset != C_NULL:
+            fp.arr_offsets.add(rule.arr_offset)
+    return rule
+
+def drop_access_rules(fp):
+    fp.access_rules.clear()
+    fp.arr_offsets.clear()
+
+def check_access(fp, ef_offset: int, access: int) -> bool:
+    rule = get_access_rule(fp, ef_offset)
+    verified = current_session().verified_pins
+    for mask in rule.read if access == ACCESS_READ else rule.update:
+        if mask & ~verified == 0:
+            return True
+    return False
+
+def verify_pin(apdu: APDU, fp) -> Tuple[int, bytes]:
+    if apdu.p1 != 0x00:
+        return SW_INCORRECT_P1P2, b""
+    pin = PINS.get(apdu.p2)
+    if pin is None:
+        return SW_REFERENCED_DATA_NOT_FOUND, b""
+    bit = get_pin_bit(apdu.p2)
+    session = current_session()
+    # Tries are counted per card, so reconnecting or resetting never restores them
+    with fp.pin_lock, session.lock:
+        retries = fp.pin_retries.get(apdu.p2, PIN_MAX_RETRIES)
+        if apdu.lc == 0:
+            # No data: report the verification status instead of checking a PIN
+            return (SW_SUCCESS if session.verified_pins & bit else SW_VERIFY_FAILED | retries), b""
+        if apdu.lc != PIN_LENGTH:
+            return SW_WRONG_LENGTH, b""
+        if retries == 0:
+            return SW_AUTH_METHOD_BLOCKED, b""
+        if not hmac.compare_digest(bytes(apdu.data[:apdu.lc]), pin.ljust(PIN_LENGTH, b"\xff")):
+            fp.pin_retries[apdu.p2] = retries - 1
+            session.verified_pins &= ~bit
+            print_infof("Wrong PIN %02X, %d tries left\n", "red", apdu.p2, retries - 1)
+            return SW_VERIFY_FAILED | (retries - 1), b""
+        fp.pin_retries[apdu.p2] = PIN_MAX_RETRIES
+        session.verified_pins |= bit
+    return SW_SUCCESS, b""
+
+
+# Command Processing
+def new_apdu() -> APDU:
+    return APDU(cla=0, ins=0, p1=0, p2=0, lc=0, data=bytearray(), data_len=0, le=0,
+                type=0, FID=C_NULL, fileSize=0, RecordSize=0, NumberOfRecords=0, sfi=0)
+
+def reset_apdu(apdu: APDU) -> APDU:
+    # Everything CREATE FILE derives from the FCP must not leak into the next command
+    apdu.cla = apdu.ins = apdu.p1 = apdu.p2 = 0
+    apdu.lc = apdu.data_len = apdu.le = 0
+    apdu.type = apdu.fileSize = apdu.RecordSize = apdu.NumberOfRecords = apdu.sfi = 0
+    apdu.FID = C_NULL
+    return apdu
+
+def parse_apdu(raw: bytes, apdu: Optional[APDU] = None) -> Tuple[int, Optional[APDU]]:
+    # ISO 7816-4 cases 1-4, short (Lc/Le one byte) and extended (00 + two bytes each).
+    # Decodes into apdu when given, so a session reuses one object and data buffer.
+    if len(raw) < 4 or len(raw) > MAX_APDU_SIZE:
+        return SW_WRONG_LENGTH, None
+    apdu = new_apdu() if apdu is None else reset_apdu(apdu)
+    apdu.cla, apdu.ins, apdu.p1, apdu.p2 = raw[0], raw[1], raw[2], raw[3]
+    body = raw[4:]
+    data = b""
+    if len(body) == 1:
+        apdu.le = body[0] or MAX_SHORT_DATA_SIZE + 1
+    elif len(body) > 1 and body[0] != 0:
+        lc = body[0]
+        if len(body) not in [1 + lc, 2 + lc]:
+            return SW_WRONG_LENGTH, None
+        data = body[1:1 + lc]
+        if len(body) == 2 + lc:
+            apdu.le = body[-1] or MAX_SHORT_DATA_SIZE + 1
+    elif len(body) == 3:
+        apdu.le = int.from_bytes(body[1:3], "big") or MAX_EXTENDED_DATA_SIZE + 1
+    elif len(body) > 3:
+        lc = int.from_bytes(body[1:3], "big")
+        if lc == 0 or len(body) not in [3 + lc, 5 + lc]:
+            return SW_WRONG_LENGTH, None
+        data = body[3:3 + lc]
+        if len(body) == 5 + lc:
+            apdu.le = int.from_bytes(body[-2:], "big") or MAX_EXTENDED_DATA_SIZE + 1
+    elif len(body) != 0:
+        return SW_WRONG_LENGTH, None
+    apdu.data[:] = data
+    apdu.lc = apdu.data_len = len(data)
+    return SW_SUCCESS, apdu
+
+def select_file(apdu: APDU, fp) -> Tuple[int, bytes]:
+    sel = current_selection()
+    if apdu.p1 == 0x04:
+        # Selection by DF name: applications live directly under the MF
+        if apdu.p2 & 0x03:
+            return SW_FUNC_NOT_SUPPORTED, b""
+        if apdu.lc == 0 or apdu.lc > 16:
+            return SW_WRONG_LENGTH, b""
+        fid = C_NULL
+    elif apdu.p1 != 0x00:
+        return SW_FUNC_NOT_SUPPORTED, b""
+    elif apdu.lc != 2:
+        return SW_WRONG_LENGTH, b""
+    else:
+        fid = (apdu.data[0] << 8) | apdu.data[1]
+
+    root_res = get_root_offset(fp)
+    if root_res.sw != SW_SUCCESS or root_res.value == C_NULL:
+        return SW_FILE_NOT_FOUND, b""
+    offset, parent_fid, parent_offset = C_NULL, C_NULL, C_NULL
+    if apdu.p1 == 0x04:
+        offset = find_df_by_name(fp, root_res.value, bytes(apdu.data[:apdu.lc]))
+        if offset != C_NULL:
+            fid = read_u16(fp, offset)
+    elif fid == MF_FID:
+        offset = root_res.value
+    elif sel.CurrentOffset != C_NULL:
+        # Search order: current DF, its children, its parent, then the parent's children
+        current = read_directory_node(fp, sel.CurrentOffset)
+        if fid == sel.CurrentFID:
+            offset = sel.CurrentOffset
+        else:
+            offset = get_directory_index(fp, sel.CurrentOffset).fids.get(fid, C_NULL)
+            parent_fid, parent_offset = sel.CurrentFID, sel.CurrentOffset
+        if offset == C_NULL and sel.CurrentFileType in [IS_DF, IS_ADF]:
+            if fid == current.ParentFID:
+                offset = current.ParentOffset
+            else:
+                offset = get_directory_index(fp, current.ParentOffset).fids.get(fid, C_NULL)
+                parent_fid, parent_offset = current.ParentFID, current.ParentOffset
+    if offset == C_NULL:
+        return SW_FILE_NOT_FOUND, b""
+
+    entry = read_node_region(fp, offset)
+    if is_valid_ef_type(entry.node.Type):
+        parent_type = IS_MF if parent_fid == MF_FID else read_u8(fp, parent_offset + 6)
+        update_current_selection(fp, fid, offset, entry.node.Type, parent_fid, parent_offset, parent_type)
+        get_access_rule(fp, offset)
+    else:
+        update_current_selection(fp, fid, offset, entry.node.Type, C_NULL, C_NULL, 0xFF)
+
+    if apdu.p2 & 0x0C == 0x0C:
+        return SW_SUCCESS, b""
+    return SW_SUCCESS, bytes(entry.fcp)
+
+def get_logical_channel(cla: int) -> int:
+    # First interindustry CLA codes channels 0-3 in b2-b1, further interindustry 4-19 in b4-b1
+    if cla & 0x40:
+        return 4 + (cla & 0x0F)
+    return cla & 0x03
+
+def manage_channel(apdu: APDU, fp) -> Tuple[int, bytes]:
+    origin = get_logical_channel(apdu.cla)
+    session = current_session()
+    channels = session.channels
+    if apdu.lc != 0:
+        return SW_WRONG_LENGTH, b""
+
+    if apdu.p1 == 0x00:
+        if apdu.p2 >= MAX_LOGICAL_CHANNELS:
+            return SW_INCORRECT_P1P2, b""
+        with session.lock:
+            if apdu.p2 == 0:
+                free = [n for n in range(1, MAX_LOGICAL_CHANNELS) if channels[n] is None]
+                if not free:
+                    return SW_FUNC_NOT_SUPPORTED, b""
+                channel = free[0]
+            elif channels[apdu.p2] is not None:
+                return SW_INCORRECT_P1P2, b""
+            else:
+                channel = apdu.p2
+
+            # Opened from the basic channel the new channel starts at the MF,
+            # otherwise it inherits the selection of the channel it was opened from
+            if origin == 0:
+                state = SelectionState()
+                root_offset = read_u16(fp, ROOT_OFFSET_PTR)
+                if root_offset != C_NULL:
+                    state.CurrentFID, state.CurrentOffset, state.CurrentFileType = MF_FID, root_offset, IS_MF
+            else:
+                sel = current_selection()
+                state = SelectionState(sel.CurrentFID, sel.CurrentOffset, sel.CurrentFileType,
+                                       sel.ParentFID, sel.ParentOffset, sel.CurrentEF_FID,
+                                       sel.CurrentEF_Offset, sel.CurrentEF_Type, sel.record_pointer)
+            channels[channel] = state
+        return SW_SUCCESS, bytes([channel]) if apdu.p2 == 0 else b""
+
+    if apdu.p1 == 0x80:
+        channel = apdu.p2 if apdu.p2 != 0 else origin
+        if channel == 0 or channel >= MAX_LOGICAL_CHANNELS:
+            return SW_INCORRECT_P1P2, b""
+        with session.lock:
+            if channels[channel] is None:
+                return SW_LOGICAL_CHANNEL_NOT_SUPPORTED, b""
+            channels[channel] = None
+        return SW_SUCCESS, b""
+
+    return SW_INCORRECT_P1P2, b""
+
+def get_response(apdu: APDU) -> Tuple[int, bytes]:
+    sel = current_selection()
+    if apdu.p1 != 0 or apdu.p2 != 0:
+        return SW_INCORRECT_P1P2, b""
+    if not sel.pending_response:
+        return SW_CONDITIONS_NOT_SATISFIED, b""
+    ne = apdu.le or MAX_SHORT_DATA_SIZE + 1
+    data, sel.pending_response = sel.pending_response[:ne], sel.pending_response[ne:]
+    if sel.pending_response:
+        return SW_RESPONSE_BYTES_AVAILABLE | (min(len(sel.pending_response), 256) & 0xFF), data
+    return SW_SUCCESS, data
+
+def queue_response(apdu: APDU, sw: int, data: bytes) -> Tuple[int, bytes]:
+    # Anything beyond Ne (all of it when Le was absent) waits for GET RESPONSE
+    sel = current_selection()
+    if sw != SW_SUCCESS or len(data) <= apdu.le:
+        return sw, data
+    sel.pending_response = data[apdu.le:]
+    return SW_RESPONSE_BYTES_AVAILABLE | (min(len(sel.pending_response), 256) & 0xFF), data[:apdu.le]
+
+def create_file_command(apdu: APDU, fp) -> Tuple[int, bytes]:
+    if apdu.lc < 2 or apdu.lc > MAX_SHORT_DATA_SIZE:
+        return SW_WRONG_LENGTH, b""
+    status = process_mf_df_ef(bytes(apdu.data[2:apdu.lc]), apdu.lc - 2, apdu)
+    if status == SW_SUCCESS:
+        status = create_file(apdu, fp)
+    return status, b""
+
+COMMAND_HANDLERS = {
+    INS_CREATE_FILE: create_file_command,
+    INS_SELECT_FILE: select_file,
+    INS_READ_BINARY: read_binary,
+    INS_UPDATE_BINARY: update_binary,
+    INS_READ_RECORD: read_record,
+    INS_UPDATE_RECORD: update_record,
+    INS_SEARCH_RECORD: search_record,
+    INS_MANAGE_CHANNEL: manage_channel,
+    INS_VERIFY: verify_pin,
+}
+
+def get_exception_status(exc: Exception) -> int:
+    for exc_type, sw in EXCEPTION_STATUS_WORDS:
+        if isinstance(exc, exc_type):
+            return sw
+    return SW_TECHNICAL_PROBLEM
+
+def process_command(apdu: APDU, fp) -> Tuple[int, bytes]:
+    if apdu.cla == 0xFF:
+        return SW_CLA_NOT_SUPPORTED, b""
+    handler = COMMAND_HANDLERS.get(apdu.ins)
+    if handler is None:
+        return SW_INS_NOT_SUPPORTED, b""
+    try:
+        return handler(apdu, fp)
+    except Exception as exc:
+        channel_context.last_error = exc
+        sw = get_exception_status(exc)
+        print_infof("INS %02X failed (%s: %s), returning %04X\n", "red", apdu.ins, type(exc).__name__, exc, sw)
+        return sw, b""
+
+def process_apdu(raw: bytes, fp, apdu: Optional[APDU] = None) -> Tuple[int, bytes]:
+    sw, data = route_apdu(raw, fp, apdu)
+    if active_trace is not None:
+        active_trace.record(raw, sw, data)
+    return sw, data
+
+def route_apdu(raw: bytes, fp, apdu: Optional[APDU] = None) -> Tuple[int, bytes]:
+    sw, apdu = parse_apdu(raw, apdu)
+    if sw != SW_SUCCESS:
+        return sw, b""
+    channel = get_logical_channel(apdu.cla)
+    channels = current_session().channels
+    sel = channels[channel]
+    if sel is None:
+        return SW_LOGICAL_CHANNEL_NOT_SUPPORTED, b""
+    # Commands on one channel run in order; different channels only meet at the storage lock
+    with sel.lock:
+        if channels[channel] is not sel:
+            return SW_LOGICAL_CHANNEL_NOT_SUPPORTED, b""
+        previous = getattr(channel_context, "state", None)
+        channel_context.state = sel
+        try:
+            return process_channel_apdu(apdu, fp)
+        finally:
+            channel_context.state = previous
+
+def process_channel_apdu(apdu: APDU, fp) -> Tuple[int, bytes]:
+    sel = current_selection()
+    if apdu.ins == INS_GET_RESPONSE:
+        return get_response(apdu)
+    sel.pending_response = b""
+
+    header = (apdu.cla & ~CLA_CHAINING, apdu.ins, apdu.p1, apdu.p2)
+    if sel.chain_header is not None and header != sel.chain_header:
+        sel.chain_header, sel.chain_data = None, bytearray()
+        return SW_LAST_COMMAND_EXPECTED, b""
+    if apdu.cla & CLA_CHAINING:
+        if len(sel.chain_data) + apdu.lc > MAX_EXTENDED_DATA_SIZE:
+            sel.chain_header, sel.chain_data = None, bytearray()
+            return SW_WRONG_LENGTH, b""
+        sel.chain_header = header
+        sel.chain_data += apdu.data
+        return SW_SUCCESS, b""
+    if sel.chain_header is not None:
+        apdu.data[:0] = sel.chain_data  # in place, the session keeps reusing this buffer
+        apdu.lc = apdu.data_len = len(apdu.data)
+        sel.chain_header, sel.chain_data = None, bytearray()
+    apdu.cla = header[0]
+
+    wear = fp.wear
+    if wear is not None:
+        wear.begin(apdu.ins, apdu.lc)
+    try:
+        with image_lock(fp, exclusive=apdu.ins not in READ_ONLY_INS):
+            sw, data = process_command(apdu, fp)
+    finally:
+        if wear is not None:
+            wear.end()
+    # With group commit the answer to a write waits for its sync, outside the image lock
+    if apdu.ins not in READ_ONLY_INS and not fp.wait_durable(fp.commit_ticket()):
+        return SW_MEMORY_FAILURE, b""
+    return queue_response(apdu, sw, data)
+
+
+# Front Ends
+class Interpreter:
+    # One per session: the REPL, batch runner and TCP server all decode into the
+    # same APDU object and input buffer for every command they execute, and each
+    # session powers up with its own channels and PIN status
+    def __init__(self, fp):
+        self.fp = fp
+        self.apdu = new_apdu()
+        self.buffer = bytearray(MAX_APDU_SIZE)
+        self.session = CardSession()
+        with bound_session(self.session):
+            handle_power_up_selection(fp)
+
+    def execute(self, raw: bytes) -> Tuple[int, bytes]:
+        with bound_session(self.session):
+            return process_apdu(raw, self.fp, self.apdu)
+
+    def execute_line(self, line: str, special_commands: bool = True) -> Optional[Tuple[int, bytes]]:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            return None
+        if special_commands:
+            with bound_session(self.session):
+                if handle_special_commands(line, self.fp, self.apdu):
+                    return None
+        length = parse_hex_string(line, self.buffer, MAX_APDU_SIZE)
+        if length < 0:
+            print_colored_text("Invalid hex input\n", "red")
+            return ZERO, b""
+        with memoryview(self.buffer) as view:
+            return self.execute(view[:length])
+
+def print_response(sw: int, data: bytes):
+    if data:
+        print_infof("Response: %s\n", "green", bytes(data).hex(" ").upper())
+    ok = sw == SW_SUCCESS or sw & 0xFF00 == SW_RESPONSE_BYTES_AVAILABLE
+    print_infof("SW: %04X (%s)\n", "green" if ok else "red", sw, get_status_description(sw))
+
+def start_card(path: str = FILE_NAME, backend: str = STORAGE_BACKEND, group_commit: Optional[str] = None,
+               index_path: Optional[str] = None) -> Storage:
+    # group_commit: None flushes on every write, "durable" or "fast-ack" share syncs between sessions;
+    # index_path names a sidecar the directory indexes are loaded from and saved to
+    fp = initialize_smartcard_file(backend, path)
+    if group_commit is not None:
+        if group_commit not in ["durable", "fast-ack"]:
+            raise ValueError(f"Unknown group commit mode '{group_commit}'")
+        fp = GroupCommitStorage(fp, durable=group_commit == "durable")
+    fp.index_path = index_path
+    return fp
+
+def run_repl(interpreter: Interpreter):
+    print_colored_text("Enter an APDU in hex, memory, apdu, clear or reset; exit to quit\n", "cyan")
+    while True:
+        try:
+            line = input("APDU> ")
+        except EOFError:
+            break
+        if line.strip().lower() in ["exit", "quit"]:
+            break
+        result = interpreter.execute_line(line)
+        if result is not None:
+            print_response(*result)
+
+def run_batch(interpreter: Interpreter, lines) -> int:
+    count = 0
+    start = time.perf_counter()
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        print_infof("> %s\n", "cyan", line)
+        result = interpreter.execute_line(line)
+        if result is not None:
+            count += 1
+            print_response(*result)
+    elapsed = time.perf_counter() - start
+    if count:
+        print_infof("%d APDUs in %.3f s (%.1f us per APDU)\n", "cyan", count, elapsed, elapsed / count * 1e6)
+    return count
+
+class APDURequestHandler(socketserver.StreamRequestHandler):
+    # One hex APDU per line in, response data followed by the SW in hex per line out
+    disable_nagle_algorithm = True  # replies are tiny; don't let them wait for an ACK
+
+    def handle(self):
+        interpreter = Interpreter(self.server.card)
+        for line in self.rfile:
+            text = line.decode("ascii", "replace").strip()
+            if text.lower() in ["exit", "quit"]:
+                break
+            result = interpreter.execute_line(text, special_commands=False)
+            if result is not None:
+                sw, data = result
+                self.wfile.write(f"{bytes(data).hex().upper()}{sw:04X}\n".encode("ascii"))
+
+class APDUServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, fp, host: str = TCP_HOST, port: int = TCP_PORT):
+        super().__init__((host, port), APDURequestHandler)
+        self.card = fp
+
+def serve_tcp(fp, host: str = TCP_HOST, port: int = TCP_PORT):
+    with APDUServer(fp, host, port) as server:
+        print_infof("Serving APDUs on %s:%d\n", "green", *server.server_address[:2])
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+def split_options(argv: List[str]) -> Tuple[List[str], dict]:
+    # "--name=value" and bare "--flag" options, in any position among the arguments
+    args, options = [], {}
+    for arg in argv:
+        if arg.startswith("--") and "=" in arg:
+            key, value = arg[2:].split("=", 1)
+            options[key] = value
+        elif arg.startswith("--"):
+            options[arg[2:]] = True
+        else:
+            args.append(arg)
+    return args, options
+
+@contextmanager
+def session_capture(fp, options: dict):
+    # --trace=<file> records every APDU the front end executes, for replay later;
+    # --wear=<sidecar> adds the session's writes to the wear sidecar when it ends
+    if isinstance(options.get("trace"), str):
+        start_trace(options["trace"])
+    if isinstance(options.get("wear"), str):
+        start_wear_tracking(fp, options["wear"])
+    try:
+        yield fp
+    finally:
+        if isinstance(options.get("wear"), str):
+            stop_wear_tracking(fp)
+        if isinstance(options.get("trace"), str):
+            stop_trace()
+
+
+# Image Migration
+def migrate_image_to_v2(fp) -> int:
+    if get_image_version(fp) == IMAGE_FORMAT_V2:
+        print_colored_text("Image is already in format v2\n", "yellow")
+        return SW_SUCCESS
+
+    root_res = get_root_offset(fp)
+    if root_res.sw != SW_SUCCESS:
+        return root_res.sw
+    if root_res.value == C_NULL:
+        set_image_version(fp, IMAGE_FORMAT_V2)
+        return SW_SUCCESS
+
+    cursors = load_cursors(fp)
+    if cursors.write_offset > DATA_AREA_END:
+        print_colored_text("Image data overlaps the image trailer, cannot migrate\n", "red")
+        return SW_NOT_ENOUGH_MEMORY
+
+    # Collect every directory and its chained children before touching the image
+    directories = []
+    try:
+        for entry in walk(fp, root_res.value):
+            if entry.node.Type in [IS_MF, IS_DF, IS_ADF]:
+                directories.append((entry.offset, entry.node, read_child_chain(fp, entry.node)))
+    except (struct.error, OSError):
+        print_colored_text("Failed to read v1 directory chains\n", "red")
+        return SW_MEMORY_FAILURE
+
+    for offset, dir_node, children in directories:
+        dir_node.ChildFID = ZERO
+        dir_node.ChildOffset = ZERO
+        dir_node.NextOffset = ZERO
+        if children:
+            capacity = max(CHILD_TABLE_INITIAL_CAPACITY, len(children))
+            table_offset = get_next_write_position(fp, CHILD_TABLE_HEADER_SIZE + capacity * CHILD_ENTRY_SIZE)
+            if table_offset == SW_NOT_ENOUGH_MEMORY:
+                return SW_NOT_ENOUGH_MEMORY
+            fp.write_at(table_offset, pack_child_table(sorted(children), capacity))
+            dir_node.ChildOffset = table_offset
+        fp.write_at(offset, pack_directory_node(dir_node))
+    set_image_version(fp, IMAGE_FORMAT_V2)
+
+    # Every directory must list exactly the children it had before
+    for offset, _, children in directories:
+        if list_children(fp, read_directory_node(fp, offset)) != sorted(children):
+            print_infof("Child table mismatch for directory at %04X\n", "red", offset)
+            return SW_TECHNICAL_PROBLEM
+    print_infof("Migrated %d directories to format v2\n", "green", len(directories))
+    return SW_SUCCESS
+
+def migrate_image_file(src_path: str, dst_path: Optional[str] = None) -> int:
+    # Convert on an in-RAM copy so a failed migration never touches the source
+    fp = MemoryStorage.load(src_path)
+    status = migrate_image_to_v2(fp)
+    if status == SW_SUCCESS:
+        fp.dump(dst_path or src_path)
+    return status
+
+
+# Fleet Archive
+def fleet_compress(codec: int, data: bytes) -> bytes:
+    if codec == FLEET_CODECS["zlib"]:
+        return zlib.compress(data, 9)
+    if codec == FLEET_CODECS["lzma"]:
+        return lzma.compress(data, preset=6)
+    return data
+
+def fleet_decompress(codec: int, data: bytes) -> bytes:
+    if codec == FLEET_CODECS["zlib"]:
+        return zlib.decompress(data)
+    if codec == FLEET_CODECS["lzma"]:
+        return lzma.decompress(data)
+    if codec == FLEET_CODECS["none"]:
+        return data
+    raise IOError(f"Unknown fleet codec {codec}")
+
+def encode_image_delta(template: bytes, image: bytes, page_size: int) -> bytes:
+    # Page bitmap followed by the pages that differ from the template
+    if len(image) != len(template):
+        raise ValueError(f"Image size {len(image)} does not match template size {len(template)}")
+    page_count = (len(image) + page_size - 1) // page_size
+    bitmap = bytearray((page_count + 7) // 8)
+    pages = []
+    image_view, template_view = memoryview(image), memoryview(template)
+    for page in range(page_count):
+        start = page * page_size
+        chunk = image_view[start:start + page_size]
+        if chunk != template_view[start:start + page_size]:
+            bitmap[page >> 3] |= 1 << (page & 7)
+            pages.append(chunk)
+    return bytes(bitmap) + b"".join(pages)
+
+def apply_image_delta(template: bytes, delta: bytes, page_size: int) -> bytes:
+    image = bytearray(template)
+    page_count = (len(image) + page_size - 1) // page_size
+    pos = (page_count + 7) // 8
+    for page in range(page_count):
+        if delta[page >> 3] & (1 << (page & 7)):
+            start = page * page_size
+            length = min(page_size, len(image) - start)
+            if pos + length > len(delta):
+                raise IOError("Truncated fleet delta")
+            image[start:start + length] = delta[pos:pos + length]
+            pos += length
+    return bytes(image)
+
+def read_exact(stream, size: int) -> bytes:
+    data = stream.read(size)
+    if len(data) != size:
+        raise IOError(f"Truncated fleet archive (wanted {size} bytes, got {len(data)})")
+    return data
+
+class FleetArchiveWriter:
+    # Cards are streamed straight to the output; the template is the first card
+    # unless one is given up front
+    def __init__(self, stream, template: Optional[bytes] = None, compression: str = "zlib",
+                 page_size: int = FLEET_PAGE_SIZE, owns_stream: bool = False):
+        if compression not in FLEET_CODECS:
+            raise ValueError(f"Unknown compression '{compression}'")
+        self.stream = stream
+        self.owns_stream = owns_stream
+        self.codec = FLEET_CODECS[compression]
+        self.page_size = page_size
+        self.template = None
+        self.index = []
+        self.names = set()
+        self.offset = 0
+        if template is not None:
+            self.write_header(bytes(template))
+
+    @classmethod
+    def create(cls, path: str, **kwargs) -> "FleetArchiveWriter":
+        return cls(open(path, "wb"), owns_stream=True, **kwargs)
+
+    def write_header(self, template: bytes):
+        packed = fleet_compress(self.codec, template)
+        self.emit(struct.pack(FLEET_HEADER_FORMAT, FLEET_MAGIC, FLEET_VERSION, self.page_size,
+                              len(template), self.codec, len(packed)) + packed)
+        self.template = template
+
+    def emit(self, data: bytes):
+        self.stream.write(data)
+        self.offset += len(data)
+
+    def add(self, name: str, image: bytes):
+        if name in self.names:
+            raise ValueError(f"Duplicate card name '{name}'")
+        if self.template is None:
+            self.write_header(bytes(image))
+        encoded_name = name.encode()
+        payload = fleet_compress(self.codec, encode_image_delta(self.template, image, self.page_size))
+        self.index.append((encoded_name, self.offset))
+        self.names.add(name)
+        self.emit(FLEET_RECORD_TAG + struct.pack(FLEET_RECORD_FORMAT, len(encoded_name), len(payload)) + encoded_name + payload)
+
+    def close(self):
+        if self.stream is None:
+            return
+        if self.template is None:
+            self.write_header(b"\xff" * FILE_SIZE)
+        index_offset = self.offset
+        self.emit(FLEET_INDEX_TAG + struct.pack(FLEET_INDEX_FORMAT, len(self.index)))
+        self.emit(b"".join(struct.pack(FLEET_INDEX_ENTRY_FORMAT, len(name), offset) + name
+                           for name, offset in self.index))
+        self.emit(struct.pack(FLEET_TRAILER_FORMAT, index_offset, FLEET_INDEX_MAGIC))
+        self.stream.flush()
+        if self.owns_stream:
+            self.stream.close()
+        self.stream = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def read_fleet_header(stream) -> Tuple[int, int, bytes]:
+    header = read_exact(stream, struct.calcsize(FLEET_HEADER_FORMAT))
+    magic, version, page_size, image_size, codec, packed_len = struct.unpack(FLEET_HEADER_FORMAT, header)
+    if magic != FLEET_MAGIC:
+        raise IOError("Not a fleet archive")
+    if version != FLEET_VERSION:
+        raise IOError(f"Unsupported fleet archive version {version}")
+    template = fleet_decompress(codec, read_exact(stream, packed_len))
+    if len(template) != image_size:
+        raise IOError("Corrupt fleet template")
+    return page_size, codec, template
+
+def read_fleet_record(stream) -> Optional[Tuple[str, bytes]]:
+    # Returns None once the index is reached
+    tag = stream.read(1)
+    if tag == FLEET_INDEX_TAG:
+        return None
+    if tag != FLEET_RECORD_TAG:
+        raise IOError("Corrupt fleet record")
+    name_len, payload_len = struct.unpack(FLEET_RECORD_FORMAT, read_exact(stream, struct.calcsize(FLEET_RECORD_FORMAT)))
+    name = read_exact(stream, name_len).decode()
+    return name, read_exact(stream, payload_len)
+
+def iter_fleet_stream(stream):
+    # Sequential read for pipes: no seeking, the index is never consulted
+    page_size, codec, template = read_fleet_header(stream)
+    while True:
+        record = read_fleet_record(stream)
+        if record is None:
+            return
+        name, payload = record
+        yield name, apply_image_delta(template, fleet_decompress(codec, payload), page_size)
+
+class FleetArchive:
+    def __init__(self, path: str):
+        self.fp = open(path, "rb")
+        self.page_size, self.codec, self.template = read_fleet_header(self.fp)
+        trailer_size = struct.calcsize(FLEET_TRAILER_FORMAT)
+        self.fp.seek(-trailer_size, os.SEEK_END)
+        index_offset, magic = struct.unpack(FLEET_TRAILER_FORMAT, read_exact(self.fp, trailer_size))
+        if magic != FLEET_INDEX_MAGIC:
+            raise IOError("Fleet archive has no index (truncated write?)")
+        self.fp.seek(index_offset)
+        if read_exact(self.fp, 1) != FLEET_INDEX_TAG:
+            raise IOError("Corrupt fleet index")
+        count, = struct.unpack(FLEET_INDEX_FORMAT, read_exact(self.fp, struct.calcsize(FLEET_INDEX_FORMAT)))
+        self.index = {}
+        entry_size = struct.calcsize(FLEET_INDEX_ENTRY_FORMAT)
+        for _ in range(count):
+            name_len, offset = struct.unpack(FLEET_INDEX_ENTRY_FORMAT, read_exact(self.fp, entry_size))
+            self.index[read_exact(self.fp, name_len).decode()] = offset
+
+    def names(self) -> List[str]:
+        return list(self.index)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.index
+
+    def get(self, name: str) -> bytes:
+        if name not in self.index:
+            raise KeyError(name)
+        self.fp.seek(self.index[name])
+        record = read_fleet_record(self.fp)
+        if record is None or record[0] != name:
+            raise IOError(f"Fleet index entry for '{name}' does not point at its record")
+        return apply_image_delta(self.template, fleet_decompress(self.codec, record[1]), self.page_size)
+
+    def open_card(self, name: str) -> MemoryStorage:
+        return MemoryStorage.from_bytes(self.get(name))
+
+    def __iter__(self):
+        for name in self.index:
+            yield name, self.get(name)
+
+    def close(self):
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def pack_fleet(archive_path: str, image_paths: List[str], template_path: Optional[str] = None,
+               compression: str = "zlib") -> int:
+    # Cards are named by file name, so a/card.bin and b/card.bin would collide
+    names = {}
+    for path in image_paths:
+        name = os.path.basename(path)
+        if name in names:
+            raise ValueError(f"Duplicate card name '{name}' ({names[name]} and {path})")
+        names[name] = path
+    template = None
+    if template_path is not None:
+        with open(template_path, "rb") as f:
+            template = f.read()
+    with FleetArchiveWriter.create(archive_path, template=template, compression=compression) as writer:
+        for path in image_paths:
+            with open(path, "rb") as f:
+                writer.add(os.path.basename(path), f.read())
+    return len(image_paths)
+
+def unpack_fleet(archive_path: str, out_dir: str) -> int:
+    os.makedirs(out_dir, exist_ok=True)
+    count = 0
+    with open(archive_path, "rb") as stream:
+        for name, image in iter_fleet_stream(stream):
+            with open(os.path.join(out_dir, os.path.basename(name)), "wb") as f:
+                f.write(image)
+            count += 1
+    return count
+
+
+# Export and Diff
+def walk_paths(fp, root_offset: int):
+    # walk() with each node's FID path from the MF, e.g. "3F00/7F10/6F07"
+    paths = []
+    for entry in walk(fp, root_offset):
+        del paths[entry.depth:]
+        paths.append(f"{entry.node.FID:04X}")
+        yield "/".join(paths), entry
+
+def decode_fcp(fcp: bytes) -> List[dict]:
+    tlvs = []
+    pos = 2
+    while pos + 2 <= len(fcp):
+        tag, length = fcp[pos], fcp[pos + 1]
+        value = fcp[pos + 2:pos + 2 + length]
+        tlvs.append({"tag": f"{tag:02X}", "name": get_tag_name(tag), "value": value.hex().upper()})
+        pos += 2 + length
+    return tlvs
+
+def get_ef_data_size(fcp: bytes) -> int:
+    size = find_fcp_tag(fcp, 0x80)
+    return int.from_bytes(size, "big") if size else 0
+
+def get_ef_record_size(fcp: bytes) -> int:
+    descriptor = find_fcp_tag(fcp, 0x82)
+    return int.from_bytes(descriptor[2:4], "big") if descriptor and len(descriptor) >= 4 else 0
+
+def get_node_header_size(node) -> int:
+    if isinstance(node, MFNode):
+        return MF_NODE_SIZE
+    return get_node_size(node.Type)
+
+def export_node(fp, entry: WalkNode) -> dict:
+    node = entry.node
+    item = {
+        "fid": f"{node.FID:04X}",
+        "type": getFileTypeName(node.Type),
+        "offset": f"{entry.offset:04X}",
+        "fcp": decode_fcp(entry.fcp),
+    }
+    if node.Type in [IS_MF, IS_DF, IS_ADF]:
+        item["children"] = []
+        return item
+    data = fp.read_at(node.DataOffset, get_ef_data_size(entry.fcp))
+    record_size = get_ef_record_size(entry.fcp)
+    if is_record_ef(node.Type) and record_size:
+        item["records"] = [data[i:i + record_size].hex().upper() for i in range(0, len(data), record_size)]
+    else:
+        item["data"] = data.hex().upper()
+    return item
+
+def export_tree(fp) -> dict:
+    root_res = get_root_offset(fp)
+    tree = None
+    if root_res.sw == SW_SUCCESS and root_res.value != C_NULL:
+        stack = []
+        for entry in walk(fp, root_res.value):
+            item = export_node(fp, entry)
+            del stack[entry.depth:]
+            if stack:
+                stack[-1]["children"].append(item)
+            else:
+                tree = item
+            if "children" in item:
+                stack.append(item)
+    return {
+        "format_version": get_image_version(fp),
+        "generation": get_generation(fp),
+        "free_bytes": calculate_available_memory(fp),
+        "mf": tree,
+    }
+
+def get_node_extents(fp) -> List[Tuple[int, int, str, str, int]]:
+    # Sorted (start, end, path, kind, node offset) for every byte range the tree owns
+    extents = [(ROOT_OFFSET_PTR, ROOT_OFFSET_PTR + 2, "", "root", C_NULL),
+               (DATA_AREA_END, FILE_SIZE, "", "trailer", C_NULL)]
+    root_res = get_root_offset(fp)
+    if root_res.sw != SW_SUCCESS or root_res.value == C_NULL:
+        return sorted(extents)
+    v2 = get_image_version(fp) == IMAGE_FORMAT_V2
+    for path, entry in walk_paths(fp, root_res.value):
+        node, offset = entry.node, entry.offset
+        extents.append((offset, offset + get_node_header_size(node), path, "node", offset))
+        extents.append((node.FCPOffset, node.FCPOffset + node.FCP_total_size, path, "fcp", offset))
+        if node.Type not in [IS_MF, IS_DF, IS_ADF]:
+            extents.append((node.DataOffset, node.DataOffset + get_ef_data_size(entry.fcp), path, "data", offset))
+        elif v2 and node.ChildOffset not in [ZERO, C_NULL]:
+            capacity = read_u16(fp, node.ChildOffset + 2)
+            extents.append((node.ChildOffset, node.ChildOffset + CHILD_TABLE_HEADER_SIZE + capacity * CHILD_ENTRY_SIZE,
+                            path, "children", offset))
+        elif not v2:
+            next_offset = node.NextOffset
+            while next_offset not in [ZERO, C_NULL] and next_offset < FILE_SIZE:
+                extents.append((next_offset, next_offset + NODE_SECOND_SIZE, path, "children", offset))
+                next_offset = read_node_second(fp, next_offset).NextOffset
+    return sorted(extents)
+
+def changed_ranges(a: bytes, b: bytes) -> List[Tuple[int, int]]:
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+
+    common = min(len(a), len(b))
+    tail = [(common, max(len(a), len(b)))] if len(a) != len(b) else []
+    if np is not None:
+        diff = np.frombuffer(a, dtype=np.uint8, count=common) != np.frombuffer(b, dtype=np.uint8, count=common)
+        changed = np.flatnonzero(diff)
+        if changed.size == 0:
+            return tail
+        breaks = np.flatnonzero(np.diff(changed) > 1)
+        starts = changed[np.concatenate(([0], breaks + 1))]
+        ends = changed[np.concatenate((breaks, [changed.size - 1]))] + 1
+        return list(zip(starts.tolist(), ends.tolist())) + tail
+
+    # Compare whole pages first and only scan the pages that differ byte by byte
+    ranges = []
+    a_view, b_view = memoryview(a), memoryview(b)
+    for page_start in range(0, common, FLEET_PAGE_SIZE):
+        page_end = min(page_start + FLEET_PAGE_SIZE, common)
+        if a_view[page_start:page_end] == b_view[page_start:page_end]:
+            continue
+        for pos in range(page_start, page_end):
+            if a[pos] != b[pos]:
+                if ranges and ranges[-1][1] == pos:
+                    ranges[-1] = (ranges[-1][0], pos + 1)
+                else:
+                    ranges.append((pos, pos + 1))
+    return ranges + tail
+
+def describe_trailer_change(a: bytes, b: bytes) -> dict:
+    fields = {"generation": GENERATION_PTR, "format_version": FORMAT_VERSION_PTR,
+              "write_cursor": WRITE_CURSOR_END, "read_cursor": READ_CURSOR_END}
+    return {"path": "", "change": "trailer",
+            "fields": [name for name, ptr in fields.items() if a[ptr:ptr + 2] != b[ptr:ptr + 2]]}
+
+def diff_entries(path: str, a_fp, a_entry: WalkNode, b_fp, b_entry: WalkNode) -> List[dict]:
+    changes = []
+    if a_entry.node.Type != b_entry.node.Type:
+        changes.append({"path": path, "change": "type", "old": getFileTypeName(a_entry.node.Type),
+                        "new": getFileTypeName(b_entry.node.Type)})
+    if a_entry.fcp != b_entry.fcp:
+        old = {tlv["tag"]: tlv for tlv in decode_fcp(a_entry.fcp)}
+        new = {tlv["tag"]: tlv for tlv in decode_fcp(b_entry.fcp)}
+        for tag in sorted(set(old) | set(new)):
+            if old.get(tag) != new.get(tag):
+                changes.append({"path": path, "change": "fcp", "tag": tag, "name": get_tag_name(int(tag, 16)),
+                                "old": old[tag]["value"] if tag in old else None,
+                                "new": new[tag]["value"] if tag in new else None})
+    if a_entry.node.Type not in [IS_MF, IS_DF, IS_ADF] and b_entry.node.Type not in [IS_MF, IS_DF, IS_ADF]:
+        a_data = a_fp.read_at(a_entry.node.DataOffset, get_ef_data_size(a_entry.fcp))
+        b_data = b_fp.read_at(b_entry.node.DataOffset, get_ef_data_size(b_entry.fcp))
+        if a_data != b_data:
+            changes.append(describe_data_change(path, b_entry, changed_ranges(a_data, b_data)))
+    return changes
+
+def describe_data_change(path: str, entry: WalkNode, ranges: List[Tuple[int, int]]) -> dict:
+    change = {"path": path, "change": "data", "ranges": [[start, end] for start, end in ranges]}
+    record_size = get_ef_record_size(entry.fcp)
+    if is_record_ef(entry.node.Type) and record_size:
+        records = set()
+        for start, end in ranges:
+            records.update(range(start // record_size + 1, (end - 1) // record_size + 2))
+        change["records"] = sorted(records)
+    return change
+
+def diff_trees(a_fp, b_fp) -> List[dict]:
+    # Full structural comparison keyed by FID path
+    trees = []
+    for fp in [a_fp, b_fp]:
+        root_res = get_root_offset(fp)
+        nodes = {}
+        if root_res.sw == SW_SUCCESS and root_res.value != C_NULL:
+            nodes = dict(walk_paths(fp, root_res.value))
+        trees.append(nodes)
+    a_nodes, b_nodes = trees
+
+    changes = []
+    for path in sorted(set(a_nodes) | set(b_nodes)):
+        if path not in b_nodes:
+            changes.append({"path": path, "change": "removed"})
+        elif path not in a_nodes:
+            changes.append({"path": path, "change": "added"})
+        else:
+            changes.extend(diff_entries(path, a_fp, a_nodes[path], b_fp, b_nodes[path]))
+    return changes
+
+def diff_images(a_fp, b_fp, a_extents: Optional[List[Tuple[int, int, str, str, int]]] = None) -> List[dict]:
+    a = a_fp.read_at(0, a_fp.size())
+    b = b_fp.read_at(0, b_fp.size())
+    ranges = changed_ranges(a, b)
+    if not ranges:
+        return []
+
+    # Attribute each changed range to the tree region of the reference that owns it
+    extents = a_extents if a_extents is not None else get_node_extents(a_fp)
+    starts = [extent[0] for extent in extents]
+    touched = {}
+    unallocated = []
+    for start, end in ranges:
+        pos = start
+        i = max(bisect.bisect_right(starts, start) - 1, 0)
+        while pos < end:
+            while i < len(extents) and extents[i][1] <= pos:
+                i += 1
+            if i == len(extents) or extents[i][0] >= end:
+                unallocated.append((pos, end))
+                break
+            ext_start, ext_end, path, kind, node_offset = extents[i]
+            if ext_start > pos:
+                unallocated.append((pos, ext_start))
+                pos = ext_start
+            touched.setdefault((path, kind, node_offset), []).append((pos - ext_start, min(end, ext_end) - ext_start))
+            pos = min(end, ext_end)
+
+    # Anything beyond data bytes may move or resize nodes: compare the trees by path
+    if any(kind in ["root", "node", "children", "fcp"] for _, kind, _ in touched):
+        changes = diff_trees(a_fp, b_fp)
+    else:
+        changes = [describe_data_change(path, read_node_region(a_fp, node_offset), node_ranges)
+                   for (path, kind, node_offset), node_ranges in sorted(touched.items()) if kind == "data"]
+    if any(kind == "trailer" for _, kind, _ in touched):
+        changes.append(describe_trailer_change(a, b))
+    if unallocated:
+        changes.append({"path": "", "change": "unallocated", "ranges": [[start, end] for start, end in unallocated]})
+    return changes
+
+def diff_fleet(reference_fp, images) -> dict:
+    # The reference layout is decoded once; each card costs one buffer compare
+    extents = get_node_extents(reference_fp)
+    return {name: diff_images(reference_fp, MemoryStorage.from_bytes(image), extents) for name, image in images}
+
+
+# Fleet Analytics
+def import_numpy():
+    try:
+        import numpy as np
+    except ImportError:
+        raise RuntimeError("Fleet analytics needs numpy (pip install numpy)")
+    return np
+
+def read_image_files(paths: List[str]):
+    for path in paths:
+        with open(path, "rb") as f:
+            yield path, f.read()
+
+def load_fleet_images(images) -> Tuple[List[str], object]:
+    # images: (name, image bytes) pairs, e.g. a FleetArchive; returns one uint8 row per card
+    np = import_numpy()
+    names, rows = [], []
+    for name, image in images:
+        if len(image) != FILE_SIZE:
+            raise ValueError(f"Image '{name}' is {len(image)} bytes, expected {FILE_SIZE}")
+        names.append(name)
+        rows.append(np.frombuffer(image, dtype=np.uint8))
+    return names, np.stack(rows) if rows else np.empty((0, FILE_SIZE), dtype=np.uint8)
+
+def fleet_u8(flat, base, offset):
+    np = import_numpy()
+    index = base + offset
+    valid = (offset >= 0) & (offset < FILE_SIZE)
+    return np.where(valid, flat[np.where(valid, index, 0)], 0).astype(np.uint16)
+
+def fleet_u16(flat, base, offset):
+    return fleet_u8(flat, base, offset) | (fleet_u8(flat, base, offset + 1) << 8)
+
+def fleet_child_offsets(flat, base, dirs, child_fid, child_offset, next_offset, v2):
+    # Children of every directory in one pass: v2 child tables are expanded with
+    # np.repeat, v1 chains are followed one NodeSecond hop at a time for all chains at once
+    np = import_numpy()
+    parents, children = [], []
+
+    table = child_offset[v2]
+    has_table = (table != ZERO) & (table != C_NULL) & (table < DATA_AREA_END)
+    table_dirs, table = dirs[v2][has_table], table[has_table].astype(np.int64)
+    table_base = base[table_dirs]
+    count = fleet_u16(flat, table_base, table).astype(np.int64)
+    count = np.minimum(count, (DATA_AREA_END - table - CHILD_TABLE_HEADER_SIZE) // CHILD_ENTRY_SIZE)
+    owner = np.repeat(np.arange(table.size), count)
+    slot = np.arange(owner.size) - np.repeat(np.cumsum(count) - count, count)
+    entry = table[owner] + CHILD_TABLE_HEADER_SIZE + slot * CHILD_ENTRY_SIZE + 2
+    parents.append(table_dirs[owner])
+    children.append(fleet_u16(flat, table_base[owner], entry))
+
+    v1 = ~v2
+    first = v1 & (child_fid != ZERO) & (child_offset != ZERO) & (child_offset != C_NULL)
+    parents.append(dirs[first])
+    children.append(child_offset[first])
+    link_dirs, link = dirs[v1], next_offset[v1].astype(np.int64)
+    for _ in range(DATA_AREA_END // NODE_SECOND_SIZE):
+        live = (link != ZERO) & (link != C_NULL) & (link < DATA_AREA_END)
+        if not live.any():
+            break
+        link_dirs, link = link_dirs[live], link[live]
+        parents.append(link_dirs)
+        children.append(fleet_u16(flat, base[link_dirs], link + 4))
+        link = fleet_u16(flat, base[link_dirs], link + 6).astype(np.int64)
+    return np.concatenate(parents), np.concatenate(children).astype(np.int64)
+
+def fleet_fcp_fields(flat, base, fid, fcp_offset, fcp_size):
+    # Walk the FCP TLVs of all EFs in lockstep for tag 80 (file size) and 88 (SFI)
+    np = import_numpy()
+    data_size = np.zeros(fid.size, dtype=np.uint16)
+    sfi = (fid & 0x1F).astype(np.int8)  # no tag 88: SFI from the FID's low bits
+    pos = fcp_offset + 2
+    end = fcp_offset + fcp_size
+    for _ in range(MAX_TLV_LEN // 2):
+        live = pos + 2 <= end
+        if not live.any():
+            break
+        tag = fleet_u8(flat, base, pos)
+        length = fleet_u8(flat, base, pos + 1).astype(np.int64)
+        live &= pos + 2 + length <= end
+        size_tag = live & (tag == 0x80) & (length == 2)
+        value = (fleet_u8(flat, base, pos + 2) << 8) | fleet_u8(flat, base, pos + 3)
+        data_size = np.where(size_tag, value, data_size)
+        sfi_tag = live & (tag == 0x88)
+        sfi = np.where(sfi_tag, np.where(length == 0, -1, fleet_u8(flat, base, pos + 2) >> 3), sfi).astype(np.int8)
+        pos = np.where(live, pos + 2 + length, end)
+    return data_size, sfi
+
+def decode_fleet_nodes(cards):
+    # cards: (n, FILE_SIZE) uint8 from load_fleet_images. Breadth-first over every card
+    # at once: each level is a handful of gathers, never a Python object per node.
+    np = import_numpy()
+    flat = cards.reshape(-1)
+    image_base = np.arange(cards.shape[0], dtype=np.int64) * FILE_SIZE
+    v2_images = fleet_u16(flat, image_base, np.int64(FORMAT_VERSION_PTR)) == IMAGE_FORMAT_V2
+    root = fleet_u16(flat, image_base, np.int64(ROOT_OFFSET_PTR)).astype(np.int64)
+    has_mf = (root != C_NULL) & (root < DATA_AREA_END)
+    has_mf[has_mf] = fleet_u16(flat, image_base[has_mf], root[has_mf]) == MF_FID
+
+    image = np.flatnonzero(has_mf)
+    offset = root[has_mf]
+    parent_fid = np.full(image.size, C_NULL, dtype=np.uint16)
+    levels = []
+    for depth in range(FLEET_MAX_DEPTH):
+        if image.size == 0:
+            break
+        base = image_base[image]
+        fid = fleet_u16(flat, base, offset)
+        is_mf = depth == 0
+        if is_mf:
+            node_type = fleet_u8(flat, base, offset + 8)
+            fcp_offset, fcp_size = fleet_u16(flat, base, offset + 9), fleet_u8(flat, base, offset + 11)
+            child_fid, child_offset = fleet_u16(flat, base, offset + 2), fleet_u16(flat, base, offset + 4)
+            next_offset = fleet_u16(flat, base, offset + 12)
+        else:
+            node_type = fleet_u8(flat, base, offset + 6)
+            is_dir = np.isin(node_type, [IS_DF, IS_ADF])
+            fcp_offset = np.where(is_dir, fleet_u16(flat, base, offset + 11), fleet_u16(flat, base, offset + 7))
+            fcp_size = np.where(is_dir, fleet_u8(flat, base, offset + 13), fleet_u8(flat, base, offset + 9))
+            child_fid, child_offset = fleet_u16(flat, base, offset + 7), fleet_u16(flat, base, offset + 9)
+            next_offset = fleet_u16(flat, base, offset + 14)
+
+        level = np.zeros(image.size, dtype=FLEET_NODE_DTYPE)
+        level["image"], level["fid"], level["type"], level["parent_fid"] = image, fid, node_type, parent_fid
+        level["depth"], level["offset"], level["fcp_offset"], level["fcp_size"] = depth, offset, fcp_offset, fcp_size
+        level["sfi"] = -1
+        is_ef = ~np.isin(node_type, [IS_MF, IS_DF, IS_ADF])
+        if is_ef.any():
+            level["data_size"][is_ef], level["sfi"][is_ef] = fleet_fcp_fields(
+                flat, base[is_ef], fid[is_ef], fcp_offset[is_ef].astype(np.int64), fcp_size[is_ef].astype(np.int64))
+        levels.append(level)
+
+        dirs = np.flatnonzero(~is_ef)
+        parent, child = fleet_child_offsets(flat, base, dirs, child_fid[dirs], child_offset[dirs],
+                                            next_offset[dirs], v2_images[image[dirs]])
+        keep = (child != ZERO) & (child != C_NULL) & (child < DATA_AREA_END)
+        parent, child = parent[keep], child[keep]
+        image, offset, parent_fid = image[parent], child, fid[parent]
+    return np.concatenate(levels) if levels else np.zeros(0, dtype=FLEET_NODE_DTYPE)
+
+def summarize_fleet_images(cards, nodes):
+    np = import_numpy()
+    flat = cards.reshape(-1)
+    image_base = np.arange(cards.shape[0], dtype=np.int64) * FILE_SIZE
+    summary = np.zeros(cards.shape[0], dtype=FLEET_IMAGE_DTYPE)
+    summary["image"] = np.arange(cards.shape[0])
+    summary["version"] = fleet_u16(flat, image_base, np.int64(FORMAT_VERSION_PTR))
+    summary["generation"] = fleet_u16(flat, image_base, np.int64(GENERATION_PTR))
+    summary["nodes"] = np.bincount(nodes["image"], minlength=cards.shape[0])
+    write_offset = fleet_u16(flat, image_base, np.int64(WRITE_CURSOR_END)).astype(np.int64)
+    summary["free"] = np.clip(DATA_AREA_END - write_offset, 0, None)
+    return summary
+
+def parse_fleet_query(where: str) -> List[Tuple[str, str, int]]:
+    # "fid==0x6F07 & data_size<9": comparisons of a field with an integer, all must hold
+    conditions = []
+    for term in where.replace(" and ", "&").split("&"):
+        term = term.strip()
+        for op in FLEET_QUERY_OPS:
+            if op in term:
+                field_name, value = term.split(op, 1)
+                conditions.append((field_name.strip(), op, int(value.strip(), 0)))
+                break
+        else:
+            raise ValueError(f"Cannot parse condition '{term}'")
+    return conditions
+
+def filter_records(records, where: str):
+    np = import_numpy()
+    mask = np.ones(records.size, dtype=bool)
+    for field_name, op, value in parse_fleet_query(where):
+        if field_name not in records.dtype.names:
+            raise ValueError(f"Unknown field '{field_name}' (fields: {', '.join(records.dtype.names)})")
+        column = records[field_name].astype(np.int64)
+        mask &= {"==": column == value, "!=": column != value, "<=": column <= value,
+                 ">=": column >= value, "<": column < value, ">": column > value}[op]
+    return records[mask]
+
+def group_records(records, by: List[str]):
+    # One row per distinct key with its count, like SELECT by..., COUNT(*) GROUP BY by
+    np = import_numpy()
+    for field_name in by:
+        if field_name not in records.dtype.names:
+            raise ValueError(f"Unknown field '{field_name}' (fields: {', '.join(records.dtype.names)})")
+    keys, counts = np.unique(records[by], return_counts=True)
+    grouped = np.zeros(keys.size, dtype=[(name, records.dtype[name]) for name in by] + [("count", "<u4")])
+    for name in by:
+        grouped[name] = keys[name]
+    grouped["count"] = counts
+    return grouped
+
+def export_records_csv(records, path: str):
+    import csv
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(records.dtype.names)
+        writer.writerows(records.tolist())
+
+def export_records_parquet(records, path: str):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+    table = pyarrow.table({name: records[name] for name in records.dtype.names})
+    pyarrow.parquet.write_table(table, path)
+
+def print_records(records, limit: int = 50):
+    names = records.dtype.names
+    print_infof("%s\n", "cyan", " ".join(f"{name:>10}" for name in names))
+    hex_fields = ["fid", "parent_fid", "type", "offset", "fcp_offset"]
+    for row in records[:limit].tolist():
+        cells = [f"{value:>10X}" if name in hex_fields else f"{value:>10}" for name, value in zip(names, row)]
+        print_infof("%s\n", "yellow", " ".join(cells))
+    if records.size > limit:
+        print_infof("... %d more rows\n", "cyan", records.size - limit)
+
+def analyze_fleet(images, where: Optional[str] = None, group_by: Optional[List[str]] = None,
+                  per_image: bool = False):
+    # Returns the selected node (or per-image) records, filtered and optionally grouped
+    names, cards = load_fleet_images(images)
+    nodes = decode_fleet_nodes(cards)
+    records = summarize_fleet_images(cards, nodes) if per_image else nodes
+    if where:
+        records = filter_records(records, where)
+    if group_by:
+        records = group_records(records, group_by)
+    return names, records
+
+
+# APDU Trace
+class TraceWriter:
+    # Append-only and buffered: recording costs a struct.pack and a memory copy per APDU
+    def __init__(self, path: str):
+        self.fp = open(path, "ab", buffering=TRACE_BUFFER_SIZE)
+        if self.fp.tell() == 0:
+            self.fp.write(struct.pack(TRACE_HEADER_FORMAT, TRACE_MAGIC, TRACE_VERSION))
+        self.start = time.monotonic_ns()
+        self.lock = threading.Lock()
+
+    def write_record(self, kind: int, command: bytes, sw: int, response: bytes):
+        header = struct.pack(TRACE_RECORD_FORMAT, kind, current_session().id, time.monotonic_ns() - self.start,
+                             len(command), len(response), sw)
+        with self.lock:
+            self.fp.write(header + command + response)
+
+    def record(self, command: bytes, sw: int, response: bytes):
+        self.write_record(TRACE_APDU, bytes(command), sw, bytes(response))
+
+    def record_reset(self):
+        self.write_record(TRACE_RESET, b"", SW_SUCCESS, b"")
+
+    def close(self):
+        with self.lock:
+            if not self.fp.closed:
+                self.fp.close()
+
+def start_trace(path: str) -> TraceWriter:
+    global active_trace
+    stop_trace()
+    active_trace = TraceWriter(path)
+    return active_trace
+
+def stop_trace():
+    global active_trace
+    if active_trace is not None:
+        active_trace.close()
+        active_trace = None
+
+def read_trace(path: str) -> List[TraceEntry]:
+    with open(path, "rb") as f:
+        data = f.read()
+    header_size = struct.calcsize(TRACE_HEADER_FORMAT)
+    magic, version = struct.unpack_from(TRACE_HEADER_FORMAT, data)
+    if magic != TRACE_MAGIC:
+        raise IOError("Not an APDU trace")
+    if version != TRACE_VERSION:
+        raise IOError(f"Unsupported trace version {version}")
+
+    entries = []
+    record_size = struct.calcsize(TRACE_RECORD_FORMAT)
+    pos = header_size
+    while pos + record_size <= len(data):
+        kind, session, timestamp, command_len, response_len, sw = struct.unpack_from(TRACE_RECORD_FORMAT, data, pos)
+        pos += record_size
+        if pos + command_len + response_len > len(data):
+            break  # session was cut off mid-record
+        command = data[pos:pos + command_len]
+        response = data[pos + command_len:pos + command_len + response_len]
+        pos += command_len + response_len
+        entries.append(TraceEntry(kind=kind, session=session, timestamp_ns=timestamp, command=command,
+                                  response=response, sw=sw))
+    return entries
+
+def replay_trace(entries: List[TraceEntry], fp, paced: bool = False, compare_data: bool = True,
+                 quiet: bool = True) -> ReplayResult:
+    # Each recorded session replays in a session of its own, starting from power-up
+    mismatches = []
+    commands = 0
+    apdu = new_apdu()
+    sessions = {}  # recorded session id -> CardSession
+    with silenced() if quiet else nullcontext():
+        start = time.perf_counter()
+        for index, entry in enumerate(entries):
+            if paced:
+                delay = entry.timestamp_ns / 1e9 - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            session = sessions.get(entry.session)
+            if session is None:
+                session = sessions[entry.session] = CardSession()
+                with bound_session(session):
+                    handle_power_up_selection(fp)
+            with bound_session(session):
+                if entry.kind == TRACE_RESET:
+                    reset_global_state()
+                    handle_power_up_selection(fp)
+                    continue
+                sw, data = route_apdu(entry.command, fp, apdu)
+            commands += 1
+            if sw != entry.sw or (compare_data and data != entry.response):
+                mismatches.append({
+                    "index": index,
+                    "ins": entry.command[1] if len(entry.command) > 1 else None,
+                    "expected": entry.sw,
+                    "actual": sw,
+                    "expected_description": get_status_description(entry.sw),
+                    "actual_description": get_status_description(sw),
+                    "data_matches": data == entry.response,
+                })
+        elapsed = time.perf_counter() - start
+    return ReplayResult(commands=commands, mismatches=mismatches, elapsed=elapsed)
+
+def print_replay_result(result: ReplayResult):
+    for mismatch in result.mismatches:
+        print_infof("#%d INS %02X: expected %04X (%s), got %04X (%s)%s\n", "red", mismatch["index"],
+                    mismatch["ins"] or 0, mismatch["expected"], mismatch["expected_description"],
+                    mismatch["actual"], mismatch["actual_description"],
+                    "" if mismatch["data_matches"] else ", response data differs")
+    color = "green" if not result.mismatches else "red"
+    print_infof("Replayed %d APDUs in %.3f s (%.0f APDU/s), %d mismatches\n", color, result.commands,
+                result.elapsed, result.commands_per_second, len(result.mismatches))
+
+
+# EEPROM Wear
+def new_wear_stats(page_size: int = WEAR_PAGE_SIZE) -> WearStats:
+    return WearStats(page_size=page_size, page_writes=[0] * (FILE_SIZE // page_size), by_ins={})
+
+def merge_wear_stats(total: WearStats, delta: WearStats):
+    if total.page_size != delta.page_size:
+        raise ValueError(f"Wear page size {delta.page_size} does not match {total.page_size}")
+    for page, count in enumerate(delta.page_writes):
+        total.page_writes[page] += count
+    for ins, counters in delta.by_ins.items():
+        merged = total.by_ins.setdefault(ins, WearCounters())
+        merged.commands += counters.commands
+        merged.payload_bytes += counters.payload_bytes
+        merged.bytes_written += counters.bytes_written
+        merged.writes += counters.writes
+
+def pack_wear_stats(stats: WearStats) -> bytes:
+    parts = [struct.pack(WEAR_HEADER_FORMAT, WEAR_MAGIC, WEAR_VERSION, stats.page_size, len(stats.page_writes)),
+             struct.pack(f"<{len(stats.page_writes)}I", *stats.page_writes),
+             struct.pack(WEAR_INS_COUNT_FORMAT, len(stats.by_ins))]
+    for ins, c in sorted(stats.by_ins.items()):
+        parts.append(struct.pack(WEAR_INS_FORMAT, ins, c.commands, c.payload_bytes, c.bytes_written, c.writes))
+    return b"".join(parts)
+
+def unpack_wear_stats(data: bytes) -> WearStats:
+    magic, version, page_size, page_count = struct.unpack_from(WEAR_HEADER_FORMAT, data)
+    if magic != WEAR_MAGIC:
+        raise IOError("Not a wear sidecar")
+    if version != WEAR_VERSION:
+        raise IOError(f"Unsupported wear sidecar version {version}")
+    pos = struct.calcsize(WEAR_HEADER_FORMAT)
+    pages = list(struct.unpack_from(f"<{page_count}I", data, pos))
+    pos += 4 * page_count
+    count, = struct.unpack_from(WEAR_INS_COUNT_FORMAT, data, pos)
+    pos += struct.calcsize(WEAR_INS_COUNT_FORMAT)
+    by_ins = {}
+    for _ in range(count):
+        ins, commands, payload, written, writes = struct.unpack_from(WEAR_INS_FORMAT, data, pos)
+        pos += struct.calcsize(WEAR_INS_FORMAT)
+        by_ins[ins] = WearCounters(commands=commands, payload_bytes=payload, bytes_written=written, writes=writes)
+    return WearStats(page_size=page_size, page_writes=pages, by_ins=by_ins)
+
+def read_wear_stats(path: str) -> WearStats:
+    with open(path, "rb") as f:
+        return unpack_wear_stats(f.read())
+
+class WearTracker:
+    # Counts land in memory and are merged into the sidecar on flush, so several
+    # processes driving the same image add up instead of overwriting each other
+    def __init__(self, path: str, page_size: int = WEAR_PAGE_SIZE):
+        self.path = path
+        self.page_size = page_size
+        self.stats = new_wear_stats(page_size)
+        self.lock = threading.Lock()
+        self.local = threading.local()  # INS of the APDU this thread is executing
+
+    def begin(self, ins: int, payload_bytes: int):
+        self.local.ins = ins
+        with self.lock:
+            counters = self.stats.by_ins.setdefault(ins, WearCounters())
+            counters.commands += 1
+            counters.payload_bytes += payload_bytes
+
+    def end(self):
+        self.local.ins = WEAR_NO_INS
+
+    def record(self, offset: int, size: int):
+        if size <= 0:
+            return
+        ins = getattr(self.local, "ins", WEAR_NO_INS)
+        first = offset // self.page_size
+        last = min((offset + size - 1) // self.page_size, len(self.stats.page_writes) - 1)
+        with self.lock:
+            pages = self.stats.page_writes
+            for page in range(first, last + 1):
+                pages[page] += 1
+            counters = self.stats.by_ins.setdefault(ins, WearCounters())
+            counters.bytes_written += size
+            counters.writes += 1
+
+    def flush(self):
+        with self.lock:
+            delta, self.stats = self.stats, new_wear_stats(self.page_size)
+        if not delta.by_ins:
+            return
+        with open(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666), "rb+") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)  # released when the file closes
+            data = f.read()
+            total = unpack_wear_stats(data) if data else new_wear_stats(self.page_size)
+            merge_wear_stats(total, delta)
+            f.seek(0)
+            f.truncate()
+            f.write(pack_wear_stats(total))
+
+def start_wear_tracking(fp, path: str, page_size: int = WEAR_PAGE_SIZE) -> WearTracker:
+    stop_wear_tracking(fp)
+    fp.wear = WearTracker(path, page_size)
+    return fp.wear
+
+def stop_wear_tracking(fp):
+    if fp.wear is not None:
+        fp.wear.flush()
+        fp.wear = None
+
+def hot_pages(stats: WearStats, count: int = 10) -> List[Tuple[int, int]]:
+    used = [(writes, page) for page, writes in enumerate(stats.page_writes) if writes]
+    return [(page, writes) for writes, page in sorted(used, key=lambda item: (-item[0], item[1]))[:count]]
+
+def describe_page(extents: List[Tuple[int, int, str, str, int]], start: int, end: int) -> str:
+    names = []
+    for extent_start, extent_end, path, kind, _ in extents:
+        if extent_start < end and start < extent_end:
+            name = kind if kind in ["root", "trailer"] else f"{path} {kind}"
+            if name not in names:
+                names.append(name)
+    return ", ".join(names) or "free"
+
+def print_wear_report(stats: WearStats, fp=None, top: int = 10):
+    written = sum(c.bytes_written for c in stats.by_ins.values())
+    payload = sum(c.payload_bytes for c in stats.by_ins.values())
+    print_infof("%d bytes written for %d bytes of command data (amplification %.2f)\n", "cyan",
+                written, payload, written / payload if payload else 0.0)
+    print_infof("%s\n", "cyan", "INS              commands    payload    written  writes  ampl.")
+    for ins, c in sorted(stats.by_ins.items(), key=lambda item: -item[1].bytes_written):
+        print_infof("%-15s %9d %10d %10d %7d %6.2f\n", "yellow", get_ins_name(ins), c.commands,
+                    c.payload_bytes, c.bytes_written, c.writes, c.amplification)
+    extents = get_node_extents(fp) if fp is not None else []
+    print_infof("Hottest pages (%d bytes each):\n", "cyan", stats.page_size)
+    for page, writes in hot_pages(stats, top):
+        start = page * stats.page_size
+        where = describe_page(extents, start, start + stats.page_size) if fp is not None else ""
+        print_infof("  %04X-%04X %8d  %s\n", "yellow", start, start + stats.page_size - 1, writes, where)
+
+
+# Fuzzing
+def build_fuzz_image() -> MemoryStorage:
+    fp = initialize_smartcard_file("memory")
+    with silenced(), bound_session(CardSession()):
+        handle_power_up_selection(fp)
+        for command in FUZZ_BASE_APDUS:
+            sw, _ = route_apdu(bytes.fromhex(command), fp)
+            if sw != SW_SUCCESS:
+                raise RuntimeError(f"Fuzz base image setup failed with {sw:04X}")
+    return fp
+
+def mutate_apdu(rng: random.Random, command: bytes, corpus: List[bytes]) -> bytes:
+    data = bytearray(command)
+    for _ in range(rng.randint(1, 3)):
+        choice = rng.randrange(8)
+        pos = rng.randrange(len(data)) if data else 0
+        if choice == 0 and data:
+            data[pos] ^= 1 << rng.randrange(8)
+        elif choice == 1 and data:
+            data[pos] = rng.choice(FUZZ_INTERESTING_BYTES)
+        elif choice == 2:
+            data.insert(pos, rng.randrange(256))
+        elif choice == 3 and len(data) > 1:
+            del data[pos]
+        elif choice == 4 and len(data) > 4:
+            del data[rng.randrange(4, len(data)):]
+        elif choice == 5 and len(data) > pos + 1:
+            end = rng.randrange(pos + 1, len(data) + 1)
+            data[pos:pos] = data[pos:end]  # repeat a slice, e.g. a TLV
+        elif choice == 6 and len(data) > 4:
+            data[4] = rng.randrange(256)  # lie about Lc
+        elif choice == 7 and data:
+            other = rng.choice(corpus)
+            data[pos:] = other[rng.randrange(len(other)):]
+    return bytes(data)
+
+def start_line_coverage(covered: set) -> bool:
+    # Python 3.12+: each line reports once, then DISABLE makes it free again
+    monitoring = getattr(sys, "monitoring", None)
+    if monitoring is None:
+        return False
+    filename = globals().get("__file__")
 
+    def on_line(code, line):
+        if code.co_filename == filename:
+            covered.add((code.co_name, line))
+        return monitoring.DISABLE
 
+    monitoring.use_tool_id(monitoring.COVERAGE_ID, "smartcard-fuzz")
+    monitoring.register_callback(monitoring.COVERAGE_ID, monitoring.events.LINE, on_line)
+    monitoring.set_events(monitoring.COVERAGE_ID, monitoring.events.LINE)
+    return True
 
+def stop_line_coverage():
+    monitoring = sys.monitoring
+    monitoring.set_events(monitoring.COVERAGE_ID, 0)
+    monitoring.register_callback(monitoring.COVERAGE_ID, monitoring.events.LINE, None)
+    monitoring.free_tool_id(monitoring.COVERAGE_ID)
+
+def check_image_integrity(fp) -> Optional[str]:
+    try:
+        root_res = get_root_offset(fp)
+        if root_res.sw == SW_SUCCESS and root_res.value != C_NULL:
+            for _ in walk(fp, root_res.value):
+                pass
+    except Exception as exc:
+        return f"{type(exc).__name__}: {exc}"
+    return None
+
+def fuzz(iterations: int = 100000, seed: int = 0, base: Optional[MemoryStorage] = None,
+         line_coverage: bool = True) -> FuzzReport:
+    # Coverage-guided: a case that reaches a new (INS, SW) pair or a new line of
+    # this module adds its APDUs to the corpus
+    rng = random.Random(seed)
+    base = base or build_fuzz_image()
+    corpus = [bytes.fromhex(command) for command in FUZZ_SEED_APDUS]
+    behaviours = set()
+    lines = set()
+    findings = {}
+    executions = 0
+    cases = 0
+    apdu = new_apdu()
+    tracing = line_coverage and start_line_coverage(lines)
+    start = time.perf_counter()
+    try:
+        with silenced(), bound_session(CardSession()):
+            while executions < iterations:
+                fp = base.fork()
+                reset_global_state()
+                handle_power_up_selection(fp)
+                case = [mutate_apdu(rng, rng.choice(corpus), corpus) if rng.random() < 0.8 else rng.choice(corpus)
+                        for _ in range(rng.randint(1, FUZZ_MAX_CASE_LEN))]
+                known = len(behaviours) + len(lines)
+                for command in case:
+                    executions += 1
+                    ins = command[1] if len(command) > 1 else None
+                    channel_context.last_error = None
+                    try:
+                        sw, _ = route_apdu(command, fp, apdu)
+                        if channel_context.last_error is not None:
+                            raise channel_context.last_error
+                    except Exception as exc:
+                        frame = traceback.extract_tb(exc.__traceback__)[-1]
+                        key = ("exception", type(exc).__name__, frame.name, frame.lineno)
+                        findings.setdefault(key, {"kind": "exception", "error": f"{type(exc).__name__}: {exc}",
+                                                  "where": f"{frame.name}:{frame.lineno}",
+                                                  "apdus": [c.hex().upper() for c in case]})
+                        break
+                    behaviours.add((ins, sw))
+                    if sw in [SW_MEMORY_FAILURE, SW_TECHNICAL_PROBLEM]:
+                        # A healthy image only reports these when an exception was swallowed
+                        findings.setdefault(("swallowed", ins, sw), {"kind": "swallowed", "error": f"{sw:04X}",
+                                                                     "where": f"INS {ins:02X}",
+                                                                     "apdus": [c.hex().upper() for c in case]})
+                problem = check_image_integrity(fp)
+                if problem is not None:
+                    findings.setdefault(("corruption", problem), {"kind": "corruption", "error": problem, "where": "",
+                                                                  "apdus": [c.hex().upper() for c in case]})
+                if len(behaviours) + len(lines) > known and len(corpus) < FUZZ_MAX_CORPUS:
+                    corpus.extend(case)
+                cases += 1
+    finally:
+        if tracing:
+            stop_line_coverage()
+    return FuzzReport(executions=executions, cases=cases, elapsed=time.perf_counter() - start,
+                      behaviours=behaviours, lines=len(lines), findings=list(findings.values()),
+                      corpus_size=len(corpus))
+
+def print_fuzz_report(report: FuzzReport):
+    print_infof("%d APDUs in %d cases, %.1f s (%.0f APDU/s)\n", "cyan", report.executions, report.cases,
+                report.elapsed, report.executions_per_second)
+    print_infof("Coverage: %d (INS, SW) pairs, %d lines; corpus %d\n", "cyan", len(report.behaviours),
+                report.lines, report.corpus_size)
+    for finding in report.findings:
+        print_infof("[%s] %s at %s\n", "red", finding["kind"], finding["error"], finding["where"])
+        for command in finding["apdus"]:
+            print_infof("    %s\n", "yellow", command)
+    if not report.findings:
+        print_colored_text("No findings\n", "green")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 3 and sys.argv[1] == "migrate":
+        status = migrate_image_file(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+        print_infof("%04X: %s\n", "green" if status == SW_SUCCESS else "red", status, get_status_description(status))
+        sys.exit(0 if status == SW_SUCCESS else 1)
+    if len(sys.argv) >= 4 and sys.argv[1] == "fleet-pack":
+        count = pack_fleet(sys.argv[2], sys.argv[3:])
+        print_infof("Packed %d images into %s\n", "green", count, sys.argv[2])
+        sys.exit(0)
+    if len(sys.argv) == 4 and sys.argv[1] == "fleet-unpack":
+        count = unpack_fleet(sys.argv[2], sys.argv[3])
+        print_infof("Unpacked %d images into %s\n", "green", count, sys.argv[3])
+        sys.exit(0)
+    if len(sys.argv) == 5 and sys.argv[1] == "fleet-get":
+        with FleetArchive(sys.argv[2]) as archive, open(sys.argv[4], "wb") as f:
+            f.write(archive.get(sys.argv[3]))
+        sys.exit(0)
+    if len(sys.argv) in [3, 4] and sys.argv[1] == "export":
+        with open_storage("file", sys.argv[2]) as fp:
+            text = json.dumps(export_tree(fp), indent=2)
+        if len(sys.argv) == 4:
+            with open(sys.argv[3], "w") as f:
+                f.write(text)
+        else:
+            print(text)
+        sys.exit(0)
+    if len(sys.argv) == 4 and sys.argv[1] == "diff":
+        with open_storage("file", sys.argv[2]) as a_fp, open_storage("file", sys.argv[3]) as b_fp:
+            changes = diff_images(a_fp, b_fp)
+        print(json.dumps(changes, indent=2))
+        sys.exit(1 if changes else 0)
+    if len(sys.argv) == 4 and sys.argv[1] == "diff-fleet":
+        with open_storage("file", sys.argv[2]) as reference, FleetArchive(sys.argv[3]) as archive:
+            changes = diff_fleet(reference, archive)
+        print(json.dumps({name: diff for name, diff in changes.items() if diff}, indent=2))
+        sys.exit(0)
+    if len(sys.argv) >= 4 and sys.argv[1] == "replay":
+        # Replays into an in-RAM copy so the image on disk is left untouched
+        with open(sys.argv[3], "rb") as f:
+            fp = initialize_smartcard_file("memory", image=f.read())
+        result = replay_trace(read_trace(sys.argv[2]), fp, paced="--paced" in sys.argv[4:])
+        print_replay_result(result)
+        sys.exit(1 if result.mismatches else 0)
+    args, options = split_options(sys.argv[2:])
+    if len(args) <= 1 and sys.argv[1:2] == ["repl"]:
+        with start_card(args[0] if args else FILE_NAME, index_path=options.get("index")) as fp, \
+                session_capture(fp, options):
+            run_repl(Interpreter(fp))
+        sys.exit(0)
+    if len(args) in [1, 2] and sys.argv[1:2] == ["batch"]:
+        with start_card(args[1] if len(args) == 2 else FILE_NAME, index_path=options.get("index")) as fp, \
+                session_capture(fp, options):
+            if args[0] == "-":
+                run_batch(Interpreter(fp), sys.stdin)
+            else:
+                with open(args[0]) as f:
+                    run_batch(Interpreter(fp), f)
+        sys.exit(0)
+    if len(args) <= 2 and sys.argv[1:2] == ["serve"]:
+        mode = "durable" if "durable" in options else "fast-ack" if "fast-ack" in options else None
+        with start_card(args[1] if len(args) > 1 else FILE_NAME, group_commit=mode, index_path=options.get("index")) as fp, \
+                session_capture(fp, options):
+            serve_tcp(fp, port=int(args[0]) if args else TCP_PORT)
+        sys.exit(0)
+    if len(sys.argv) >= 3 and sys.argv[1] == "analyze":
+        group_by = options["group-by"].split(",") if "group-by" in options else None
+        archive = FleetArchive(args[0]) if len(args) == 1 and not args[0].endswith(".bin") else None
+        try:
+            names, records = analyze_fleet(archive or read_image_files(args), options.get("where"), group_by,
+                                           "images" in options)
+        finally:
+            if archive is not None:
+                archive.close()
+        if "csv" in options:
+            export_records_csv(records, options["csv"])
+        if "parquet" in options:
+            export_records_parquet(records, options["parquet"])
+        print_records(records)
+        print_infof("%d rows from %d images\n", "green", records.size, len(names))
+        sys.exit(0)
+    if len(sys.argv) in [3, 4] and sys.argv[1] == "wear":
+        stats = read_wear_stats(sys.argv[2])
+        if len(sys.argv) == 4:
+            with open_storage("file", sys.argv[3]) as fp:
+                print_wear_report(stats, fp)
+        else:
+            print_wear_report(stats)
+        sys.exit(0)
+    if len(sys.argv) >= 2 and sys.argv[1] == "fuzz":
+        report = fuzz(int(sys.argv[2]) if len(sys.argv) > 2 else 100000, int(sys.argv[3]) if len(sys.argv) > 3 else 0)
+        print_fuzz_report(report)
+        sys.exit(1 if report.findings else 0)
+    print(f"Usage: {sys.argv[0]} repl [image] [--trace=file] [--wear=sidecar] [--index=sidecar]")
+    print(f"       {sys.argv[0]} batch <script|-> [image] [--trace=file] [--wear=sidecar] [--index=sidecar]")
+    print(f"       {sys.argv[0]} serve [port] [image] [--durable|--fast-ack] [--trace=file] [--wear=sidecar]"
+          " [--index=sidecar]")
+    print(f"       {sys.argv[0]} migrate <image> [output]")
+    print(f"       {sys.argv[0]} fleet-pack <archive> <image>...")
+    print(f"       {sys.argv[0]} fleet-unpack <archive> <directory>")
+    print(f"       {sys.argv[0]} fleet-get <archive> <card> <output>")
+    print(f"       {sys.argv[0]} export <image> [output.json]")
+    print(f"       {sys.argv[0]} diff <image> <image>")
+    print(f"       {sys.argv[0]} diff-fleet <reference image> <archive>")
+    print(f"       {sys.argv[0]} replay <trace> <image> [--paced]")
+    print(f"       {sys.argv[0]} analyze <archive|image.bin...> [--where=EXPR] [--group-by=F,...] [--images]"
+          " [--csv=out] [--parquet=out]")
+    print(f"       {sys.argv[0]} wear <sidecar> [image]")
+    print(f"       {sys.argv[0]} fuzz [iterations] [seed]")